@@ -3,11 +3,17 @@ import logging
 import os
 from collections import defaultdict
 from annotation.utility import Utility
+from annotation.schema import AnnotationSchema
+from annotation.generation.wikifier_stats import WikifierStats
 
 _logger = logging.getLogger(__name__)
 TYPE_MAP_DICT = {"string": "String", "number": "Quantity", "year": "Time", "month": "Time", "day": "Time",
                  "date": "Time", "entity": 'WikibaseItem'}
 
+# template dataframes and the sheet they are saved to
+TEMPLATE_SHEETS = {"dataset_file": "Dataset", "attributes_file": "Attributes", "units_file": "Units",
+                   "extra_edges": "Extra Edges", "Wikifier_t2wml": "Wikifier_t2wml"}
+
 # kyao
 # Only add one location qualifier until datamart-api can handle multiple locations. 31 July 2020.
 ADDITIONAL_QUALIFIER_MAP = {
@@ -24,37 +30,36 @@ ADDITIONAL_QUALIFIER_MAP = {
 }
 
 
-def generate_template_from_df(input_df: pd.DataFrame, dataset_qnode: str, dataset_id: str) -> dict:
+def generate_template_from_df(input_df: pd.DataFrame, dataset_qnode: str, dataset_id: str,
+                              schema: AnnotationSchema = None, wikifier_stats: WikifierStats = None) -> dict:
     """
     Function used for datamart annotation batch mode, return a dict of dataFrame instead of output a xlsx file.
-
+    `schema` is the parsed annotation of `input_df`, it is built here if not given.
+    `wikifier_stats`: if given, the `WikifierStats` of the wikifier runs are merged into it
     """
 
     # Assumes cell [0,0] is the start of the annotation
     if not input_df.iloc[0,0] == 'dataset':
         raise Exception('The first column of the dataframe must bet the annotations (not the index of the dataframe)')
 
+    if schema is None:
+        schema = AnnotationSchema(input_df)
+
     utility = Utility()
 
     # updated 2020.7.22: it is possible that header is not at row 7, so we need to search header row if exist
-    header_row, data_row = utility.find_data_start_row(input_df)
+    header_row, data_row = utility.find_data_start_row(input_df, schema)
 
-    input_df = input_df.set_index(0)
-    if 'tag' in input_df.iloc[:7, 0]:
-        annotation_rows = list(range(1, 7)) + [header_row]
-    else:
-        annotation_rows = list(range(1, 6)) + [header_row]
-    content_rows = list(range(data_row, len(input_df)))
-
-    annotation_part = input_df.iloc[annotation_rows].fillna("")
-    content_part = input_df.iloc[content_rows]
+    # positional slices without column A instead of set_index(0) + a row list, so the sheet is not copied
+    annotation_part = input_df.iloc[:, 1:]
+    content_part = annotation_part.iloc[data_row:]
 
     # start generate dataframe for templates
-    dataset_df = _generate_dataset_tab(input_df, dataset_qnode, dataset_id)
-    attribute_df = _generate_attributes_tab(dataset_qnode, annotation_part)
-    unit_df = _generate_unit_tab(dataset_qnode, content_part, annotation_part)
-    extra_df, wikifier_df1 = _process_main_subject(dataset_qnode, content_part, annotation_part, data_row)
-    wikifier_df2 = _generate_wikifier_part(content_part, annotation_part, data_row)
+    dataset_df = _generate_dataset_tab(annotation_part, dataset_qnode, dataset_id)
+    attribute_df = _generate_attributes_tab(dataset_qnode, schema)
+    unit_df = _generate_unit_tab(dataset_qnode, content_part, schema)
+    extra_df, wikifier_df1 = _process_main_subject(dataset_qnode, content_part, schema, data_row)
+    wikifier_df2 = _generate_wikifier_part(content_part, schema, data_row, wikifier_stats)
     wikifier_df = pd.concat([wikifier_df1, wikifier_df2])
 
     output_df_dict = {
@@ -86,11 +91,23 @@ def generate_template(input_path: str, output_path: str, dataset_qnode: str = No
 
 def save_template_file(output_df_dict: dict, output_path: str) -> None:
     with pd.ExcelWriter(output_path) as writer:
-        output_df_dict["dataset_file"].to_excel(writer, sheet_name='Dataset', index=False)
-        output_df_dict["attributes_file"].to_excel(writer, sheet_name='Attributes', index=False)
-        output_df_dict["units_file"].to_excel(writer, sheet_name='Units', index=False)
-        output_df_dict["extra_edges"].to_excel(writer, sheet_name="Extra Edges", index=False)
-        output_df_dict["Wikifier_t2wml"].to_excel(writer, sheet_name="Wikifier_t2wml", index=False)
+        for key, sheet_name in TEMPLATE_SHEETS.items():
+            output_df_dict[key].to_excel(writer, sheet_name=sheet_name, index=False)
+
+
+def save_template_bundle(output_df_dict: dict, output_dir: str, file_format: str = "csv") -> None:
+    """
+    save the template as a folder with one csv or parquet file per sheet, much faster to write than xlsx
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for key, sheet_name in TEMPLATE_SHEETS.items():
+        output_file_path = os.path.join(output_dir, "{}.{}".format(sheet_name, file_format))
+        if file_format == "csv":
+            output_df_dict[key].to_csv(output_file_path, index=False)
+        elif file_format == "parquet":
+            Utility.to_parquet(output_df_dict[key], output_file_path)
+        else:
+            raise ValueError("Unknown template bundle format `{}`".format(file_format))
 
 
 def _generate_dataset_tab(input_df: pd.DataFrame, dataset_qnode: str, dataset_id: str) -> pd.DataFrame:
@@ -123,7 +140,7 @@ def _generate_dataset_tab(input_df: pd.DataFrame, dataset_qnode: str, dataset_id
     return dataset_df
 
 
-def _generate_attributes_tab(dataset_qnode: str, annotation_part: pd.DataFrame) -> pd.DataFrame:
+def _generate_attributes_tab(dataset_qnode: str, schema: AnnotationSchema) -> pd.DataFrame:
     """
         codes used to generate the template attribute tab
         1. add for columns with role = variable or role = qualifier.
@@ -142,9 +159,8 @@ def _generate_attributes_tab(dataset_qnode: str, annotation_part: pd.DataFrame)
     #                                    "label": edge_info["Attribute"],
     #                                    "description": edge_info["Attribute"]})
 
-    for i in range(annotation_part.shape[1]):
-        each_col_info = annotation_part.iloc[:, i]
-        role_info = each_col_info["role"].split(";")
+    for col in range(1, schema.n_columns):
+        role_info = schema.roles[col].split(";")
         role_lower = role_info[0].lower()
 
         if role_lower in {"variable", "qualifier"}:
@@ -154,18 +170,18 @@ def _generate_attributes_tab(dataset_qnode: str, annotation_part: pd.DataFrame)
             # otherwise apply this variable / qualifier for all by give empty cell
             else:
                 relationship = ""
-            attribute = each_col_info["header"]
-            role_type = each_col_info["type"].lower()
+            attribute = schema.headers[col]
+            role_type = schema.types[col].lower()
             if role_type == "":
                 continue
 
             if role_type not in TYPE_MAP_DICT:
-                raise ValueError("Column type {} for column {} is not valid!".format(role_type, i))
-            data_type = TYPE_MAP_DICT[each_col_info["type"]]
-            label = "{}".format(attribute) if not each_col_info['name'] else each_col_info['name']
-            description = "{} column in {}".format(role_lower, dataset_qnode) if not each_col_info['description'] \
-                else each_col_info['description']
-            tag = each_col_info['tag'] if 'tag' in each_col_info else ""
+                raise ValueError("Column type {} for column {} is not valid!".format(role_type, col - 1))
+            data_type = TYPE_MAP_DICT[schema.types[col]]
+            label = "{}".format(attribute) if not schema.names[col] else schema.names[col]
+            description = "{} column in {}".format(role_lower, dataset_qnode) if not schema.descriptions[col] \
+                else schema.descriptions[col]
+            tag = schema.tags[col] if schema.has_tag else ""
 
             # qualifier and variables have been deduplicated already in validation. Now if anything is repeating,
             # it is meant to be same.
@@ -183,7 +199,7 @@ def _generate_attributes_tab(dataset_qnode: str, annotation_part: pd.DataFrame)
     return attributes_df
 
 
-def _generate_unit_tab(dataset_qnode: str, content_part: pd.DataFrame, annotation_part: pd.DataFrame) -> pd.DataFrame:
+def _generate_unit_tab(dataset_qnode: str, content_part: pd.DataFrame, schema: AnnotationSchema) -> pd.DataFrame:
     """
         codes used to generate the template unit tab
         1. list all the distinct units defined in the units row
@@ -199,10 +215,11 @@ def _generate_unit_tab(dataset_qnode: str, content_part: pd.DataFrame, annotatio
     unit_cols = defaultdict(list)
     units_set = set()
 
-    for i in range(annotation_part.shape[1]):
-        each_col_info = annotation_part.iloc[:, i]
+    for col in range(1, schema.n_columns):
+        # content_part starts at column B, so its columns are shifted by one
+        i = col - 1
 
-        role = each_col_info["role"].lower()
+        role = schema.roles[col].lower()
         # if role is unit, record them
         if len(role) >= 4 and role[:4] == "unit":
             if role == "unit":
@@ -214,12 +231,14 @@ def _generate_unit_tab(dataset_qnode: str, content_part: pd.DataFrame, annotatio
                     unit_cols[each_variable].append(i)
 
         # add units defined in unit
-        if each_col_info['unit'] != "":
-            units_set.add(each_col_info['unit'])
+        if schema.units[col] != "":
+            units_set.add(schema.units[col])
 
     if len(unit_cols) > 0:
         for each_variable_units in unit_cols.values():
-            units_set.update(content_part.iloc[:, each_variable_units].agg(", ".join, axis=1).unique())
+            # unit columns have few distinct combinations, only join each distinct combination once
+            unit_combinations = content_part.iloc[:, each_variable_units].drop_duplicates()
+            units_set.update(unit_combinations.agg(", ".join, axis=1).unique())
 
     # sort for better index for human vision
     for each_unit in sorted(list(units_set)):
@@ -233,25 +252,24 @@ def _generate_unit_tab(dataset_qnode: str, content_part: pd.DataFrame, annotatio
     return unit_df
 
 
-def _process_main_subject(dataset_qnode: str, content_part: pd.DataFrame, annotation_part: pd.DataFrame, data_row):
+def _process_main_subject(dataset_qnode: str, content_part: pd.DataFrame, schema: AnnotationSchema, data_row):
     col_offset = 1
     wikifier_df_list = []
     extra_df_list = []
     created_node_ids = set()
-    for i in range(annotation_part.shape[1]):
-        each_col_info = annotation_part.iloc[:, i]
-        role = each_col_info["role"].lower()
+    for col in range(1, schema.n_columns):
+        i = col - 1
+        role = schema.roles[col].lower()
         if role == "main subject":
             allowed_types = {"string", "country", "admin1", "admin2", "admin3"}
-            each_col_info = annotation_part.iloc[:, i]
-            type_ = each_col_info["type"].lower()
-            main_subject_annotation = annotation_part.iloc[:, i]
+            type_ = schema.types[col].lower()
+            header = schema.headers[col]
 
             # generate wikifier file and extra edge file for main subjects when type == string
             if type_ == "string":
                 for row, each in enumerate(content_part.iloc[:, i]):
                     label = str(each).strip()
-                    node = "{}_{}_{}".format(dataset_qnode, each_col_info["header"], label) \
+                    node = "{}_{}_{}".format(dataset_qnode, header, label) \
                         .replace(" ", "_").replace("-", "_")
 
                     # wikifier part should always be updated, as column/row is specified for each cell
@@ -265,8 +283,7 @@ def _process_main_subject(dataset_qnode: str, content_part: pd.DataFrame, annota
                     created_node_ids.add(node)
 
                     labels = ["label", "description", "P31"]
-                    node2s = ["{} {}".format(main_subject_annotation["header"], label),
-                              main_subject_annotation["description"], "Q35120"]
+                    node2s = ["{} {}".format(header, label), schema.descriptions[col], "Q35120"]
                     for each_label, each_node2 in zip(labels, node2s):
                         id_ = "{}-{}".format(node, each_label)
                         extra_df_list.append({"id": id_, "node1": node, "label": each_label, "node2": each_node2})
@@ -289,7 +306,8 @@ def _process_main_subject(dataset_qnode: str, content_part: pd.DataFrame, annota
     return extra_df, wikifier_df
 
 
-def _generate_wikifier_part(content_part: pd.DataFrame, annotation_part: pd.DataFrame, data_row):
+def _generate_wikifier_part(content_part: pd.DataFrame, schema: AnnotationSchema, data_row,
+                            stats: WikifierStats = None):
     # generate wikifier file for all columns that have type == country, admin1, admin2, or admin3
     # TODO: set country wikifier and ethiopia wikifier to be a service
     wikifier_df_list = []
@@ -300,28 +318,30 @@ def _generate_wikifier_part(content_part: pd.DataFrame, annotation_part: pd.Data
     data_type_need_wikifier = {"admin1", "admin2", "admin3"}
     wikifier_column_metadata = []  # for column metadata in wikifier output
     col_offset = 1
-    for i in range(annotation_part.shape[1]):
-        each_col_info = annotation_part.iloc[:, i]
-        if each_col_info["role"] in new_wikifier_roles:
-            if each_col_info["type"] == "country":
+    for col in range(1, schema.n_columns):
+        i = col - 1
+        role = schema.roles[col]
+        type_ = schema.types[col]
+        if role in new_wikifier_roles:
+            if type_ == "country":
                 has_country_column = True
                 # use country wikifier
-                context = "main subject" if each_col_info["role"] == "main subject" else each_col_info["type"]
+                context = "main subject" if role == "main subject" else type_
                 column_metadata = {"context": context}
                 wikifier_df_list.extend(run_wikifier(
                     input_df=content_part, target_col=i,
-                    return_type="list", wikifier_type="country", column_metadata=column_metadata))
+                    return_type="list", wikifier_type="country", column_metadata=column_metadata, stats=stats))
 
                 if "ethiopia" in [each.lower() for each in content_part.iloc[:, i].dropna().unique()]:
                     run_ethiopia_wikifier = True
 
-            if each_col_info["type"] in data_type_need_wikifier:
+            if type_ in data_type_need_wikifier:
                 target_cols.append(i)
                 each_metadata = {}
-                if each_col_info["role"] == "location":
-                    each_metadata["context"] = each_col_info["type"]
+                if role == "location":
+                    each_metadata["context"] = type_
                 else:
-                    each_metadata["context"] = new_wikifier_roles[each_col_info["role"]]
+                    each_metadata["context"] = new_wikifier_roles[role]
                 wikifier_column_metadata.append(each_metadata)
 
     # if no country column exists, assume the country is Ethiopia
@@ -342,7 +362,7 @@ def _generate_wikifier_part(content_part: pd.DataFrame, annotation_part: pd.Data
             # for each part, run wikifier and add it the wikifier file
             wikifier_df_list.extend(run_wikifier(input_df=target_df, target_col=i, wikifier_type="ethiopia",
                                                  col_offset=col_offset + target_cols[i] - i, row_offset=data_row,
-                                                 column_metadata=wikifier_column_metadata[i]
+                                                 column_metadata=wikifier_column_metadata[i], stats=stats
                                                  )
                                     )
 
@@ -354,14 +374,17 @@ def _generate_wikifier_part(content_part: pd.DataFrame, annotation_part: pd.Data
 
 
 def run_wikifier(input_df: pd.DataFrame, target_col: int, wikifier_type: str, return_type: str = "list",
-                 col_offset=0, row_offset=0, column_metadata: dict = None):
+                 col_offset=0, row_offset=0, column_metadata: dict = None, stats: WikifierStats = None):
+    """
+    stats: if given, the `WikifierStats` of the wikifier run are merged into it
+    """
     wikifier_df_list = []
     if column_metadata is None:
         column_metadata = {}
     if wikifier_type == "country":
         from annotation.generation.country_wikifier import DatamartCountryWikifier
-        wikified_result = DatamartCountryWikifier(). \
-            wikify(input_df.iloc[:, target_col].dropna().unique().tolist())
+        wikified_result, run_stats = DatamartCountryWikifier(). \
+            wikify(input_df.iloc[:, target_col].dropna().unique().tolist(), return_stats=True)
         for label, node in wikified_result.items():
             each_row = {"column": "", "row": "", "value": label, "context": column_metadata.get("context", ""),
                         "item": node}
@@ -373,9 +396,10 @@ def run_wikifier(input_df: pd.DataFrame, target_col: int, wikifier_type: str, re
         wikifier = EthiopiaWikifier()
         input_col_name = input_df.columns[target_col]
         output_col_name = "{}_wikifier".format(input_col_name)
-        wikifier_res = wikifier. \
-            produce(input_df=input_df, target_column=input_col_name, column_metadata=column_metadata). \
-            fillna("")
+        wikifier_res, run_stats = wikifier. \
+            produce(input_df=input_df, target_column=input_col_name, column_metadata=column_metadata,
+                    return_stats=True)
+        wikifier_res = wikifier_res.fillna("")
         # wrap to t2wml wikifier format
         for row_number, each_row in wikifier_res.iterrows():
             label = each_row[input_col_name]
@@ -388,6 +412,8 @@ def run_wikifier(input_df: pd.DataFrame, target_col: int, wikifier_type: str, re
     else:
         raise ValueError("Unsupport wikifier type!")
 
+    if stats is not None:
+        stats.merge(run_stats)
     if return_type == "list":
         return wikifier_df_list
     else:
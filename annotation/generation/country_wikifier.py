@@ -5,6 +5,8 @@ from functools import partial
 import rltk.similarity as sim
 import os
 from abc import ABC, abstractmethod
+from annotation.generation.wikifier_stats import WikifierStats
+from annotation.generation import reference_data
 
 
 def word_tokenizer(s):
@@ -91,8 +93,8 @@ class DatamartCountryWikifier:
             cache_file = __file__[:__file__.rfind("/")] + "/country_wikifier_cache.json"
         if not os.path.exists(cache_file):
             raise ValueError("Country wikifier cache file not exist at {}!".format(cache_file))
-        with open(cache_file, "r") as f:
-            self.memo = json.load(f)
+        self.memo = reference_data.load_file(cache_file, "country_wikifier_cache.json")
+        self.stats = WikifierStats()
 
     def save(self, loc: str = None) -> None:
         """
@@ -103,14 +105,31 @@ class DatamartCountryWikifier:
         with open(loc, "r") as f:
             json.dump(self.memo, f)
 
-    def wikify(self, input_countries: list) -> dict:
+    def wikify(self, input_countries: list, return_stats: bool = False):
+        """
+        Returns the dict from each input value to its qnode (None if not found), and the `WikifierStats` of the
+        run with it if `return_stats` is True. The stats are also kept in `self.stats`:
+        lookup.exact_hit / lookup.processed_hit / lookup.fuzzy_scan / lookup.too_short / lookup.known_miss split
+        the values looked up, fuzzy.accepted / fuzzy.rejected the outcome of the scans, fuzzy.candidates_scored the
+        similarities computed
+        """
+        self.stats = stats = WikifierStats()
+        with stats.timer("wikify"):
+            wikified = self._wikify(input_countries, stats)
+        if return_stats:
+            return wikified, stats
+        return wikified
+
+    def _wikify(self, input_countries: list, stats: WikifierStats) -> dict:
         no_wifiy_memo = set()
         wikifier_result = []
         wikified = {}
         for each in input_countries:
+            stats.count("inputs")
             if isinstance(each, str) or not np.isnan(each):
                 # skip those input we already confirm no candidate
                 if each in no_wifiy_memo:
+                    stats.count("lookup.known_miss")
                     wikifier_result.append("")
                     continue
 
@@ -124,32 +143,43 @@ class DatamartCountryWikifier:
                         input_str_processed_no_bracket not in self.memo:
                     # if not exact matched and the length is less than 4, ignore it
                     if len(input_str) < 4:
+                        stats.count("lookup.too_short")
                         no_wifiy_memo.add(each)
                         wikifier_result.append("")
                         continue
 
                     self._logger.warning("`{}` not in record, will try to find the closest result".format(each))
+                    stats.count("lookup.fuzzy_scan")
                     highest_score = 0
                     best_res = ""
-                    for each_candidate in self.memo.keys():
-                        score = self.similarity_unit.similarity(input_str, each_candidate)
-                        if score > highest_score:
-                            best_res = each_candidate
-                            highest_score = score
+                    with stats.timer("fuzzy_scan"):
+                        for each_candidate in self.memo.keys():
+                            score = self.similarity_unit.similarity(input_str, each_candidate)
+                            if score > highest_score:
+                                best_res = each_candidate
+                                highest_score = score
+                    stats.count("fuzzy.candidates_scored", len(self.memo))
 
                     if highest_score > 0:
                         self._logger.info("get best match: `{}` with score `{}`".format(best_res, highest_score))
                         if highest_score > 0.9:
+                            stats.count("fuzzy.accepted")
                             self._logger.info("will add `{}` to memo as `{}`".format(input_str, best_res))
                             wikified[each] = self.memo[best_res]
 
                         else:
+                            stats.count("fuzzy.rejected")
                             no_wifiy_memo.add(each)
                             wikified[each] = None
                             self._logger.warning("Not wikify for input value `{}`".format(each))
+                    else:
+                        stats.count("fuzzy.rejected")
                 else:
+                    stats.count("lookup.exact_hit" if input_str in self.memo else "lookup.processed_hit")
                     wikified[each] = self.memo.get(input_str, None) or self.memo.get(input_str_processed,
                                                                                      None) or self.memo.get(
                         input_str_processed_no_bracket, None)
+            else:
+                stats.count("missing_inputs")
 
         return wikified
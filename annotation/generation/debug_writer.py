@@ -0,0 +1,104 @@
+import csv
+import importlib.util
+import os
+import shutil
+import traceback
+import typing
+import yaml
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, Future
+from annotation.utility import Utility
+from annotation.generation.annotation_to_template import save_template_file, save_template_bundle
+
+DEBUG_FORMATS = ("xlsx", "csv", "parquet")
+
+
+class DebugArtifactWriter(object):
+    """
+    Writes the debug artifacts of GenerateKgtk on a background thread so the main result never waits on them.
+
+    With `debug_format="xlsx"` the artifacts are the same as before: template.xlsx, t2wml.yaml and the template
+    output files. "csv" and "parquet" save the template as a `template` folder with one file per sheet instead, and
+    "parquet" also saves the dataframe artifacts as parquet.
+
+    The dataframes given to the writer must not be modified afterwards. Errors are printed when they happen and
+    raised by `wait`.
+    """
+
+    def __init__(self, debug_dir: str, debug_format: str = "xlsx"):
+        if debug_format not in DEBUG_FORMATS:
+            raise ValueError("Unknown debug format `{}`, should be one of {}".format(debug_format, DEBUG_FORMATS))
+        if debug_format == "parquet" and not any(importlib.util.find_spec(each) for each in ("pyarrow", "fastparquet")):
+            raise ValueError("Debug format `parquet` requires pyarrow or fastparquet to be installed")
+        self.debug_dir = debug_dir
+        self.debug_format = debug_format
+        # a single thread keeps the artifacts written in submission order, started with the first artifact
+        self._executor = None
+        self._futures = []
+
+    def write_template(self, template_df_dict: dict) -> Future:
+        if self.debug_format == "xlsx":
+            return self._submit("template.xlsx", save_template_file, template_df_dict,
+                                os.path.join(self.debug_dir, "template.xlsx"))
+        return self._submit("template", save_template_bundle, template_df_dict,
+                            os.path.join(self.debug_dir, "template"), self.debug_format)
+
+    def write_yaml(self, file_name: str, content) -> Future:
+        def _write():
+            with open(os.path.join(self.debug_dir, file_name), 'w') as out:
+                yaml.dump(content, out)
+        return self._submit(file_name, _write)
+
+    def write_df(self, file_name: str, df: pd.DataFrame) -> Future:
+        """
+        save `df` as `file_name` (.csv or kgtk .tsv), or next to it as parquet in parquet mode
+        """
+        output_file_path = os.path.join(self.debug_dir, file_name)
+        if self.debug_format == "parquet":
+            return self._submit(file_name, Utility.to_parquet, df, os.path.splitext(output_file_path)[0] + ".parquet")
+        if file_name.endswith(".tsv"):
+            return self._submit(file_name, df.to_csv, output_file_path, sep='\t', index=False,
+                                quoting=csv.QUOTE_NONE)
+        return self._submit(file_name, df.to_csv, output_file_path, index=False)
+
+    def copy_file(self, file_path: str, file_name: str) -> Future:
+        return self._submit(file_name, shutil.copy, file_path, os.path.join(self.debug_dir, file_name))
+
+    def _submit(self, name: str, func: typing.Callable, *args, **kwargs) -> Future:
+        def _run():
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                print("Error!!")
+                print("Writing debug artifact `{}` failed".format(name))
+                traceback.print_exc()
+                raise
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="debug-writer")
+        future = self._executor.submit(_run)
+        self._futures.append((name, future))
+        return future
+
+    def wait(self) -> None:
+        """
+        block until every artifact submitted so far is written, raises ValueError listing the failed ones
+        """
+        failures = []
+        for name, future in self._futures:
+            if future.exception() is not None:
+                failures.append("{}: {}".format(name, future.exception()))
+        self._futures = []
+        if failures:
+            raise ValueError("Writing debug artifacts failed!\n{}".format("\n".join(failures)))
+
+    def close(self, wait: bool = True, then: typing.Callable = None) -> None:
+        """
+        stop the writer thread once the pending artifacts are written, artifacts written afterwards start a new one.
+        `then` runs on the writer thread after them, e.g. to remove the files they are copied from. With wait=False
+        this returns right away and the thread finishes in the background, `wait` still reports the failures
+        """
+        if then is not None:
+            self._submit("cleanup", then)
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -0,0 +1,199 @@
+import csv
+import math
+import os
+import tempfile
+import typing
+import pandas as pd
+
+# memory the previous and current edges of a bucket may take once loaded
+DELTA_MEMORY_BUDGET = 512 * 1024 * 1024
+# parsed string columns take about this many times the size of the tsv
+PARSED_SIZE_FACTOR = 8
+# most rows read at once while the edges are split into buckets
+DELTA_CHUNK_ROWS = 500000
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+
+
+def _float_text(value: float) -> str:
+    # as arrow casts floats to text, integral values without the ".0" a tsv export does not have either
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _normalize(chunk: pd.DataFrame) -> pd.DataFrame:
+    # tsv and parquet exports are compared as text, missing values as empty strings
+    chunk = chunk.copy()
+    for column in chunk.columns:
+        if pd.api.types.is_float_dtype(chunk[column]):
+            chunk[column] = chunk[column].map(_float_text, na_action="ignore")
+    chunk = chunk.astype(object)
+    return chunk.where(chunk.notna(), "").astype(str)
+
+
+def _iter_tsv(path: str, chunk_rows: int) -> typing.Iterator[pd.DataFrame]:
+    with pd.read_csv(path, sep="\t", quoting=csv.QUOTE_NONE, dtype=str, keep_default_na=False,
+                     chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def _iter_parquet(path: str, chunk_rows: int) -> typing.Iterator[pd.DataFrame]:
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            # read as strings, a numeric column would otherwise come back as 1.0 where the tsv has 1.
+            # cast as a table, RecordBatch.cast only exists from pyarrow 16
+            table = pyarrow.Table.from_batches([batch]).cast(
+                pyarrow.schema([(name, pyarrow.string()) for name in batch.schema.names]))
+            yield _normalize(table.to_pandas())
+        return
+    except ImportError:
+        pass
+    try:
+        import fastparquet
+    except ImportError as e:
+        raise ValueError("Reading parquet files requires pyarrow or fastparquet: {}".format(e))
+    for chunk in fastparquet.ParquetFile(path).iter_row_groups():
+        yield _normalize(chunk)
+
+
+def iter_edges(path: str, chunk_rows: int = DELTA_CHUNK_ROWS) -> typing.Iterator[pd.DataFrame]:
+    """
+    Yields the edges of a kgtk tsv file or of a parquet file (by extension) in chunks of string columns
+    """
+    if os.path.splitext(path)[1].lower() in PARQUET_EXTENSIONS:
+        return _iter_parquet(path, chunk_rows)
+    return _iter_tsv(path, chunk_rows)
+
+
+def _row_digests(df: pd.DataFrame, columns: typing.List[str]) -> pd.Series:
+    # rows are equal when they have the same values in the same columns, whatever the column order of the file
+    return pd.util.hash_pandas_object(df.reindex(columns=columns, fill_value=""), index=False)
+
+
+def _bucket_of(ids: pd.Series, n_buckets: int):
+    return (pd.util.hash_pandas_object(ids, index=False).to_numpy() % n_buckets).astype(int)
+
+
+def _spill(path: str, n_buckets: int, directory: str, side: str, chunk_rows: int) -> typing.List[str]:
+    """
+    split the edges of `path` into `n_buckets` files by the hash of their id, returns the paths of the buckets
+    """
+    paths = [os.path.join(directory, "{}-{}.tsv".format(side, i)) for i in range(n_buckets)]
+    for chunk in iter_edges(path, chunk_rows):
+        for bucket, group in chunk.groupby(_bucket_of(chunk["id"], n_buckets), sort=False):
+            exists = os.path.exists(paths[bucket])
+            group.to_csv(paths[bucket], sep="\t", index=False, quoting=csv.QUOTE_NONE, mode="a", header=not exists)
+    return paths
+
+
+def _read_all(path: str, chunk_rows: int) -> pd.DataFrame:
+    chunks = list(iter_edges(path, chunk_rows))
+    if not chunks:
+        return pd.DataFrame(columns=["id"], dtype=str)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _parquet_size(path: str) -> typing.Tuple[int, int]:
+    """
+    uncompressed bytes and rows of a parquet file from its row group metadata, a compressed file loads much
+    larger than its size on disk
+    """
+    try:
+        import pyarrow.parquet
+        metadata = pyarrow.parquet.ParquetFile(path).metadata
+        # summed over the column chunks, older pyarrow writers store the compressed size as the row group size
+        row_groups = [metadata.row_group(i) for i in range(metadata.num_row_groups)]
+        return sum(each.column(i).total_uncompressed_size for each in row_groups
+                   for i in range(each.num_columns)), metadata.num_rows
+    except ImportError:
+        pass
+    try:
+        import fastparquet
+    except ImportError as e:
+        raise ValueError("Reading parquet files requires pyarrow or fastparquet: {}".format(e))
+    row_groups = fastparquet.ParquetFile(path).row_groups
+    return sum(each.total_byte_size for each in row_groups), sum(each.num_rows for each in row_groups)
+
+
+def _estimated_size(path: str) -> int:
+    # bytes of the edges as text, what PARSED_SIZE_FACTOR applies to
+    if os.path.splitext(path)[1].lower() in PARQUET_EXTENSIONS:
+        return _parquet_size(path)[0]
+    return os.path.getsize(path)
+
+
+def _bytes_per_row(path: str, sample_bytes: int = 1 << 20) -> float:
+    # tsv files are estimated from their beginning, parquet files from their metadata
+    if os.path.splitext(path)[1].lower() in PARQUET_EXTENSIONS:
+        size, rows = _parquet_size(path)
+        return size / max(rows, 1)
+    with open(path, "rb") as f:
+        sample = f.read(sample_bytes)
+    return len(sample) / max(sample.count(b"\n"), 1)
+
+
+def _columns(path: str) -> typing.List[str]:
+    for chunk in iter_edges(path, 1):
+        return list(chunk.columns)
+    return []
+
+
+def diff_edges(previous_path: str, current_path: str, added_path: str, removed_path: str,
+               memory_budget: int = DELTA_MEMORY_BUDGET, chunk_rows: int = DELTA_CHUNK_ROWS) -> dict:
+    """
+    Writes the edges of `current_path` missing from `previous_path` to `added_path` and the edges of
+    `previous_path` missing from `current_path` to `removed_path`, both kgtk tsv. Either input may be a kgtk tsv
+    or a parquet file. Edges are matched by id, an edge whose id is in both files but with other values (in the
+    columns of the current file) is counted as changed and written to both outputs.
+
+    Memory stays bounded: when the files are larger than `memory_budget` both are first split into buckets by the
+    hash of the edge id (a grace hash join), each pair of buckets is then compared on its own. The outputs are
+    grouped by bucket rather than in the input order. Parquet files are sized by their uncompressed row groups, and
+    read as strings so that their values compare with the tsv text.
+
+    Returns the counts {"previous", "current", "added", "removed", "changed", "buckets"}.
+    """
+    previous_columns, current_columns = _columns(previous_path), _columns(current_path)
+    for path, columns in ((previous_path, previous_columns), (current_path, current_columns)):
+        if "id" not in columns:
+            raise ValueError("Edge file `{}` has no id column".format(path))
+    size = _estimated_size(previous_path) + _estimated_size(current_path)
+    n_buckets = max(1, math.ceil(size * PARSED_SIZE_FACTOR / memory_budget))
+    if n_buckets > 1:
+        # a chunk being split should not take more memory than a bucket
+        bytes_per_row = max(_bytes_per_row(previous_path), _bytes_per_row(current_path))
+        if bytes_per_row:
+            chunk_rows = max(1000, min(chunk_rows, int(memory_budget / (bytes_per_row * PARSED_SIZE_FACTOR))))
+
+    counts = {"previous": 0, "current": 0, "added": 0, "removed": 0, "changed": 0, "buckets": n_buckets}
+    with tempfile.TemporaryDirectory(prefix="edge-delta-") as directory:
+        if n_buckets == 1:
+            previous_buckets, current_buckets = [previous_path], [current_path]
+        else:
+            previous_buckets = _spill(previous_path, n_buckets, directory, "previous", chunk_rows)
+            current_buckets = _spill(current_path, n_buckets, directory, "current", chunk_rows)
+
+        for i, (previous_bucket, current_bucket) in enumerate(zip(previous_buckets, current_buckets)):
+            # a missing bucket file has no edges
+            previous_df = _read_all(previous_bucket, chunk_rows) if os.path.exists(previous_bucket) else \
+                pd.DataFrame(columns=["id"], dtype=str)
+            current_df = _read_all(current_bucket, chunk_rows) if os.path.exists(current_bucket) else \
+                pd.DataFrame(columns=["id"], dtype=str)
+            previous_digests = _row_digests(previous_df, current_columns)
+            current_digests = _row_digests(current_df, current_columns)
+            removed = previous_df[~previous_digests.isin(current_digests).to_numpy()]
+            added = current_df[~current_digests.isin(previous_digests).to_numpy()]
+
+            counts["previous"] += len(previous_df)
+            counts["current"] += len(current_df)
+            counts["added"] += len(added)
+            counts["removed"] += len(removed)
+            counts["changed"] += int(added["id"].isin(removed["id"]).sum())
+            added.reindex(columns=current_columns).to_csv(added_path, sep="\t", index=False,
+                                                          quoting=csv.QUOTE_NONE, mode="w" if i == 0 else "a",
+                                                          header=i == 0)
+            removed.reindex(columns=previous_columns).to_csv(removed_path, sep="\t", index=False,
+                                                             quoting=csv.QUOTE_NONE, mode="w" if i == 0 else "a",
+                                                             header=i == 0)
+    return counts
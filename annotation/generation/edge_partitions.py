@@ -0,0 +1,116 @@
+import csv
+import json
+import os
+import re
+import typing
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+# property of a variable node pointing to the property its statements use, and to its short name
+VARIABLE_PROPERTY_LABEL = "P1687"
+VARIABLE_SHORT_NAME_LABEL = "P1813"
+MANIFEST_VERSION = 1
+
+
+def _unquote(value: str) -> str:
+    value = str(value)
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+def variable_properties(variables_df: pd.DataFrame) -> typing.Dict[str, str]:
+    """
+    Returns the short name (P1813, as in `GenerateKgtk.variables_ids`) of the variable using each property,
+    built from the `kgtk_variables.tsv` edges.
+    """
+    short_names = variables_df[variables_df["label"] == VARIABLE_SHORT_NAME_LABEL]
+    short_names = dict(zip(short_names["node1"], short_names["node2"]))
+    properties = variables_df[variables_df["label"] == VARIABLE_PROPERTY_LABEL]
+    result = {}
+    for variable, property_id in zip(properties["node1"], properties["node2"]):
+        if variable in short_names and property_id not in result:
+            result[property_id] = short_names[variable]
+    return result
+
+
+def partition_keys(edges_df: pd.DataFrame, properties: typing.Dict[str, str]) -> pd.Series:
+    """
+    Returns the variable short name of each edge, NaN for the edges that are not about a variable.
+
+    Statement edges belong to the variable of their property, qualifier edges to the variable of the statement
+    they qualify (their node1 is the id of that statement edge).
+    """
+    keys = edges_df["label"].map(properties)
+    statements = keys.notna()
+    statement_keys = pd.Series(keys[statements].to_numpy(), index=edges_df.loc[statements, "id"].to_numpy())
+    statement_keys = statement_keys[~statement_keys.index.duplicated()]
+    return keys.fillna(edges_df["node1"].map(statement_keys))
+
+
+def partition_file_names(dataset_id: str, variables_ids: typing.List[str]) -> typing.Dict[str, str]:
+    """
+    Returns a distinct file name for each variable, the short names are sanitized for the file system
+    """
+    file_names = {}
+    used = {"{}-metadata.tsv".format(dataset_id)}
+    for variable in variables_ids:
+        base = "{}-variable-{}".format(dataset_id, re.sub(r"[^\w.-]+", "-", _unquote(variable)).strip("-") or "_")
+        file_name, n = base + ".tsv", 1
+        while file_name in used:
+            n += 1
+            file_name = "{}-{}.tsv".format(base, n)
+        used.add(file_name)
+        file_names[variable] = file_name
+    return file_names
+
+
+def _write_partition(df: pd.DataFrame, path: str) -> typing.Tuple[int, int]:
+    # written next to its final name and renamed, a reader never sees a partial partition
+    temp_path = path + ".tmp"
+    df.to_csv(temp_path, sep="\t", index=False, quoting=csv.QUOTE_NONE)
+    os.replace(temp_path, path)
+    return len(df), os.path.getsize(path)
+
+
+def write_partitions(edges_df: pd.DataFrame, variables_df: pd.DataFrame, variables_ids: typing.List[str],
+                     dataset_id: str, directory: str, workers: int = None) -> dict:
+    """
+    Split the edges into one file per variable plus one file with every other edge (dataset, variable, property
+    and qualifier definitions), written to `directory` in parallel. Every variable gets a file, empty ones only
+    have the header.
+
+    Returns the manifest, also written to `<dataset_id>-manifest.json` in `directory` once all the partitions
+    are complete:
+    {"version", "dataset_id", "columns", "rows", "bytes",
+     "partitions": [{"variable": short name or None for the metadata, "file", "rows", "bytes"}]}
+    """
+    os.makedirs(directory, exist_ok=True)
+    keys = partition_keys(edges_df, variable_properties(variables_df))
+    file_names = partition_file_names(dataset_id, variables_ids)
+    groups = {key: group for key, group in edges_df.groupby(keys, sort=False)}
+    partitions = [(variable, file_names[variable], groups.get(variable, edges_df.iloc[:0]))
+                  for variable in variables_ids]
+    # edges of variables missing from variables_ids (no P1813) stay with the metadata
+    partitions.append((None, "{}-metadata.tsv".format(dataset_id), edges_df[~keys.isin(variables_ids)]))
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="edge-partitions") as executor:
+        futures = [executor.submit(_write_partition, df, os.path.join(directory, file_name))
+                   for _, file_name, df in partitions]
+        sizes = [future.result() for future in futures]
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "dataset_id": dataset_id,
+        "columns": list(edges_df.columns),
+        "rows": sum(rows for rows, _ in sizes),
+        "bytes": sum(size for _, size in sizes),
+        "partitions": [{"variable": None if variable is None else _unquote(variable), "file": file_name,
+                        "rows": rows, "bytes": size}
+                       for (variable, file_name, _), (rows, size) in zip(partitions, sizes)],
+    }
+    manifest_path = os.path.join(directory, "{}-manifest.json".format(dataset_id))
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
@@ -1,4 +1,3 @@
-import csv
 import os
 import pandas as pd
 import numpy as np
@@ -9,8 +8,10 @@ import re
 import urllib.parse
 
 from annotation.generation.country_wikifier import HybridJaccardSimilarity
+from annotation.generation.generate_t2wml_files import run_shell_code
+from annotation.generation.wikifier_stats import WikifierStats
+from annotation.generation import reference_data
 from collections import defaultdict
-from io import StringIO
 from tl.utility.utility import Utility
 
 ethiopia_direction_dict = {"misraq": "east", "misraqawi": "eastern",
@@ -20,14 +21,11 @@ ethiopia_direction_dict = {"misraq": "east", "misraqawi": "eastern",
                            }
 CONSTRAINS_CHARS = set("abcdefghijklmnopqrstuvwxyz_() 1234567890'")
 
-ethiopia_census_code = {}
-with open(os.path.join(os.path.dirname(__file__), 'ethiopia_census_code.csv'), 'r') as fin:
-    reader = csv.reader(fin)
-    for row in reader:
-        ethiopia_census_code[row[0]] = row[1]
+ethiopia_census_code = reference_data.load("ethiopia_census_code.csv")
 
 class EthiopiaWikifier:
-    def __init__(self, es_server=None, es_index=None, sparql_server=None, similarity_threshold: float = 0.5):
+    def __init__(self, es_server=None, es_index=None, sparql_server=None, similarity_threshold: float = 0.5,
+                 timeout: float = None):
         if not es_server:
             # self.es_server = "http://kg2018a.isi.edu:9200"
             self.es_server = "https://dsbox02.isi.edu:8888/es"
@@ -47,6 +45,9 @@ class EthiopiaWikifier:
         self.similarity_threshold = similarity_threshold
         self.admin_level_mapping = {"admin1": 1, "admin2": 2, "admin3": 3}
         self.level_restrict = None
+        # seconds each table linker pipeline may run before it is killed
+        self.timeout = timeout
+        self.stats = WikifierStats()
 
     def generate_index(self, kgtk_file: str, output_path: str):
         """
@@ -220,10 +221,24 @@ class EthiopiaWikifier:
 
     def produce(self, input_file: str = None, input_df: pd.DataFrame = None,
                 target_column: str = None, output_column_name: str = None, unique_columns=typing.List[str],
-                column_metadata: dict = None) -> pd.DataFrame:
+                column_metadata: dict = None, return_stats: bool = False):
         """
         Main function of wikifier, the input could either be a dataframe or a input path
+
+        Returns the input with the wikifier column, and the `WikifierStats` of the run with it if `return_stats` is
+        True. The stats are also kept in `self.stats`: census_code.fast_path / table_linker.runs tell which path
+        was used, table_linker.<tl query>.rows the rows sent to each tl query and best_candidate.<branch> how
+        often each branch of `find_best_candidates` resolved a cell
         """
+        self.stats = stats = WikifierStats()
+        with stats.timer("produce"):
+            output_df = self._produce(input_file, input_df, target_column, output_column_name, column_metadata)
+        if return_stats:
+            return output_df, stats
+        return output_df
+
+    def _produce(self, input_file: str, input_df: pd.DataFrame, target_column: str, output_column_name: str,
+                 column_metadata: dict) -> pd.DataFrame:
         if column_metadata is None:
             column_metadata = {}
         level_restrict = column_metadata.get("context")
@@ -249,10 +264,13 @@ class EthiopiaWikifier:
             raise ValueError("Target column {} does not exist in input!".format(target_column))
 
         if self._is_census_code(input_df, target_column):
+            self.stats.count("census_code.fast_path")
             output_df = self._add_census_wikifier_column(input_df, target_column)
         else:
+            self.stats.count("table_linker.runs")
             df_all = self.run_table_linker(input_file, target_column)
-            final_answer = self.find_best_candidates(df_all)
+            with self.stats.timer("find_best_candidates"):
+                final_answer = self.find_best_candidates(df_all)
             final_answer = Utility.sort_by_col_and_row(final_answer).reset_index().drop(columns=["index"])
             # return output
             output_df = input_df.copy()
@@ -306,11 +324,9 @@ class EthiopiaWikifier:
             format(self.es_server, self.es_index,
                    input_file_path, target_column)
 
-        res = Utility.execute_shell_code(shell_code)
-        if res == "":
+        output_file = self._run_table_linker_query(shell_code, "tl first query")
+        if output_file is None:
             raise ValueError("Executing first query error when running on {}!".format(input_file_path))
-        res_io = StringIO(res)
-        output_file = pd.read_csv(res_io, dtype=object)
         return output_file
 
     def get_candidates2(self, input_file_path: str) -> pd.DataFrame:
@@ -328,13 +344,29 @@ class EthiopiaWikifier:
         / normalize-scores -c retrieval_score \
         / drop-duplicate -c kg_id --keep-method exact-match --score-column retrieval_score_normalized""". \
             format(self.es_server, self.es_index, input_file_path)
-        res = Utility.execute_shell_code(shell_code)
-        if res == "":
+        output_file = self._run_table_linker_query(shell_code, "tl second query")
+        if output_file is None:
             raise ValueError("Executing second query when running on {}!".format(input_file_path))
-        res_io = StringIO(res)
-        output_file = pd.read_csv(res_io, dtype=object)
         return output_file
 
+    def _run_table_linker_query(self, shell_code: str, stage: str) -> typing.Optional[pd.DataFrame]:
+        """
+        run a tl pipeline and parse its csv output while it is streamed, returns None if it printed nothing
+        """
+        def parse_candidates(stream):
+            try:
+                return pd.read_csv(stream, dtype=object)
+            except pd.errors.EmptyDataError:
+                return None
+
+        with self.stats.timer(stage):
+            return run_shell_code(shell_code, output_parser=parse_candidates, timeout=self.timeout, stage=stage,
+                                  debug=False).parsed
+
+    def _count_rows_sent(self, stage: str, n_rows: int) -> None:
+        # rows given to the tl pipeline, how tl turns them into elastic search queries is not measured
+        self.stats.count("table_linker.{}.rows".format(stage), n_rows)
+
     def remove_punctuation(self, input_str):
         words_processed = str(input_str).lower().translate(self.TRANSLATOR).split()
         return "".join(words_processed)
@@ -348,6 +380,8 @@ class EthiopiaWikifier:
         """
         # run first query
         df = self.get_candidates(input_file, target_column)
+        # every input row is kept in the output, with empty candidates if none was found
+        self._count_rows_sent("tl first query", len(df[["column", "row"]].drop_duplicates()))
 
         # run second query for those candidates which don't have exact match
         second_query_df_dict = {}
@@ -376,6 +410,7 @@ class EthiopiaWikifier:
                 second_query_df.to_csv(temp, index=False)
                 _ = temp.seek(0)
                 df_second_query = self.get_candidates2(temp.name)
+            self._count_rows_sent("tl second query", len(second_query_df))
             df_all = pd.concat([df_second_query, df])
             df_all = Utility.sort_by_col_and_row(df_all)
             return df_all
@@ -412,6 +447,7 @@ class EthiopiaWikifier:
 
             # no candidates
             if len(each_group.dropna()) == 0:
+                self.stats.count("best_candidate.no_candidate")
                 temp = each_group.iloc[0, :]
                 # temp_kg_id = "Q{}".format(temp["label"].lower())
                 # while temp_kg_id in self.
@@ -423,6 +459,7 @@ class EthiopiaWikifier:
 
             # 1. If only one candidate -> use it
             if len(each_group) == 1:
+                self.stats.count("best_candidate.single_candidate")
                 temp = each_group.iloc[0]
                 output_df_list.append(temp.to_dict())
                 self.check_level_information(temp)
@@ -432,6 +469,7 @@ class EthiopiaWikifier:
                 exact_match_res = each_group[each_group["method"] == "exact-match"]
                 # One exact match -> use it
                 if len(exact_match_res) == 1:
+                    self.stats.count("best_candidate.single_exact_match")
                     temp = exact_match_res.iloc[0]
                     output_df_list.append(temp.to_dict())
                     self.check_level_information(temp)
@@ -439,6 +477,7 @@ class EthiopiaWikifier:
                 # multiple exact match
                 else:
                     # check those later
+                    self.stats.count("best_candidate.multiple_exact_matches")
                     pending_results = pd.concat([pending_results, exact_match_res])
                     continue
             # no exact match, check other information
@@ -454,6 +493,7 @@ class EthiopiaWikifier:
                         if each_label[0] == '"' and each_label[-1] == '"':
                             each_label = each_label[1:-1]
                         score = self.similarity_unit.similarity(input_label, each_label)
+                        self.stats.count("best_candidate.candidates_scored")
                         if score >= self.similarity_threshold:
                             has_high_similairty_candidates = True
                             break
@@ -461,8 +501,10 @@ class EthiopiaWikifier:
                         break
 
                 if has_high_similairty_candidates:
+                    self.stats.count("best_candidate.similar_candidates")
                     pending_results = pd.concat([pending_results, each_group])
                 else:
+                    self.stats.count("best_candidate.no_similar_candidate")
                     temp = each_group.iloc[0, :]
                     empty_result = {'column':  temp['column'], 'row':  temp['row'],
                                     'label': temp['label'], '||other_information||': temp['||other_information||'],
@@ -484,10 +526,12 @@ class EthiopiaWikifier:
                 possible_candidates = self.get_higher_score_candidate(each_group, keep_multiple_highest=True, level=level)
                 possible_candidates = list(possible_candidates.values())[0]
                 if len(possible_candidates) == 1:
+                    self.stats.count("best_candidate.resolved_by_information")
                     output_df_list.append(possible_candidates[0].to_dict())
                     continue
                 else:
                     # no way to figure out, use the higher retrieval_score one
+                    self.stats.count("best_candidate.resolved_by_score")
                     highest_score = 0
                     final_res = None
                     for each in possible_candidates:
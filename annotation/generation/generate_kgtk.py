@@ -1,4 +1,5 @@
 import pandas as pd
+import math
 import tempfile
 import yaml
 import csv
@@ -6,21 +7,147 @@ import os
 import shutil
 import typing
 import traceback
+import hashlib
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 from t2wml.api import KnowledgeGraph
 from t2wml.wikification.utility_functions import add_entities_from_file
-from annotation.generation.generate_t2wml_files import execute_shell_code
+from annotation.generation.generate_t2wml_files import run_shell_code, async_run_shell_code, run_blocking
 from annotation.generation.wikify_datamart_units_and_attributes import generate
-from annotation.generation.annotation_to_template import generate_template_from_df, save_template_file
+from annotation.generation.annotation_to_template import generate_template_from_df
+from annotation.generation.debug_writer import DebugArtifactWriter
+from annotation.generation.wikifier_stats import WikifierStats
+from annotation.generation import reference_data
+from annotation.generation.edge_partitions import write_partitions
+from annotation.generation.edge_delta import DELTA_MEMORY_BUDGET, diff_edges
+from annotation.generation.native_t2wml import run_native_t2wml
+from annotation.generation.prune_data import prune_sheet
+from annotation.generation.generate_t2wml import Role, region_rows, with_region_rows
+from annotation.schema import AnnotationSchema
+from annotation.memory_report import MemoryReport, stage as memory_stage
+from annotation.profiler import StageProfiler, profiling_enabled, stage as profile_stage
+from annotation.metrics import PipelineMetrics, stage as metrics_stage
 from time import time
-import shortuuid
 
 # currently this script only support t2wml == 2.0a19
 
+# rows evaluated in the parent process to measure the t2wml throughput before sharding the rest of the region
+T2WML_CALIBRATION_ROWS = 200
+# wall time a shard should take, long enough to amortize loading the sheet and the yaml in the worker
+T2WML_SHARD_SECONDS = 10.0
+
+# "native" generates the statements of the templates made by ToT2WML without t2wml, see native_t2wml
+T2WML_ENGINES = ("t2wml", "native")
+
+# held while t2wml evaluates a sheet in this process, so another conversion can not change the entity store
+_t2wml_lock = threading.RLock()
+
+# content hash of each property this process already added to the t2wml entity store, keyed by property id
+_registered_properties = {}
+_registered_properties_lock = threading.Lock()
+
+
+def default_debug_dir() -> str:
+    """
+    folder of the debug artifacts and profiles when no debug folder is given
+    """
+    return os.path.join(os.getenv("HOME"), "datamart-annotation-debug-output")
+
+
+def property_content_hashes(properties_df: pd.DataFrame) -> typing.Dict[str, str]:
+    """
+    Returns a hash of the (label, node2) edges of each property (node1), independent of the edges order.
+    """
+    edges = {}
+    for node1, label, node2 in zip(properties_df["node1"].astype(str), properties_df["label"].astype(str),
+                                   properties_df["node2"].astype(str)):
+        edges.setdefault(node1, []).append("{}\t{}".format(label, node2))
+    return {node1: hashlib.md5("\n".join(sorted(each)).encode("utf-8")).hexdigest()
+            for node1, each in edges.items()}
+
+
+def register_properties(properties_df: pd.DataFrame) -> typing.Tuple[int, int]:
+    """
+    Add the properties to the t2wml entity store, skipping those already added by this process with identical
+    content. Returns the number of properties added and the number of properties skipped.
+    """
+    hashes = property_content_hashes(properties_df)
+    with _registered_properties_lock:
+        new_properties = {node1 for node1, digest in hashes.items() if _registered_properties.get(node1) != digest}
+        if new_properties:
+            with tempfile.NamedTemporaryFile(mode='r+', suffix=".tsv") as properties_file:
+                properties_df[properties_df["node1"].astype(str).isin(new_properties)] \
+                    .to_csv(properties_file.name, sep="\t", index=False)
+                add_entities_from_file(properties_file.name)
+            for node1 in new_properties:
+                _registered_properties[node1] = hashes[node1]
+    return len(new_properties), len(hashes) - len(new_properties)
+
+
+def plan_shard_rows(n_rows: int, seconds_per_row: float, workers: int) -> int:
+    """
+    Rows per shard so that a shard takes about T2WML_SHARD_SECONDS, while still giving every worker a shard.
+    """
+    if seconds_per_row > 0:
+        rows = int(T2WML_SHARD_SECONDS / seconds_per_row)
+    else:
+        rows = n_rows
+    return max(1, min(rows, math.ceil(n_rows / workers)))
+
+
+def _init_t2wml_shard_worker(properties_df: pd.DataFrame):
+    # the entity store of a spawned worker is empty, a forked one already has the properties and skips them
+    register_properties(properties_df)
+
+
+def _generate_t2wml_shard(data_filepath: str, sheet_name: str, t2wml_script: dict, wikifier_filepath: str,
+                          top: int, bottom: int) -> str:
+    """
+    Run t2wml on rows `top` to `bottom` (inclusive) of the region, returns the path of the kgtk output file.
+    """
+    shard_script = with_region_rows(t2wml_script, top, bottom)
+    with tempfile.NamedTemporaryFile(mode='w', suffix=".yaml") as yaml_file:
+        yaml.dump(shard_script, yaml_file)
+        yaml_file.flush()
+        kg = KnowledgeGraph.generate_from_files(data_filepath, sheet_name, yaml_file.name, wikifier_filepath)
+    output_file = tempfile.NamedTemporaryFile(mode='w', suffix=".tsv", delete=False)
+    output_file.close()
+    kg.save_kgtk(output_file.name)
+    return output_file.name
+
+
+def merge_kgtk_files(input_paths: typing.List[str], output_path: str) -> None:
+    """
+    Concatenate kgtk files in the given order, keeping a single header. Empty files are skipped.
+    """
+    headers = {}
+    for each in input_paths:
+        with open(each) as f:
+            header = f.readline()
+        if header:
+            headers[each] = header
+    if len(set(headers.values())) > 1:
+        # shards produced different columns, let pandas align them
+        merged = pd.concat([pd.read_csv(each, sep="\t", quoting=csv.QUOTE_NONE, dtype=object) for each in headers])
+        merged.to_csv(output_path, sep="\t", index=False, quoting=csv.QUOTE_NONE)
+        return
+    with open(output_path, "w") as out:
+        for i, each in enumerate(headers):
+            with open(each) as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+
 
 class GenerateKgtk:
     def __init__(self, annotated_spreadsheet: pd.DataFrame, t2wml_script: dict, dataset_qnode: str = None,
                  wikifier_file: str = None, property_file: str = None, add_datamart_constant_properties: bool = False,
-                 debug: bool = False, debug_dir: str = None):
+                 debug: bool = False, debug_dir: str = None, schema: AnnotationSchema = None,
+                 stage_timeouts: dict = None, t2wml_workers: int = None, memory_report: MemoryReport = None,
+                 debug_format: str = "xlsx", prune_data: bool = False, profile: bool = None,
+                 profiler: StageProfiler = None, metrics: PipelineMetrics = None, t2wml_engine: str = "t2wml"):
         """
         Parameters
         ----------
@@ -32,7 +159,34 @@ class GenerateKgtk:
             File containing general wikifier entities, such as countries
         property_file: str
             File contain general property definitions, such as the property file datamart-schema repo
+        schema: AnnotationSchema
+            Parsed annotation of the spreadsheet, built from the spreadsheet if not given
+        stage_timeouts: dict
+            Seconds each kgtk stage ("kgtk implode", "kgtk explode", "kgtk add-id") may run before it is killed
+        t2wml_workers: int
+            If more than 1, the data rows are split into shards evaluated by t2wml in that many processes
+        memory_report: MemoryReport
+            If given, the memory used by each stage is recorded in it
+        debug_format: str
+            Format of the debug artifacts, "xlsx" (default), "csv" or "parquet". They are written in the background,
+            call `wait_for_debug_artifacts` to make sure they are complete
+        prune_data: bool
+            If True, non numeric cells of number variables and the variable cells of duplicated data rows are masked
+            before running t2wml, see `prune_data.prune_sheet`. The counts are kept in `prune_report`
+        profile: bool
+            If True, each stage is profiled into `profiles/<dataset_id>` of the debug folder, see
+            `profiler.StageProfiler`. Defaults to the T2WML_ANNOTATION_PROFILE environment variable
+        profiler: StageProfiler
+            Profiler to use instead, for instance one shared with the caller's own stages
+        metrics: PipelineMetrics
+            If given, the volumes of the sheet, the latency of each stage and the wikifier counters (also kept in
+            `wikifier_stats`) are recorded in it
+        t2wml_engine: str
+            "t2wml" (default) or "native". The native engine generates the statements of a template made by
+            ToT2WML with pandas, custom templates and sheets it can not reproduce exactly are still run with t2wml
         """
+        if t2wml_engine not in T2WML_ENGINES:
+            raise ValueError("Unknown t2wml engine `{}`, should be one of {}".format(t2wml_engine, T2WML_ENGINES))
 
         # Make sure column "A" in spreadsheet is column 0 of dataframe:
         if not annotated_spreadsheet.iloc[0,0] == 'dataset':
@@ -42,6 +196,19 @@ class GenerateKgtk:
         self.annotated_spreadsheet = annotated_spreadsheet
         self.property_file = property_file
         self._debug = debug
+        self.stage_timeouts = stage_timeouts or {}
+        self.t2wml_workers = t2wml_workers
+        self.memory_report = memory_report
+        self.prune_data = prune_data
+        self.t2wml_engine = t2wml_engine
+        self.prune_report = None
+        # t2wml / implode / explode results shared by generate_edges and generate_edges_df
+        self._preparations = None
+        # uniq-ids edge file written by the last generate_edges call
+        self._edges_path = None
+        # intermediate files of this instance, generate_edges / generate_edges_df may be called from several threads
+        self._scratch_dir = None
+        self._lock = threading.RLock()
 
         if __file__.rfind("/") != -1:
             base_pos = __file__[:__file__.rfind("/")]
@@ -53,46 +220,74 @@ class GenerateKgtk:
             property_file = base_pos + "/datamart_schema_properties.tsv"
 
         self.wikifier_file = wikifier_file
-        self.constant_wikikifer_df = pd.read_csv(wikifier_file)
+        self.constant_wikikifer_df = reference_data.load_file(wikifier_file, "country-wikifier.csv")
 
         self.dataset_id = self.annotated_spreadsheet.iloc[0, 1]
 
         # If missing, annotation does not contain dataset metadata. Just use a default id.
         # The 'dataset.tsv' metadata is not used.
-        if not self.dataset_id:
+        if pd.isna(self.dataset_id) or not self.dataset_id:
             self.dataset_id = dataset_qnode[1:]
 
+        if schema is None:
+            schema = AnnotationSchema(annotated_spreadsheet)
+        self.schema = schema
+
+        if profiler is None and profiling_enabled(profile):
+            profiler = StageProfiler(os.path.join(debug_dir or default_debug_dir(), "profiles", self.dataset_id))
+        self.profiler = profiler
+        self.metrics = metrics
+        if metrics is not None:
+            if schema.data_index is not None:
+                metrics.observe("data_rows", max(annotated_spreadsheet.shape[0] - schema.data_index, 0))
+            metrics.observe("variable_columns", len(schema.role_columns(Role.VARIABLE.value)))
+            metrics.observe("qualifier_columns", len(schema.role_columns(Role.QUALIFIER.value)))
+
+        # counters of the country / ethiopia wikifier runs made while generating the template
+        self.wikifier_stats = WikifierStats()
+
         # generate the template files
-        template_df_dict = generate_template_from_df(annotated_spreadsheet, dataset_qnode, self.dataset_id)
+        with self._stage("generate_template_from_df"):
+            template_df_dict = generate_template_from_df(annotated_spreadsheet, dataset_qnode, self.dataset_id,
+                                                         schema=schema, wikifier_stats=self.wikifier_stats)
+        if metrics is not None:
+            for name, count in self.wikifier_stats.counters.items():
+                metrics.inc("wikifier_events_total", count, counter=name)
 
         # update 2020.7.27, enable debug to save the template and template-output files
         if self._debug:
             if debug_dir is None:
-                self.debug_dir = os.path.join(os.getenv("HOME"), "datamart-annotation-debug-output")
+                self.debug_dir = default_debug_dir()
             else:
                 self.debug_dir = debug_dir
             os.makedirs(self.debug_dir, exist_ok=True)
             if not os.access(self.debug_dir, os.W_OK):
                 raise ValueError("No write permission to debug folder `{}`".format(self.debug_dir))
-            save_template_file(template_df_dict, os.path.join(self.debug_dir, "template.xlsx"))
-            with open(os.path.join(self.debug_dir, 't2wml.yaml'), 'w') as out:
-                yaml.dump(self.t2wml_script, out)
+            self.debug_writer = DebugArtifactWriter(self.debug_dir, debug_format)
+            self.debug_writer.write_template(template_df_dict)
+            self.debug_writer.write_yaml('t2wml.yaml', self.t2wml_script)
         else:
             self.debug_dir = debug_dir
+            self.debug_writer = None
 
         # generate template output files
         # update 2020.7.27, enable debug to save the template-output files
-        self.output_df_dict = generate(loaded_file=template_df_dict,
-                                       output_path=self.debug_dir,
-                                       to_disk=False,
-                                       datamart_properties_file=property_file,
-                                       dataset_qnode=dataset_qnode,
-                                       dataset_id=self.dataset_id,
-                                       debug=self._debug,
-                                       )
+        with self._stage("template outputs"):
+            self.output_df_dict = generate(loaded_file=template_df_dict,
+                                           output_path=self.debug_dir,
+                                           to_disk=False,
+                                           datamart_properties_file=property_file,
+                                           dataset_qnode=dataset_qnode,
+                                           dataset_id=self.dataset_id,
+                                           )
+        if self.debug_writer:
+            for name, each_df in self.output_df_dict.items():
+                self.debug_writer.write_df(name, each_df)
 
         # update 2020.7.22: not add dataset edges
         _ = self.output_df_dict.pop("dataset.tsv")
+        if metrics is not None:
+            metrics.observe("wikifier_rows", len(self.output_df_dict["wikifier.csv"]))
 
         # memory all nodes2 from P1813 of variables
         variables_df = self.output_df_dict['kgtk_variables.tsv']
@@ -104,7 +299,7 @@ class GenerateKgtk:
 
         if not os.path.exists(property_file):
             raise ValueError("Datamart schema properties tsv file not exist at {}!".format(property_file))
-        self.kgtk_properties_df = pd.concat([pd.read_csv(property_file, sep='\t', quoting=csv.QUOTE_NONE),
+        self.kgtk_properties_df = pd.concat([reference_data.load_file(property_file, "datamart_schema_properties.tsv"),
                                              self.output_df_dict["kgtk_properties.tsv"]])
 
         # update 2020.7.22: only combine datamart scheme constant properties when required
@@ -114,6 +309,24 @@ class GenerateKgtk:
     def get_variable_ids(self) -> typing.List[str]:
         return self.variables_ids
 
+    def get_metadata_df(self, include_schema_properties: bool = False) -> pd.DataFrame:
+        """
+        Returns the kgtk metadata files of the template output concatenated in one go
+        """
+        metadata_dfs = [each_df for name, each_df in self.output_df_dict.items()
+                        if each_df is not None and name.endswith(".tsv") and
+                        (include_schema_properties or name.strip() != 'datamart_schema_properties.tsv')]
+        if not metadata_dfs:
+            return pd.DataFrame()
+        return pd.concat(metadata_dfs)
+
+    def wait_for_debug_artifacts(self) -> None:
+        """
+        Block until the debug artifacts submitted so far are written, raises ValueError if some of them failed
+        """
+        if self.debug_writer:
+            self.debug_writer.wait()
+
     def generate_edges(self, directory: str) -> str:
         """
         Returns file containing exploded KGTK edges.
@@ -124,158 +337,320 @@ class GenerateKgtk:
             Directory folder to store result edge file
         """
         exploded_file, metadata_file = self._make_preparations()
+
         # add id
-        _ = exploded_file.seek(0)
         final_output_path = "{}/{}-datamart-kgtk-exploded-uniq-ids.tsv".format(directory, self.dataset_id)
-        shell_code = """
-        kgtk add_id --overwrite-id False --id-style node1-label-node2-num {} > {}
-        """.format(exploded_file.name, final_output_path)
-        return_res = execute_shell_code(shell_code)
-        if return_res != "":
-            print(return_res)
-            raise ValueError("Running kgtk add-id failed! Please check!")
+        self._run_kgtk("kgtk add-id", self._add_id_shell_code(exploded_file), output_path=final_output_path)
+        self._edges_path = final_output_path
 
         # create metadata file
         shell_code = """
-        kgtk explode {} --allow-lax-qnodes True --overwrite True \
-        > {}/{}-datamart-kgtk-exploded_metadata.tsv
-        """.format(metadata_file.name, directory, self.dataset_id)
-        return_res = execute_shell_code(shell_code)
-        if return_res != "":
-            print(return_res)
-            raise ValueError("Running kgtk add-id failed! Please check!")
+        kgtk explode {} --allow-lax-qnodes True --overwrite True
+        """.format(metadata_file)
+        self._run_kgtk("kgtk explode", shell_code,
+                       output_path="{}/{}-datamart-kgtk-exploded_metadata.tsv".format(directory, self.dataset_id))
 
         return final_output_path
 
     def generate_edges_df(self) -> pd.DataFrame:
         """
-        Returns dataframe of the output from kgtk
+        Returns dataframe of the output from kgtk, reuses the edge file of a previous generate_edges call
         """
-        exploded_file, metadata_file = self._make_preparations()
+        if self._edges_path is not None and os.path.exists(self._edges_path):
+            return self._reuse_edges()
 
-        # add id
-        _ = exploded_file.seek(0)
-        final_output_file = tempfile.NamedTemporaryFile(mode='r+', suffix=".tsv")
-        final_output_path = final_output_file.name
-        shell_code = """
-        kgtk add_id --overwrite-id False --id-style node1-label-node2-num -i {} > {}
-        """.format(exploded_file.name, final_output_path)
+        debug_output_path = self._debug_edges_path()
+        exploded_file, _ = self._make_preparations()
+
+        # add id, written straight to the debug folder if required, otherwise parsed while kgtk writes it
+        shell_code = self._add_id_shell_code(exploded_file)
         s = time()
-        return_res = execute_shell_code(shell_code)
+        if debug_output_path:
+            self._run_kgtk("kgtk add-id", shell_code, output_path=debug_output_path)
+            with self._stage("read exploded edges"):
+                final_output_df = self._read_edges(debug_output_path)
+        else:
+            final_output_df = self._run_kgtk("kgtk add-id", shell_code, output_parser=self._read_edges).parsed
+            if self.debug_writer:
+                self.debug_writer.write_df('kgtk-edges.tsv', final_output_df)
         print(f'time take to run kgtk add id: {time() - s} seconds')
-        if return_res != "":
-            print(return_res)
-            raise ValueError("Running kgtk add-id failed! Please check!")
-        _ = final_output_file.seek(0)
 
-        final_output_df = pd.read_csv(final_output_file, sep="\t", quoting=csv.QUOTE_NONE)
+        return final_output_df
 
-        if self._debug:
-            shutil.copy(final_output_file.name, os.path.join(self.debug_dir, 'kgtk-edges.tsv'))
+    async def generate_edges_df_async(self) -> pd.DataFrame:
+        """
+        asyncio version of generate_edges_df. t2wml and the other in process stages run in the default executor,
+        the kgtk commands are awaited as child processes. Cancelling the awaiting task kills them.
+
+        Not meant to be awaited concurrently on the same instance.
+        """
+        if self._edges_path is not None and os.path.exists(self._edges_path):
+            return await run_blocking(self._reuse_edges)
+
+        debug_output_path = self._debug_edges_path()
+        exploded_file, _ = await self._make_preparations_async()
+
+        shell_code = self._add_id_shell_code(exploded_file)
+        s = time()
+        if debug_output_path:
+            await self._run_kgtk_async("kgtk add-id", shell_code, output_path=debug_output_path)
+            final_output_df = await run_blocking(self._read_edges, debug_output_path)
+        else:
+            final_output_df = (await self._run_kgtk_async("kgtk add-id", shell_code,
+                                                          output_parser=self._read_edges)).parsed
+            if self.debug_writer:
+                self.debug_writer.write_df('kgtk-edges.tsv', final_output_df)
+        print(f'time take to run kgtk add id: {time() - s} seconds')
+
+        return final_output_df
 
+    def generate_partitioned_edges(self, directory: str, workers: int = None) -> dict:
+        """
+        Writes the edges split by variable to `directory`: one file per variable of `variables_ids` with its
+        statements and their qualifiers, one metadata file with every other edge and a manifest with the rows and
+        bytes of each file, see `edge_partitions.write_partitions`. Returns the manifest.
+
+        Parameters
+        ----------
+        directory: str
+            Directory folder to store the partitions and the manifest
+        workers: int
+            Number of partitions written at the same time, defaults to the ThreadPoolExecutor default
+        """
+        edges_df = self.generate_edges_df()
+        with self._stage("write partitions"):
+            return write_partitions(edges_df, self.output_df_dict['kgtk_variables.tsv'], self.variables_ids,
+                                    self.dataset_id, directory, workers=workers)
+
+    def generate_delta_edges(self, previous_edges: str, directory: str,
+                             memory_budget: int = DELTA_MEMORY_BUDGET) -> dict:
+        """
+        Writes only the edges that changed since a previous export of the dataset to `directory`, by edge id:
+        `<dataset_id>-datamart-kgtk-added.tsv` and `<dataset_id>-datamart-kgtk-removed.tsv`, see
+        `edge_delta.diff_edges`. Returns the counts of the diff.
+
+        Parameters
+        ----------
+        previous_edges: str
+            Edge file of the previous export, a kgtk tsv file or a parquet file
+        directory: str
+            Directory folder to store the added and removed edge files
+        memory_budget: int
+            Bytes the comparison may hold in memory, larger exports are compared bucket by bucket
+        """
+        if self._edges_path is not None and os.path.exists(self._edges_path):
+            current_edges = self._edges_path
+        else:
+            exploded_file, _ = self._make_preparations()
+            current_edges = self._scratch_path("exploded-uniq-ids.tsv")
+            self._run_kgtk("kgtk add-id", self._add_id_shell_code(exploded_file), output_path=current_edges)
+
+        with self._stage("edge delta"):
+            counts = diff_edges(previous_edges, current_edges,
+                                "{}/{}-datamart-kgtk-added.tsv".format(directory, self.dataset_id),
+                                "{}/{}-datamart-kgtk-removed.tsv".format(directory, self.dataset_id),
+                                memory_budget=memory_budget)
+        print('edge delta: {added} added, {removed} removed ({changed} changed) out of {current} edges, '
+              '{buckets} buckets'.format(**counts))
+        return counts
+
+    def _reuse_edges(self) -> pd.DataFrame:
+        with self._stage("read exploded edges"):
+            final_output_df = self._read_edges(self._edges_path)
+        if self.debug_writer:
+            if self.debug_writer.debug_format == "parquet":
+                self.debug_writer.write_df('kgtk-edges.tsv', final_output_df)
+            else:
+                self.debug_writer.copy_file(self._edges_path, 'kgtk-edges.tsv')
         return final_output_df
 
-    def _make_preparations(self):
+    def _debug_edges_path(self) -> typing.Optional[str]:
+        # in xlsx / csv debug mode kgtk writes the debug edge file itself, which costs the same as a temp file
+        if self.debug_writer and self.debug_writer.debug_format != "parquet":
+            return os.path.join(self.debug_dir, 'kgtk-edges.tsv')
+        return None
+
+    def generate_edges_and_df(self, directory: str) -> typing.Tuple[str, pd.DataFrame]:
         """
-        do the preparation steps for generate_edges and generate_edges_df
-        :return:
+        Writes the edge and metadata files to `directory` and returns the edge file path together with its
+        dataframe, running t2wml and kgtk only once.
+
+        Parameters
+        ----------
+        directory: str
+            Directory folder to store result edge file
         """
-        # concat the input wikifier file with generated wikifier file from output_df_dict
-        wikifier_df = pd.concat([pd.read_csv(self.wikifier_file), self.output_df_dict["wikifier.csv"]])
-        temp_wikifier_file = tempfile.NamedTemporaryFile(mode='r+', suffix=".csv")
-        wikifier_filepath = temp_wikifier_file.name
-        wikifier_df.to_csv(wikifier_filepath, index=False)
-        if self._debug:
-            wikifier_df.to_csv(os.path.join(self.debug_dir, "consolidated-wikifier.csv"), index=False)
-        _ = temp_wikifier_file.seek(0)
-
-        # use t2wml api to add properties file to t2wml database
-        all_properties_df = self.kgtk_properties_df
-        all_properties_file = tempfile.NamedTemporaryFile(mode='r+', suffix=".tsv")
-        all_properties_df.to_csv(all_properties_file.name, sep="\t", index=False)
-        _ = all_properties_file.seek(0)
-        add_entities_from_file(all_properties_file.name)
-
-        # generate temp yaml file
-        temp_yaml_file = tempfile.NamedTemporaryFile(mode='r+', suffix=".yaml")
-        yaml_filepath = temp_yaml_file.name
-        yaml.dump(self.t2wml_script, temp_yaml_file)
-        temp_yaml_file.seek(0)
-
-        # generate temp input dataset file
-        temp_data_file = tempfile.NamedTemporaryFile(mode='r+', suffix=".csv")
-        # data_filepath = "{}.csv".format(self.dataset_id)
-        data_filepath = "{}.csv".format(f'{self.dataset_id}-{shortuuid.uuid()}')
-
-        if os.path.islink(data_filepath) or os.path.exists(data_filepath):
-            os.remove(data_filepath)
-        os.symlink(temp_data_file.name, data_filepath)
+        final_output_path = self.generate_edges(directory)
+        return final_output_path, self.generate_edges_df()
 
-        self.annotated_spreadsheet.to_csv(data_filepath, header=None, index=False)
-        _ = temp_data_file.seek(0)
+    @staticmethod
+    def _read_edges(file) -> pd.DataFrame:
+        return pd.read_csv(file, sep="\t", quoting=csv.QUOTE_NONE)
 
-        # generate knowledge graph
-        sheet_name = data_filepath
-        output_kgtk_main_content = tempfile.NamedTemporaryFile(mode='r+', suffix=".tsv")
-        t2wml_output_filepath = output_kgtk_main_content.name
+    def _run_kgtk(self, stage: str, shell_code: str, output_path: str = None,
+                  output_parser: typing.Callable = None):
+        """
+        run a kgtk command writing its stdout to `output_path` (or streaming it to `output_parser`), within the
+        timeout configured for the stage
+        """
+        with self._stage(stage):
+            return run_shell_code(shell_code, output_file=output_path, output_parser=output_parser,
+                                  timeout=self.stage_timeouts.get(stage), stage=stage)
+
+    async def _run_kgtk_async(self, stage: str, shell_code: str, output_path: str = None,
+                              output_parser: typing.Callable = None):
+        """
+        asyncio version of _run_kgtk
+        """
+        # not profiled, the event loop runs other tasks while the child is awaited
+        with memory_stage(self.memory_report, stage), metrics_stage(self.metrics, stage):
+            return await async_run_shell_code(shell_code, output_file=output_path, output_parser=output_parser,
+                                              timeout=self.stage_timeouts.get(stage), stage=stage)
+
+    @contextlib.contextmanager
+    def _stage(self, name: str):
+        # measured in the memory report, profiled and timed in the metrics when they are enabled
+        with memory_stage(self.memory_report, name), profile_stage(self.profiler, name), \
+                metrics_stage(self.metrics, name):
+            yield
+
+    def _observe_exploded_edges(self, exploded_file: str) -> None:
+        if self.metrics is not None:
+            with open(exploded_file, "rb") as f:
+                lines = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+            self.metrics.observe("exploded_edges", max(lines - 1, 0))
+
+    @staticmethod
+    def _add_id_shell_code(exploded_file: str) -> str:
+        return """
+        kgtk add_id --overwrite-id False --id-style node1-label-node2-num -i {}
+        """.format(exploded_file)
+
+    @staticmethod
+    def _implode_shell_code(t2wml_output_filepath: str) -> str:
+        return """
+            kgtk implode -i "{}" --allow-lax-qnodes --remove-prefixed-columns True --without si_units language_suffix
+            """.format(t2wml_output_filepath)
+
+    @staticmethod
+    def _explode_shell_code(imploded_file: str, metadata_file: str) -> str:
+        return """
+        kgtk cat -i {} {} \
+        / explode --allow-lax-qnodes True --overwrite True
+        """.format(imploded_file, metadata_file)
+
+    def _run_t2wml(self, t2wml_script: dict, data_filepath: str, sheet_name: str, yaml_filepath: str,
+                   wikifier_filepath: str, output_path: str) -> None:
+        """
+        run t2wml and save its kgtk output to `output_path`, sharded by rows when t2wml_workers is more than 1
+        """
+        if self.t2wml_engine == "native":
+            with self._stage("native t2wml"):
+                if run_native_t2wml(t2wml_script, data_filepath, wikifier_filepath, self.kgtk_properties_df,
+                                    output_path):
+                    return
+
+        rows = region_rows(t2wml_script)
+        if not self.t2wml_workers or self.t2wml_workers < 2 or rows is None:
+            kg = KnowledgeGraph.generate_from_files(data_filepath, sheet_name, yaml_filepath, wikifier_filepath)
+            kg.save_kgtk(output_path)
+            return
+
+        top, bottom = rows
+        shard_paths = []
         try:
+            # measure the per row throughput on the first rows, then size the shards of the remaining rows
             s = time()
-            kg = KnowledgeGraph.generate_from_files(data_filepath, sheet_name, yaml_filepath, wikifier_filepath)
-            kg.save_kgtk(t2wml_output_filepath)
-            print(f'time take to get t2wml output: {time() - s} seconds')
-        except:
-            traceback.print_exc()
-            raise ValueError("Generating kgtk knowledge graph file failed!")
+            calibration_bottom = min(bottom, top + T2WML_CALIBRATION_ROWS - 1)
+            shard_paths.append(_generate_t2wml_shard(data_filepath, sheet_name, t2wml_script,
+                                                     wikifier_filepath, top, calibration_bottom))
+            seconds_per_row = (time() - s) / (calibration_bottom - top + 1)
+
+            remaining = bottom - calibration_bottom
+            if remaining > 0:
+                shard_rows = plan_shard_rows(remaining, seconds_per_row, self.t2wml_workers)
+                print(f't2wml: {seconds_per_row * 1000:.3f} ms per row, {remaining} rows left in shards of '
+                      f'{shard_rows} rows on {self.t2wml_workers} workers')
+                with ProcessPoolExecutor(max_workers=self.t2wml_workers, initializer=_init_t2wml_shard_worker,
+                                         initargs=(self.kgtk_properties_df,)) as executor:
+                    futures = [executor.submit(_generate_t2wml_shard, data_filepath, sheet_name, t2wml_script,
+                                               wikifier_filepath, start, min(start + shard_rows - 1, bottom))
+                               for start in range(calibration_bottom + 1, bottom + 1, shard_rows)]
+                    # collected in submission order so the statements keep the original row order, every shard
+                    # is awaited so none of their files is left behind on failure
+                    failure = None
+                    for future in futures:
+                        try:
+                            shard_paths.append(future.result())
+                        except Exception as e:
+                            failure = failure or e
+                    if failure is not None:
+                        raise failure
+            merge_kgtk_files(shard_paths, output_path)
         finally:
-            os.remove(data_filepath)
+            for each in shard_paths:
+                os.remove(each)
 
-        t2wml_kgtk_df = pd.read_csv(t2wml_output_filepath, sep="\t", quoting=csv.QUOTE_NONE)
-        if len(t2wml_kgtk_df) == 0:
-            raise ValueError("An empty kgtk file was generated from t2wml! Please check!")
+    def _make_preparations(self) -> typing.Tuple[str, str]:
+        """
+        do the preparation steps for generate_edges and generate_edges_df, only once per instance
+        :return: paths of the exploded edge file and of the metadata file
+        """
+        with self._lock:
+            if self._preparations is None:
+                self._preparations = self._prepare()
+            return self._preparations
 
-        _ = output_kgtk_main_content.seek(0)
+    async def _make_preparations_async(self) -> typing.Tuple[str, str]:
+        """
+        asyncio version of _make_preparations
+        """
+        if self._preparations is None:
+            preparations = await self._prepare_async()
+            with self._lock:
+                self._preparations = preparations
+        return self._preparations
+
+    def _scratch_path(self, file_name: str) -> str:
+        # intermediate files live in a folder owned by this instance, removed by `close`
+        if self._scratch_dir is None:
+            self._scratch_dir = tempfile.TemporaryDirectory(prefix="generate-kgtk-")
+        return os.path.join(self._scratch_dir.name, file_name)
+
+    def close(self, wait: bool = True) -> None:
+        """
+        Remove the intermediate files of this instance and stop its debug writer, the edge files written by
+        `generate_edges` are kept. With wait=False this returns right away: the scratch folder is handed over to the
+        debug writer, which removes it once the pending artifacts (some are copied from it) are written
+        """
+        with self._lock:
+            scratch_dir, self._scratch_dir = self._scratch_dir, None
+            cleanup = scratch_dir.cleanup if scratch_dir is not None else None
+            if self.debug_writer is not None:
+                self.debug_writer.close(wait=wait, then=cleanup)
+            elif cleanup is not None:
+                cleanup()
+            self._preparations = None
+
+    def _prepare(self) -> typing.Tuple[str, str]:
+        t2wml_output_filepath = self._prepare_t2wml()
 
         # generate imploded file
-        kgtk_imploded_file = tempfile.NamedTemporaryFile(mode='r+', suffix=".tsv")
-        kgtk_imploded_file_name = kgtk_imploded_file.name
-        shell_code = """
-            kgtk implode -i "{}" --allow-lax-qnodes --remove-prefixed-columns True --without si_units language_suffix > "{}"
-            """.format(t2wml_output_filepath, kgtk_imploded_file_name)
+        kgtk_imploded_file_name = self._scratch_path("imploded.tsv")
         s = time()
-        return_res = execute_shell_code(shell_code)
+        self._run_kgtk("kgtk implode", self._implode_shell_code(t2wml_output_filepath),
+                       output_path=kgtk_imploded_file_name)
         print(f'time take to run kgtk implode: {time() - s} seconds')
-        if return_res != "":
-            print(return_res)
-            raise ValueError("Running kgtk implode failed! Please check!")
-        _ = kgtk_imploded_file.seek(0)
-
-        # concat metadata file
-        metadata_df = pd.DataFrame()
-        for name, each_df in self.output_df_dict.items():
-            if each_df is not None and name.endswith(".tsv"):
-                if name.strip() != 'datamart_schema_properties.tsv':
-                    metadata_df = pd.concat([metadata_df, each_df])
-        metadata_file = tempfile.NamedTemporaryFile(mode='r+', suffix=".tsv")
-        exploded_file = tempfile.NamedTemporaryFile(mode='r+', suffix=".tsv")
-        metadata_file_name = metadata_file.name
-        exploded_file_name = exploded_file.name
-        metadata_df.to_csv(metadata_file_name, sep="\t", index=False, quoting=csv.QUOTE_NONE)
-        _ = metadata_file.seek(0)
+
+        metadata_file_name = self._write_metadata()
 
         # combine and explode the results
-        shell_code = """
-        kgtk cat -i {} {} \
-        / explode --allow-lax-qnodes True --overwrite True \
-        > {}
-        """.format(kgtk_imploded_file_name, metadata_file_name, exploded_file_name)
+        exploded_file_name = self._scratch_path("exploded.tsv")
         s = time()
-        return_res = execute_shell_code(shell_code)
+        self._run_kgtk("kgtk explode", self._explode_shell_code(kgtk_imploded_file_name, metadata_file_name),
+                       output_path=exploded_file_name)
         print(f'time take to run kgtk cat and explode: {time() - s} seconds')
-        if return_res != "":
-            print(return_res)
-            raise ValueError("Running kgtk explode failed! Please check!")
-        # _ = metadata_file.seek(0)
-        # _ = exploded_file.seek(0)
+        self._observe_exploded_edges(exploded_file_name)
 
         # validate the exploded file
         # shell_code = """
@@ -288,4 +663,102 @@ class GenerateKgtk:
         #     print(res)
         #     raise ValueError("The output kgtk file is invalid!")
 
-        return exploded_file, metadata_file
+        return exploded_file_name, metadata_file_name
+
+    async def _prepare_async(self) -> typing.Tuple[str, str]:
+        """
+        asyncio version of _prepare, the same steps with the kgtk commands awaited
+        """
+        t2wml_output_filepath = await run_blocking(self._prepare_t2wml)
+
+        kgtk_imploded_file_name = self._scratch_path("imploded.tsv")
+        s = time()
+        await self._run_kgtk_async("kgtk implode", self._implode_shell_code(t2wml_output_filepath),
+                                   output_path=kgtk_imploded_file_name)
+        print(f'time take to run kgtk implode: {time() - s} seconds')
+
+        metadata_file_name = await run_blocking(self._write_metadata)
+
+        exploded_file_name = self._scratch_path("exploded.tsv")
+        s = time()
+        await self._run_kgtk_async("kgtk explode", self._explode_shell_code(kgtk_imploded_file_name,
+                                                                            metadata_file_name),
+                                   output_path=exploded_file_name)
+        print(f'time take to run kgtk cat and explode: {time() - s} seconds')
+        self._observe_exploded_edges(exploded_file_name)
+
+        return exploded_file_name, metadata_file_name
+
+    def _prepare_t2wml(self) -> str:
+        """
+        run t2wml on the sheet, returns the path of its kgtk output
+        """
+        # concat the input wikifier file with generated wikifier file from output_df_dict
+        with self._stage("wikifier concat"):
+            wikifier_df = pd.concat([self.constant_wikikifer_df, self.output_df_dict["wikifier.csv"]])
+            wikifier_filepath = self._scratch_path("wikifier.csv")
+            wikifier_df.to_csv(wikifier_filepath, index=False)
+            if self.debug_writer:
+                self.debug_writer.write_df("consolidated-wikifier.csv", wikifier_df)
+
+        # mask the cells t2wml would evaluate for nothing, row and column numbers are kept
+        sheet, t2wml_script = self.annotated_spreadsheet, self.t2wml_script
+        if self.prune_data:
+            with self._stage("prune data"):
+                sheet, t2wml_script, self.prune_report = prune_sheet(sheet, t2wml_script, self.schema)
+            print(self.prune_report)
+
+        # generate yaml file
+        yaml_filepath = self._scratch_path("t2wml.yaml")
+        with open(yaml_filepath, "w") as f:
+            yaml.dump(t2wml_script, f)
+
+        # generate input dataset file, t2wml uses the csv file name as the sheet name
+        data_filepath = self._scratch_path("{}.csv".format(self.dataset_id))
+        with self._stage("sheet to_csv"):
+            sheet.to_csv(data_filepath, header=None, index=False)
+        del sheet
+
+        # generate knowledge graph
+        sheet_name = os.path.basename(data_filepath)
+        t2wml_output_filepath = self._scratch_path("t2wml-output.tsv")
+        try:
+            # the t2wml entity store is global to the process, keep it unchanged while this sheet is evaluated
+            with _t2wml_lock:
+                # use t2wml api to add properties file to t2wml database
+                # only properties not registered yet (or whose definition changed) are added
+                s = time()
+                with self._stage("register properties"):
+                    added, skipped = register_properties(self.kgtk_properties_df)
+                print(f'time take to register properties: {time() - s} seconds '
+                      f'({added} added, {skipped} already registered)')
+
+                s = time()
+                with self._stage("t2wml"):
+                    self._run_t2wml(t2wml_script, data_filepath, sheet_name, yaml_filepath, wikifier_filepath,
+                                    t2wml_output_filepath)
+                print(f'time take to get t2wml output: {time() - s} seconds')
+        except:
+            traceback.print_exc()
+            raise ValueError("Generating kgtk knowledge graph file failed!")
+        finally:
+            os.remove(data_filepath)
+
+        with self._stage("read t2wml output"):
+            t2wml_kgtk_df = pd.read_csv(t2wml_output_filepath, sep="\t", quoting=csv.QUOTE_NONE)
+        if len(t2wml_kgtk_df) == 0:
+            raise ValueError("An empty kgtk file was generated from t2wml! Please check!")
+        if self.metrics is not None:
+            self.metrics.observe("t2wml_statements", len(t2wml_kgtk_df))
+
+        return t2wml_output_filepath
+
+    def _write_metadata(self) -> str:
+        """
+        concat the metadata files, returns the path of the result
+        """
+        with self._stage("metadata concat"):
+            metadata_df = self.get_metadata_df()
+            metadata_file_name = self._scratch_path("metadata.tsv")
+            metadata_df.to_csv(metadata_file_name, sep="\t", index=False, quoting=csv.QUOTE_NONE)
+        return metadata_file_name
@@ -1,11 +1,15 @@
+import copy
 import string
+import typing
 import numpy as np
+from datetime import datetime
 import pandas as pd
 from yaml import dump
 from enum import Enum
 from pandas.api.types import is_numeric_dtype
 from annotation.utility import Category
 from annotation.utility import Utility
+from annotation.schema import AnnotationSchema
 
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
@@ -95,40 +99,123 @@ MONTH_ABBREVIATED = set([
 ])
 
 
-def guess_year_format(values: pd.Series):
+# number of values looked at when guessing the format of a time column, None to look at the whole column
+FORMAT_SAMPLE_SIZE = 10000
+
+# candidate formats for columns with type "date", in order of preference when several formats fit equally well
+DATE_FORMATS = [
+    '%Y-%m-%d',
+    '%Y/%m/%d',
+    '%m/%d/%Y',
+    '%d/%m/%Y',
+    '%d-%m-%Y',
+    '%m-%d-%Y',
+    '%d.%m.%Y',
+    '%Y%m%d',
+    '%d %B %Y',
+    '%d %b %Y',
+    '%B %d, %Y',
+    '%b %d, %Y',
+    '%Y-%m',
+    '%Y',
+]
+
+
+def sample_values(values: pd.Series, sample_size: typing.Optional[int] = FORMAT_SAMPLE_SIZE) -> pd.Series:
+    """
+    Non missing values of a column, strided evenly down to `sample_size` values so sorted columns stay covered.
+    """
     values = values[values.notna()]
-    if is_numeric_dtype(values):
-        two_digit_count = values.apply(lambda x: x < 100).sum()
-    else:
-        two_digit_count = np.asarray([len(str(x)) <= 2 for x in values]).sum()
-    if two_digit_count > len(values) - two_digit_count:
-        return '%y'
-    else:
-        return '%Y'
+    if sample_size is not None and len(values) > sample_size:
+        values = values.iloc[np.linspace(0, len(values) - 1, sample_size).astype(int)]
+    return values
 
 
-def guess_month_format(values: pd.Series):
-    values = values[values.notna()]
-    # numerical month
-    if is_numeric_dtype(values):
-        return '%m'
-    numeric_count = 0
-    for x in values:
+def _strptime_mask(strings: pd.Series, date_format: str) -> pd.Series:
+    # values parsed the way t2wml applies a pinned format, pandas also takes any ISO string for an ISO-like format
+    def parses(text: str) -> bool:
         try:
-            if int(x) > -1:
-                numeric_count += 1
-        except:
-            pass
-    if numeric_count > 0.5 * len(values):
-        return '%m'
-
-    # string month
-    full_name_count = pd.Series(values).apply(lambda x: x.lower() in MONTH_FULL_NAME).sum()
-    abbreviated_count = pd.Series(values).apply(lambda x: x.lower() in MONTH_ABBREVIATED).sum()
-    if full_name_count > abbreviated_count:
-        return '%B'
-    else:
-        return '%b'
+            datetime.strptime(text, date_format)
+            return True
+        except ValueError:
+            return False
+
+    return strings.map(parses).astype(bool)
+
+
+def _numeric_mask(values: pd.Series) -> pd.Series:
+    # values that read as a non negative number, e.g. 3, "3" or " 03"
+    return pd.to_numeric(values, errors='coerce') > -1
+
+
+def infer_time_format(values: pd.Series, col_type: Type, sample_size: typing.Optional[int] = FORMAT_SAMPLE_SIZE) \
+        -> typing.Tuple[typing.Union[str, list, None], float]:
+    """
+    Guess the format of a year, month, day or date column from a sample of its values.
+
+    Returns the format together with a confidence: the fraction of the sampled values that agree with it.
+    Date columns return the list of matching formats from DATE_FORMATS, or None if no sampled value parses.
+    """
+    values = sample_values(values, sample_size)
+    total = len(values)
+
+    if col_type == Type.YEAR:
+        if is_numeric_dtype(values):
+            two_digit = values < 100
+        else:
+            two_digit = values.astype(str).str.len() <= 2
+        two_digit_count = int(two_digit.sum())
+        if two_digit_count > total - two_digit_count:
+            return '%y', two_digit_count / total
+        return '%Y', (total - two_digit_count) / total if total else 0.0
+
+    if col_type == Type.MONTH:
+        # numerical month
+        if is_numeric_dtype(values):
+            return '%m', 1.0
+        numeric_count = int(_numeric_mask(values).sum())
+        if numeric_count > 0.5 * total:
+            return '%m', numeric_count / total
+
+        # string month
+        lowered = values.astype(str).str.lower()
+        full_name_count = int(lowered.isin(MONTH_FULL_NAME).sum())
+        abbreviated_count = int(lowered.isin(MONTH_ABBREVIATED).sum())
+        if full_name_count > abbreviated_count:
+            return '%B', full_name_count / total
+        return '%b', abbreviated_count / total if total else 0.0
+
+    if col_type == Type.DAY:
+        return '%d', float(_numeric_mask(values).sum()) / total if total else 0.0
+
+    if col_type == Type.DATE:
+        if total == 0:
+            return None, 0.0
+        # values are not stripped, t2wml hands them to strptime as they are. Each distinct value is parsed once
+        counts = values.astype(str).value_counts(sort=False)
+        strings = pd.Series(counts.index, index=counts.index)
+        parsed = pd.Series(False, index=strings.index)
+        hits = []
+        for each_format in DATE_FORMATS:
+            matched = _strptime_mask(strings, each_format)
+            if matched.any():
+                hits.append((int(counts[matched].sum()), each_format))
+                parsed |= matched
+        if not hits:
+            return None, 0.0
+        # stable sort keeps the DATE_FORMATS order between formats with the same number of hits
+        formats = [each_format for _, each_format in sorted(hits, key=lambda x: -x[0])]
+        return formats, float(counts[parsed].sum()) / total
+
+    raise ValueError("Can not infer the format of a {} column".format(col_type.value))
+
+
+def guess_year_format(values: pd.Series, sample_size: typing.Optional[int] = FORMAT_SAMPLE_SIZE):
+    return infer_time_format(values, Type.YEAR, sample_size)[0]
+
+
+def guess_month_format(values: pd.Series, sample_size: typing.Optional[int] = FORMAT_SAMPLE_SIZE):
+    return infer_time_format(values, Type.MONTH, sample_size)[0]
 
 
 def to_letter_column(number):
@@ -175,39 +262,79 @@ def get_indices(series: pd.Series, value, *, within: pd.Int64Index = None, start
     return indices
 
 
+def region_rows(t2wml_script: dict) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    Returns the (top, bottom) rows of the statement regions if they all share the same numeric row bounds, which
+    is what ToT2WML generates, otherwise None.
+    """
+    regions = t2wml_script.get('statementMapping', {}).get('region')
+    if not isinstance(regions, list) or len(regions) == 0 or not all(isinstance(each, dict) for each in regions):
+        return None
+    bounds = {(each.get('top'), each.get('bottom')) for each in regions}
+    if len(bounds) != 1:
+        return None
+    top, bottom = bounds.pop()
+    if not isinstance(top, int) or not isinstance(bottom, int) or top > bottom:
+        return None
+    return top, bottom
+
+
+def with_region_rows(t2wml_script: dict, top: int, bottom: int) -> dict:
+    """
+    Returns a copy of the script with the rows of every statement region set to `top` .. `bottom`.
+    """
+    t2wml_script = copy.deepcopy(t2wml_script)
+    for each in t2wml_script['statementMapping']['region']:
+        each.update(top=top, bottom=bottom)
+    return t2wml_script
+
+
 class ToT2WML:
-    def __init__(self, annotated_spreadsheet: pd.DataFrame, dataset_qnode: str):
+    def __init__(self, annotated_spreadsheet: pd.DataFrame, dataset_qnode: str, schema: AnnotationSchema = None,
+                 format_sample_size: typing.Optional[int] = FORMAT_SAMPLE_SIZE, exact_regions: bool = True,
+                 format_confidence_threshold: float = 1.0):
         self.sheet = annotated_spreadsheet
         self.dataset_qnode = dataset_qnode
+        # skip the columns between the first and the last variable that are not variables
+        self.exact_regions = exact_regions
+        # time formats are guessed from a sample of each column, confidence is recorded per column letter
+        self.format_sample_size = format_sample_size
+        self.format_confidence = {}
+        # date formats are pinned when at least this fraction of the sample parses with them
+        self.format_confidence_threshold = format_confidence_threshold
+        # parse the annotation rows once, the schema can be shared with validation and template generation
+        if schema is None:
+            schema = AnnotationSchema(annotated_spreadsheet)
+        self.schema = schema
+        self.letters = schema.letters
 
         # category rows
         # self.dataset_index = get_index(self.sheet.iloc[:, 0], Category.DATASET.value)  Not needed
-        self.role_index = Utility.get_index(self.sheet.iloc[:, 0], Category.ROLE.value)
-        self.type_index = Utility.get_index(self.sheet.iloc[:, 0], Category.TYPE.value)
-        self.unit_index = Utility.get_index(self.sheet.iloc[:, 0], Category.UNIT.value)
-        self.header_index = Utility.get_index(self.sheet.iloc[:, 0], Category.HEADER.value)
-        self.data_index = Utility.get_index(self.sheet.iloc[:, 0], Category.DATA.value)
+        self.role_index = schema.index(Category.ROLE)
+        self.type_index = schema.index(Category.TYPE)
+        self.unit_index = schema.index(Category.UNIT)
+        self.header_index = schema.index(Category.HEADER)
+        self.data_index = schema.index(Category.DATA)
 
         # role
-        self.time_indcies = get_indices(self.sheet.iloc[self.role_index, :], Role.TIME.value)
-        self.location_indices = get_indices(self.sheet.iloc[self.role_index, :], Role.LOCATION.value)
-        self.variable_indices = get_indices(self.sheet.iloc[self.role_index, :], Role.VARIABLE.value)
-        self.qualifier_indices = get_indices(self.sheet.iloc[self.role_index, :], Role.QUALIFIER.value)
-        self.units_indices = get_indices(self.sheet.iloc[self.role_index, :], Role.UNIT.value, startswith=True)
-        self.variable_columns = self.sheet.iloc[1, :] == Role.VARIABLE.value
+        self.time_indcies = schema.role_columns(Role.TIME.value)
+        self.location_indices = schema.role_columns(Role.LOCATION.value)
+        self.variable_indices = schema.role_columns(Role.VARIABLE.value)
+        self.qualifier_indices = schema.role_columns(Role.QUALIFIER.value)
+        self.units_indices = schema.role_columns(Role.UNIT.value, startswith=True)
 
         self.failures = []
 
         ## main subject role
         try:
-            self.main_subject_index = Utility.get_index(self.sheet.iloc[self.role_index, :], Role.MAIN_SUBJECT.value)
+            self.main_subject_index = schema.role_columns(Role.MAIN_SUBJECT.value)[0]
         except:
             # use a location column for main subject
             self.main_subject_index = 0
-            if self.location_indices.shape[0]:
+            if len(self.location_indices):
                 for col_type in [Type.ADMIN3, Type.ADMIN2, Type.ADMIN1, Type.COUNTRY]:
-                    admin_indices = get_indices(self.sheet.iloc[self.type_index, :], col_type.value)
-                    if admin_indices.shape[0]:
+                    admin_indices = schema.type_columns(col_type.value)
+                    if len(admin_indices):
                         self.main_subject_index = admin_indices[0]
                         break
             if self.main_subject_index == 0:
@@ -217,11 +344,11 @@ class ToT2WML:
         try:
             top = self.data_index
             bottom = self.sheet.shape[0]
-            left = Utility.get_index(self.sheet.iloc[1, :], Role.VARIABLE.value)
-            right = Utility.get_index(self.sheet.iloc[1, :], Role.VARIABLE.value, pos=-1)
+            left = self.variable_indices[0]
+            right = self.variable_indices[-1]
             region = {
-                'left': to_letter_column(left),
-                'right': to_letter_column(right),
+                'left': self.letters[left],
+                'right': self.letters[right],
                 'top': top + 1,
                 'bottom': bottom
             }
@@ -235,6 +362,39 @@ class ToT2WML:
             }
         return region
 
+    def _get_regions(self) -> typing.List[dict]:
+        """
+        the statement region, the time, location, qualifier and other columns between the first and the last
+        variable column are listed under skip_columns so they are not evaluated as statement cells. t2wml only reads
+        the first region of the list, so the columns are skipped instead of splitting the region
+        """
+        region = self._get_region()
+        if not self.exact_regions or len(self.variable_indices) == 0:
+            return [region]
+        variables = set(self.variable_indices)
+        skipped = [self.letters[col] for col in range(self.variable_indices[0], self.variable_indices[-1] + 1)
+                   if col not in variables]
+        if skipped:
+            region['skip_columns'] = skipped
+        return [region]
+
+    def _guess_format(self, col_index: int, col_type: Type):
+        spec_format, confidence = infer_time_format(self.sheet.iloc[self.data_index:, col_index], col_type,
+                                                    self.format_sample_size)
+        self.format_confidence[self.letters[col_index]] = confidence
+        return spec_format
+
+    def _get_date_format(self, col_index: int) -> typing.Optional[list]:
+        # t2wml drops the values that match none of the given formats, so they are only pinned when enough of the
+        # sample parses with them, otherwise let T2WML guess the format per cell. A format_sample_size of None checks
+        # every value of the column
+        formats, confidence = infer_time_format(self.sheet.iloc[self.data_index:, col_index], Type.DATE,
+                                                self.format_sample_size)
+        self.format_confidence[self.letters[col_index]] = confidence
+        if formats and confidence >= self.format_confidence_threshold:
+            return formats
+        return None
+
     def _get_time_single_format(self) -> dict:
         # over multiple columns
         time_cells = []
@@ -242,21 +402,15 @@ class ToT2WML:
         precision = 'year'
         try:
             for col_type in [Type.YEAR, Type.MONTH, Type.DAY]:
-                col_indices = get_indices(self.sheet.iloc[self.type_index, :],
-                                          col_type.value, within=self.time_indcies, startswith=True)
-                if col_indices.shape[0]:
+                col_indices = self.schema.type_columns(col_type.value, within=self.time_indcies, startswith=True)
+                if len(col_indices):
                     # col_index = get_index(self.sheet.iloc[self.type_index, :], col_type.value)
                     col_index = col_indices[0]
-                    type_spec = self.sheet.iloc[self.type_index, col_index].split(';')
+                    type_spec = self.schema.types[col_index].split(';')
                     if len(type_spec) > 1:
                         spec_format = type_spec[1]
                     else:
-                        if col_type == Type.YEAR:
-                            spec_format = guess_year_format(self.sheet.iloc[self.data_index:, col_index])
-                        elif col_type == Type.MONTH:
-                            spec_format = guess_month_format(self.sheet.iloc[self.data_index:, col_index])
-                        else:
-                            spec_format = date_format[col_type]
+                        spec_format = self._guess_format(col_index, col_type)
                     time_cells.append(col_index)
                     time_formats.append(spec_format)
                     if col_type == Type.MONTH:
@@ -267,16 +421,16 @@ class ToT2WML:
             print('Failed to guess time format')
         if not time_cells:
             self.failures.append('Failed to guess time format')
-            if self.time_indcies.shape[0]:
-                value = f'=value[{to_letter_column(self.time_indcies[0])}, $row]  # FIX ME'
+            if len(self.time_indcies):
+                value = f'=value[{self.letters[self.time_indcies[0]]}, $row]  # FIX ME'
             else:
                 value = '=value[COL, $row]  # FIX ME'
         elif len(time_cells) > 1:
-            cells = ', '.join([f'value[{to_letter_column(col)}, $row]' for col in time_cells])
+            cells = ', '.join([f'value[{self.letters[col]}, $row]' for col in time_cells])
             value = f'=concat({cells}, "-")'
             time_format = '-'.join(time_formats)
         else:
-            value = f'=value[{to_letter_column(time_cells[0])}, $row]'
+            value = f'=value[{self.letters[time_cells[0]]}, $row]'
             time_format = time_formats[0]
         result = {
             'property': 'P585',
@@ -299,27 +453,20 @@ class ToT2WML:
             precision = 'year'
             try:
                 # Continue, if the most fine grained date type column does not exist
-                col_indices = get_indices(self.sheet.iloc[self.type_index, :],
-                                          col_types[-1].value, within=self.time_indcies)
-                if not col_indices.shape[0]:
+                col_indices = self.schema.type_columns(col_types[-1].value, within=self.time_indcies)
+                if not len(col_indices):
                     continue
 
                 for col_type in col_types:
-                    col_indices = get_indices(self.sheet.iloc[self.type_index, :],
-                                              col_type.value, within=self.time_indcies)
-                    if col_indices.shape[0]:
+                    col_indices = self.schema.type_columns(col_type.value, within=self.time_indcies)
+                    if len(col_indices):
                         # col_index = get_index(self.sheet.iloc[self.type_index, :], col_type.value)
                         col_index = col_indices[0]
-                        type_spec = self.sheet.iloc[self.type_index, col_index].split(';')
+                        type_spec = self.schema.types[col_index].split(';')
                         if len(type_spec) > 1:
                             spec_format = type_spec[1]
                         else:
-                            if col_type == Type.YEAR:
-                                spec_format = guess_year_format(self.sheet.iloc[self.data_index:, col_index])
-                            elif col_type == Type.MONTH:
-                                spec_format = guess_month_format(self.sheet.iloc[self.data_index:, col_index])
-                            else:
-                                spec_format = date_format[col_type]
+                            spec_format = self._guess_format(col_index, col_type)
                         time_cells.append(col_index)
                         time_formats.append(spec_format)
                         if col_type == Type.MONTH:
@@ -332,18 +479,18 @@ class ToT2WML:
                 print('Failed to guess time format')
                 time_format = ''
                 self.failures.append('Failed to guess time format')
-                if self.time_indcies.shape[0]:
-                    value = f'=value[{to_letter_column(self.time_indcies[0])}, $row]  # FIX ME'
+                if len(self.time_indcies):
+                    value = f'=value[{self.letters[self.time_indcies[0]]}, $row]  # FIX ME'
                 else:
                     value = '=value[COL, $row]  # FIX ME'
             elif len(time_cells) > 1:
-                cells = ', '.join([f'value[{to_letter_column(col)}, $row]' for col in time_cells])
+                cells = ', '.join([f'value[{self.letters[col]}, $row]' for col in time_cells])
                 if not value:
                     value = f'=concat({cells}, "-")'
                 time_format = '-'.join(time_formats)
             else:
                 if not value:
-                    value = f'=value[{to_letter_column(time_cells[0])}, $row]'
+                    value = f'=value[{self.letters[time_cells[0]]}, $row]'
                 time_format = time_formats[0]
             if time_format:
                 format_list.append(time_format)
@@ -362,7 +509,7 @@ class ToT2WML:
     def _get_time(self) -> dict:
         # add point in time
         # Need to generalize
-        if self.time_indcies.shape[0] == 0:
+        if len(self.time_indcies) == 0:
             print('WARNING: No columns with "time" role annotation. Using default date 1900-01-01')
             result = {
                 'property': 'P585',
@@ -375,22 +522,24 @@ class ToT2WML:
             return result
 
         # Check if type is plain 'date'
-        date_indices = get_indices(self.sheet.iloc[self.type_index, :], Type.DATE.value,
-                                   within=self.time_indcies)
-        if date_indices.shape[0] > 0:
+        date_indices = self.schema.type_columns(Type.DATE.value, within=self.time_indcies)
+        if len(date_indices) > 0:
             time_index = date_indices[0]
             result = {
                 'property': 'P585',
-                'value': f'=value[{to_letter_column(time_index)}, $row]',
+                'value': f'=value[{self.letters[time_index]}, $row]',
                 'calendar': 'Q1985727',
                 'precision': 'day',
                 'time_zone': 0,
-                # No need to provide 'format'. Let T2WML guess the format.
+                # 'format' is only provided if it could be inferred, otherwise let T2WML guess the format.
             }
+            formats = self._get_date_format(time_index)
+            if formats:
+                result['format'] = formats
             return result
 
         # Check if type is a format string
-        cell_value = self.sheet.iloc[self.type_index, self.time_indcies[0]]
+        cell_value = self.schema.types[self.time_indcies[0]]
         if cell_value.startswith('%'):
             if '|' in cell_value:
                 # After '|' is regular exrpress to capture date.
@@ -401,12 +550,12 @@ class ToT2WML:
                 cell_value = cell_value.replace(u'\u2018', "'").replace(u'\u2019', "'")
                 try:
                     date_format, value = cell_value.split('|')
-                    value = value.replace('$$', f'value[{to_letter_column(self.time_indcies[0])}, $row]')
+                    value = value.replace('$$', f'value[{self.letters[self.time_indcies[0]]}, $row]')
                 except:
                     raise Exception(f"Invalid time specification: {cell_value}")
             else:
                 date_format = cell_value
-                value = f'=value[{to_letter_column(self.time_indcies[0])}, $row]'
+                value = f'=value[{self.letters[self.time_indcies[0]]}, $row]'
             result = {
                 'property': 'P585',
                 'value': value,
@@ -434,12 +583,13 @@ class ToT2WML:
         qualifiers = []
         items = []
         for col_type in [Type.ADMIN3, Type.ADMIN2, Type.ADMIN1, Type.COUNTRY]:
-            if get_indices(self.sheet.iloc[self.type_index, :], col_type.value).shape[0]:
-                col_index = Utility.get_index(self.sheet.iloc[self.type_index, :], col_type.value)
+            col_indices = self.schema.type_columns(col_type.value)
+            if len(col_indices):
+                col_index = col_indices[0]
                 context = location_context[col_type]
                 if self.main_subject_index == col_index:
                     context = "main subject"
-                item = f'item[{to_letter_column(col_index)}, $row, "{context}"]'
+                item = f'item[{self.letters[col_index]}, $row, "{context}"]'
                 value = f'={item}'
                 entry = {
                     'property': f'{property_node[col_type]}',
@@ -502,15 +652,15 @@ class ToT2WML:
 
     def _get_coordinate(self) -> list:
         # add coordinate
-        longitude_index = get_indices(self.sheet.iloc[self.type_index, :], Type.LONGITUDE.value)
-        latitude_index = get_indices(self.sheet.iloc[self.type_index, :], Type.LATITUDE.value)
-        if longitude_index.shape[0] and latitude_index.shape[0]:
+        longitude_index = self.schema.type_columns(Type.LONGITUDE.value)
+        latitude_index = self.schema.type_columns(Type.LATITUDE.value)
+        if len(longitude_index) and len(latitude_index):
             longitude_index = longitude_index[0]
             latitude_index = latitude_index[0]
             result = {
                 'property': property_node[Type.POINT],
-                'latitude': f'=value[{to_letter_column(latitude_index)}, $row]',
-                'longitude': f'=value[{to_letter_column(longitude_index)}, $row]',
+                'latitude': f'=value[{self.letters[latitude_index]}, $row]',
+                'longitude': f'=value[{self.letters[longitude_index]}, $row]',
                 'globe': 'wgs84'
                 # 'value': '=concat("POINT(", value[' + to_letter_column(longitude_index) + ' , $row], value[' \
                 #     + to_letter_column(latitude_index) + ', $row], ")", " ")'
@@ -522,28 +672,31 @@ class ToT2WML:
     def _get_qualifiers(self) -> list:
         # add qualifiers
         qualifier = []
-        if self.qualifier_indices.shape[0] == 0:
+        if len(self.qualifier_indices) == 0:
             return qualifier
-        for i in range(self.qualifier_indices.shape[0]):
+        for i in range(len(self.qualifier_indices)):
             col_index = self.qualifier_indices[i]
-            col_type = self.sheet.iloc[self.type_index, col_index]
-            print(self.sheet.iloc[self.header_index, col_index], col_type, col_type == Type.DATE)
+            col_type = self.schema.types[col_index]
+            print(self.schema.headers[col_index], col_type, col_type == Type.DATE)
             if col_type == Type.DATE.value:
                 entry = {
                     'calendar': 'Q1985727',
                     'time_zone': 0,
-                    'property': f'=item[{to_letter_column(col_index)}, {self.header_index + 1}, "property"]',
-                    'value': f'=value[{to_letter_column(col_index)}, $row]'
+                    'property': f'=item[{self.letters[col_index]}, {self.header_index + 1}, "property"]',
+                    'value': f'=value[{self.letters[col_index]}, $row]'
                 }
+                formats = self._get_date_format(col_index)
+                if formats:
+                    entry['format'] = formats
             elif col_type == Type.ENTITY.value:
                 entry = {
-                    'property': f'=item[{to_letter_column(col_index)}, {self.header_index + 1}, "property"]',
-                    'value': f'=item[{to_letter_column(col_index)}, $row]'
+                    'property': f'=item[{self.letters[col_index]}, {self.header_index + 1}, "property"]',
+                    'value': f'=item[{self.letters[col_index]}, $row]'
                 }
             else:
                 entry = {
-                    'property': f'=item[{to_letter_column(col_index)}, {self.header_index + 1}, "property"]',
-                    'value': f'=value[{to_letter_column(col_index)}, $row]'
+                    'property': f'=item[{self.letters[col_index]}, {self.header_index + 1}, "property"]',
+                    'value': f'=value[{self.letters[col_index]}, $row]'
                 }
             qualifier.append(entry)
         return qualifier
@@ -563,17 +716,17 @@ class ToT2WML:
         result = dict()
 
         # If not unit columns, just return
-        if self.units_indices.shape[0] == 0:
+        if len(self.units_indices) == 0:
             return result
 
-        for i in range(self.units_indices.shape[0]):
+        for i in range(len(self.units_indices)):
             col_index = self.units_indices[i]
-            unit_spec = self.sheet.iloc[self.role_index, col_index]
+            unit_spec = self.schema.roles[col_index]
             variable_indices = []
             if ';' in unit_spec:
                 variable_names = unit_spec.split(';')[1].split(',')
                 for name in variable_names:
-                    indices = get_indices(self.sheet.iloc[self.header_index, 1:], name)
+                    indices = self.schema.header_columns(name)
                     if len(indices) == 0:
                         print(f'Invalid unit specification: "{unit_spec}"  No variable named "{name}"')
                     else:
@@ -589,7 +742,8 @@ class ToT2WML:
 
     def get_dict(self) -> dict:
         self.failures = []
-        region = self._get_region()
+        self.format_confidence = {}
+        regions = self._get_regions()
         variable_unit_map = self._process_unit_columns()
 
         # template = collections.OrderedDict()
@@ -599,11 +753,11 @@ class ToT2WML:
             no_main_subject_warning == '  # FIX ME'
             self.failures.append('No main subject column')
         template[
-            'item'] = f'=item[{to_letter_column(self.main_subject_index)}, $row, "main subject"]{no_main_subject_warning}'
+            'item'] = f'=item[{self.letters[self.main_subject_index]}, $row, "main subject"]{no_main_subject_warning}'
         template['property'] = f'=item[$col, {self.header_index + 1}, "property"]'
         template['value'] = '=value[$col, $row]'
 
-        if self.units_indices.shape[0] > 0:
+        if len(self.units_indices) > 0:
             # NOTE: Currently we do not support multiple yaml files.
             # If None key exists the we just use that unit list.
             # Otherwise, we just combine all the unit list.
@@ -613,11 +767,11 @@ class ToT2WML:
                 unit_cols = sorted(list(set(unit for units in  variable_unit_map.values() for unit in units)))
 
             if len(unit_cols) > 1:
-                cells = ', '.join([f'value[{to_letter_column(col)}, $row]' for col in unit_cols])
+                cells = ', '.join([f'value[{self.letters[col]}, $row]' for col in unit_cols])
                 value = f'=get_item(concat({cells} , ", "), "unit")'
             else:
                 col = unit_cols[0]
-                value = f'=item[{to_letter_column(col)}, $row, "unit"]'
+                value = f'=item[{self.letters[col]}, $row, "unit"]'
             template['unit'] = value
         else:
             template['unit'] = f'=value[$col, {self.unit_index + 1}] -> item[$col, {self.unit_index + 1}, "unit"]'
@@ -632,7 +786,7 @@ class ToT2WML:
 
         t2wml_yaml = {
             'statementMapping': {
-                'region': [region],
+                'region': regions,
                 'template': template,
             }
         }
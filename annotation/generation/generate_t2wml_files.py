@@ -1,9 +1,29 @@
+import asyncio
+import contextvars
+import functools
 import os
+import signal
+import tempfile
+import sys
+import threading
+import typing
 from pathlib import Path
 from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from time import time
 import pandas as pd
 import shutil
 
+# input files produce() can read, every sheet of a workbook is processed
+T2WML_INPUT_EXTENSIONS = (".csv", ".xlsx", ".xls")
+# each sheet runs in its own hidden work directory of the output folder
+T2WML_WORK_PREFIX = ".work-"
+# size of the chunks read from a child process, and how much of its stderr is kept for error messages
+SHELL_READ_CHUNK = 64 * 1024
+SHELL_STDERR_TAIL = 64 * 1024
+# output of an awaited child kept in memory before it is spooled to disk, until it is handed to the parser
+SHELL_SPOOL_SIZE = 16 * 1024 * 1024
+
 def get_sheet_names(file_path):
     """
     This function returns the first sheet name of the excel file
@@ -18,79 +38,505 @@ def get_sheet_names(file_path):
     return xl.sheet_names
 
 
-def produce(t2wml_project_path: str, project_name: str, input_folder_path:str, output_folder_path: str):
-    # set up the environment
-    virtual_env = pd.__file__.replace("pandas/__init__.py", "backend")
-    os.chdir(virtual_env)
+def _init_t2wml_worker(backend_path: str):
+    # t2wml's driver is imported from its backend folder, every path handed to it is absolute
+    if backend_path not in sys.path:
+        sys.path.insert(0, backend_path)
+
+
+def _run_t2wml_sheet(data_file_path: str, sheet_name: str, wikifier_file: str, yaml_file: str,
+                     work_directory: str, project_name: str) -> float:
     from driver import run_t2wml
+    s = time()
+    run_t2wml(data_file_path, wikifier_file, yaml_file, work_directory, sheet_name, filetype="tsv",
+              project_name=project_name)
+    return time() - s
+
+
+def _move_results(work_directory: str, output_directory: str, prefix: str, moved: set) -> int:
+    """
+    move every `<name>/results.tsv` of a worker's directory to `<prefix><name>.tsv` in the output directory, other
+    files to `<prefix><name>`. Raises ValueError without moving anything if one of them was already written by
+    another sheet of this run (`moved`)
+    :return: number of rows moved
+    """
+    moves = []
+    for each_file in os.listdir(work_directory):
+        full_path = os.path.join(work_directory, each_file)
+        if os.path.isdir(full_path):
+            if os.path.isfile(os.path.join(full_path, "results.tsv")):
+                moves.append((os.path.join(full_path, "results.tsv"), prefix + each_file + ".tsv"))
+        else:
+            moves.append((full_path, prefix + each_file))
+    clashes = sorted(name for _, name in moves if name in moved)
+    if clashes:
+        raise ValueError("t2wml output {} is also written by another sheet".format(", ".join(clashes)))
 
-    # set up the folders
-    yaml_file = os.path.join(t2wml_project_path, "{}/{}.yaml".format(project_name, project_name))
-    wikifier_file = os.path.join(output_folder_path, "consolidated-wikifier.csv")
-    data_file_folder = input_folder_path
-    output_directory = os.path.join(output_folder_path, "t2wml-output")
+    rows = 0
+    for source, name in moves:
+        if name.endswith(".tsv"):
+            with open(source, "r") as f:
+                rows += max(sum(1 for _ in f) - 1, 0)
+        shutil.move(source, os.path.join(output_directory, name))
+        moved.add(name)
+    shutil.rmtree(work_directory)
+    return rows
 
-    for filename in os.listdir(data_file_folder):
-        if filename.endswith(".csv"):
-            total_results = ""
+
+def produce(t2wml_project_path: str, project_name: str, input_folder_path: str, output_folder_path: str,
+            workers: int = None) -> typing.List[dict]:
+    """
+    run t2wml on every sheet of every csv / excel file in the input folder, `workers` sheets at a time
+    each sheet runs in its own process and output directory, its results.tsv is moved to `t2wml-output`
+    as soon as it finishes. The output of a workbook sheet is named after the workbook too, `<file>.<sheet>.tsv`,
+    since sheets of different workbooks often share a name
+    :return: per sheet report with the time taken and the number of rows produced
+    """
+    # set up the environment
+    backend_path = pd.__file__.replace("pandas/__init__.py", "backend")
+
+    # set up the folders, workers run from the backend folder so all paths must be absolute
+    yaml_file = os.path.abspath(os.path.join(t2wml_project_path, "{}/{}.yaml".format(project_name, project_name)))
+    wikifier_file = os.path.abspath(os.path.join(output_folder_path, "consolidated-wikifier.csv"))
+    data_file_folder = os.path.abspath(input_folder_path)
+    output_directory = os.path.abspath(os.path.join(output_folder_path, "t2wml-output"))
+    os.makedirs(output_directory, exist_ok=True)
+
+    tasks = []
+    for filename in sorted(os.listdir(data_file_folder)):
+        if filename.startswith("~") or filename.startswith("."):
+            continue
+        if filename.lower().endswith(T2WML_INPUT_EXTENSIONS):
             data_file_path = os.path.join(data_file_folder, filename)
-            print("processing", filename)
-            sheet_names = get_sheet_names(data_file_path)
-            for sheet_name in sheet_names:
-                run_t2wml(data_file_path, wikifier_file, yaml_file, output_directory, sheet_name, filetype="tsv",
-                          project_name=project_name)
+            for sheet_name in get_sheet_names(data_file_path):
+                work_directory = os.path.join(output_directory, "{}{}".format(T2WML_WORK_PREFIX, len(tasks)))
+                tasks.append((filename, data_file_path, sheet_name, work_directory))
 
+    report = []
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_t2wml_worker,
+                             initargs=(backend_path,)) as executor:
+        futures = {}
+        moved = set()
+        for filename, data_file_path, sheet_name, work_directory in tasks:
+            # a failed sheet of an earlier run may have left its work directory behind
+            shutil.rmtree(work_directory, ignore_errors=True)
+            os.makedirs(work_directory, exist_ok=True)
+            future = executor.submit(_run_t2wml_sheet, data_file_path, sheet_name, wikifier_file, yaml_file,
+                                     work_directory, project_name)
+            futures[future] = (filename, sheet_name, work_directory)
+        for future in as_completed(futures):
+            filename, sheet_name, work_directory = futures[future]
+            try:
+                seconds = future.result()
+                is_csv = filename.lower().endswith(".csv")
+                rows = _move_results(work_directory, output_directory, "" if is_csv else filename + ".", moved)
+            except Exception as e:
+                failures["{} [{}]".format(filename, sheet_name)] = str(e)
+                print("Error!! t2wml failed on", filename, sheet_name)
+                print(e)
+                # the work directory is kept for debugging, it is cleared when the sheet runs again
+                print("partial output kept in", work_directory)
+                print("-" * 50)
+                continue
+            print("processed {} [{}]: {} rows in {:.2f} seconds ({:.1f} rows/second)".format(
+                filename, sheet_name, rows, seconds, rows / seconds if seconds else 0))
+            report.append({"file": filename, "sheet": sheet_name, "rows": rows, "seconds": seconds})
 
-    # move all files from folder
+    # move results left in the output folder by earlier runs, work directories of failed sheets are left alone
     for each_file in os.listdir(output_directory):
         full_path = os.path.join(output_directory, each_file)
-        if os.path.isdir(full_path):
+        if os.path.isdir(full_path) and not each_file.startswith(T2WML_WORK_PREFIX):
             file_path = os.path.join(output_directory, each_file, "results.tsv")
             if os.path.isfile(file_path):
                 shutil.move(file_path, full_path + ".tsv")
             shutil.rmtree(full_path)
 
+    if failures:
+        raise ValueError("Running t2wml failed on {} of {} sheets: {}".format(
+            len(failures), len(tasks), ", ".join(sorted(failures))))
+    return report
 
-def execute_shell_code(shell_command: str, debug=True):
+
+class ShellCodeResult(object):
+    """
+    Outcome of `run_shell_code`: exit status, run time, bytes written by the child and its (parsed) output.
+    """
+    def __init__(self, shell_command: str):
+        self.shell_command = shell_command
+        self.returncode = None
+        self.seconds = 0.0
+        self.output_bytes = 0
+        self.error_bytes = 0
+        self.stderr = ""
+        self.stdout = None
+        self.parsed = None
+
+
+class _CountingReader(object):
+    # binary file-like view of a child's stdout that counts the bytes read through it
+    def __init__(self, stream):
+        self._stream = stream
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.count += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._stream.readline(size)
+        self.count += len(data)
+        return data
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+def _drain_stderr(stream, result: ShellCodeResult):
+    tail = bytearray()
+    for chunk in iter(lambda: stream.read1(SHELL_READ_CHUNK), b""):
+        result.error_bytes += len(chunk)
+        tail += chunk
+        if len(tail) > SHELL_STDERR_TAIL:
+            del tail[:len(tail) - SHELL_STDERR_TAIL]
+    result.stderr = tail.decode("utf-8", errors="replace")
+
+
+def _kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _wait_unreaped(process) -> None:
+    # block until the child exits but leave it to be reaped, its pid and process group can not be reused meanwhile
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+
+
+class ShellScope(object):
+    """
+    Child processes started by `run_shell_code` while the scope is set in the current context. Cancelling the
+    scope from another thread kills them and makes `run_shell_code` refuse to start new ones, see `run_blocking`.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def add(self, process) -> bool:
+        with self._lock:
+            if self.cancelled:
+                _kill_process_group(process)
+                return False
+            self._processes.add(process)
+            return True
+
+    def discard(self, process) -> None:
+        with self._lock:
+            self._processes.discard(process)
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                _kill_process_group(process)
+
+
+_shell_scope = contextvars.ContextVar("shell_scope", default=None)
+
+
+async def run_blocking(func: typing.Callable, *args, **kwargs):
+    """
+    Await a blocking function run in the default executor. If the awaiting task is cancelled, the child processes
+    `func` started through `run_shell_code` are killed, so it fails quickly and releases its thread.
+    """
+    scope = ShellScope()
+    context = contextvars.copy_context()
+    context.run(_shell_scope.set, scope)
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+    except asyncio.CancelledError:
+        scope.cancel()
+        raise
+
+
+def _check_shell_result(result: ShellCodeResult, stage: str, debug: bool) -> None:
+    if result.returncode != 0:
+        if debug:
+            print("Error!!")
+            print(result.stderr)
+            print("-" * 50)
+        raise ValueError("Running {} failed with exit status {}!\n{}\n{}".format(
+            stage, result.returncode, result.shell_command.strip(), result.stderr))
+
+    if debug:
+        if result.stderr:
+            print("Warning!!")
+            print(result.stderr)
+            print("-" * 50)
+        print("Running finished!!!!!! exit status {}, {} bytes of output in {:.2f} seconds".format(
+            result.returncode, result.output_bytes, result.seconds))
+
+
+def run_shell_code(shell_command: str, output_file: str = None, output_parser: typing.Callable = None,
+                   timeout: float = None, stage: str = None, debug=True) -> ShellCodeResult:
+    """
+    Run a shell command without buffering its output in memory.
+
+    stdout goes straight to `output_file` if given, otherwise it is streamed to `output_parser` (a callable taking
+    a binary file-like object, e.g. `pd.read_csv`) whose return value is kept in `result.parsed`, otherwise it is
+    collected in `result.stdout`. The command runs in its own process group which is killed if it is still running
+    after `timeout` seconds. Output on stderr is only reported, failure is decided by the exit status.
+
+    Raises TimeoutError on timeout and ValueError on a non zero exit status.
+    """
+    stage = stage or "shell code"
     if debug:
         print("Executing...")
         print(shell_command)
         print("-" * 100)
-    out = Popen(shell_command, shell=True, stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    # out.wait()
-    """
-    Popen.wait():
+    result = ShellCodeResult(shell_command)
+    s = time()
 
-    Wait for child process to terminate. Set and return returncode attribute.
+    output_handle = open(output_file, "wb") if output_file else None
+    try:
+        process = Popen(shell_command, shell=True, stdout=output_handle or PIPE, stderr=PIPE,
+                        start_new_session=True)
+    finally:
+        if output_handle:
+            output_handle.close()
 
-    Warning: This will deadlock when using stdout=PIPE and/or stderr=PIPE and the child process generates enough output to
-    a pipe such that it blocks waiting for the OS pipe buffer to accept more data. Use communicate() to avoid that. """
-    stdout, stderr = out.communicate()
-    if stderr:
-        print("Error!!")
-        print(stderr)
-        print("-" * 50)
-        raise
+    scope = _shell_scope.get()
+    if scope is not None and not scope.add(process):
+        process.wait()
+        raise ValueError("Running {} cancelled!\n{}".format(stage, shell_command.strip()))
+
+    # the child is only reaped under the lock, so its process group is not killed once its pid can be reused
+    reap_lock = threading.Lock()
+    timed_out = threading.Event()
+
+    def _kill_unreaped() -> bool:
+        with reap_lock:
+            if process.returncode is not None:
+                return False
+            _kill_process_group(process)
+            return True
+
+    def _on_timeout():
+        if _kill_unreaped():
+            timed_out.set()
+
+    timer = threading.Timer(timeout, _on_timeout) if timeout else None
+    stderr_thread = threading.Thread(target=_drain_stderr, args=(process.stderr, result), daemon=True)
+    stdout_reader = None
+    try:
+        if timer:
+            timer.start()
+        stderr_thread.start()
+        if output_handle is None:
+            stdout_reader = _CountingReader(process.stdout)
+            if output_parser is not None:
+                result.parsed = output_parser(stdout_reader)
+                # let the child finish writing whatever the parser did not consume
+                while stdout_reader.read(SHELL_READ_CHUNK):
+                    pass
+            else:
+                result.stdout = stdout_reader.read().decode("utf-8", errors="replace")
+        _wait_unreaped(process)
+        with reap_lock:
+            process.wait()
+        stderr_thread.join()
+    except BaseException:
+        # parser failure or cancellation, do not leave the child (or its pipeline) running
+        _kill_unreaped()
+        process.wait()
+        if not timed_out.is_set() or process.returncode != -signal.SIGKILL:
+            raise
+    finally:
+        if timer:
+            timer.cancel()
+        if process.stdout:
+            process.stdout.close()
+        if scope is not None:
+            scope.discard(process)
+
+    result.returncode = process.returncode
+    result.seconds = time() - s
+    result.output_bytes = os.path.getsize(output_file) if output_file else stdout_reader.count
 
+    # a timeout is only reported if the kill is what ended the child
+    if timed_out.is_set() and process.returncode == -signal.SIGKILL:
+        raise TimeoutError("Running {} timed out after {} seconds!\n{}".format(stage, timeout, shell_command.strip()))
+    if scope is not None and scope.cancelled:
+        raise ValueError("Running {} cancelled!\n{}".format(stage, shell_command.strip()))
+    _check_shell_result(result, stage, debug)
+    return result
+
+
+async def _drain_stderr_async(stream, result: ShellCodeResult):
+    tail = bytearray()
+    while True:
+        chunk = await stream.read(SHELL_READ_CHUNK)
+        if not chunk:
+            break
+        result.error_bytes += len(chunk)
+        tail += chunk
+        if len(tail) > SHELL_STDERR_TAIL:
+            del tail[:len(tail) - SHELL_STDERR_TAIL]
+    result.stderr = tail.decode("utf-8", errors="replace")
+
+
+async def async_run_shell_code(shell_command: str, output_file: str = None, output_parser: typing.Callable = None,
+                               timeout: float = None, stage: str = None, debug=True) -> ShellCodeResult:
+    """
+    asyncio version of `run_shell_code`, the child is awaited with asyncio.create_subprocess_exec instead of
+    blocking a thread.
+
+    stdout goes straight to `output_file` if given, otherwise it is spooled (on disk past SHELL_SPOOL_SIZE) and
+    then handed to `output_parser` in the default executor, or collected in `result.stdout`. The process group is
+    killed on timeout and when the awaiting task is cancelled.
+
+    Raises TimeoutError on timeout and ValueError on a non zero exit status.
+    """
+    stage = stage or "shell code"
     if debug:
-        print("Running finished!!!!!!")
-    return stdout
+        print("Executing...")
+        print(shell_command)
+        print("-" * 100)
+    result = ShellCodeResult(shell_command)
+    s = time()
+
+    output_handle = open(output_file, "wb") if output_file else None
+    try:
+        process = await asyncio.create_subprocess_exec("/bin/sh", "-c", shell_command,
+                                                       stdout=output_handle or asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    finally:
+        if output_handle:
+            output_handle.close()
+
+    spool = None if output_handle else tempfile.SpooledTemporaryFile(max_size=SHELL_SPOOL_SIZE)
+
+    async def _communicate():
+        stderr_task = asyncio.ensure_future(_drain_stderr_async(process.stderr, result))
+        if spool is not None:
+            while True:
+                chunk = await process.stdout.read(SHELL_READ_CHUNK)
+                if not chunk:
+                    break
+                spool.write(chunk)
+                result.output_bytes += len(chunk)
+        await stderr_task
+        await process.wait()
+
+    try:
+        try:
+            await asyncio.wait_for(_communicate(), timeout)
+        except asyncio.TimeoutError:
+            # the child may have exited just before the timeout, only a kill that ends it is a timeout
+            if process.returncode is None:
+                _kill_process_group(process)
+            await process.wait()
+            if process.returncode == -signal.SIGKILL:
+                raise TimeoutError("Running {} timed out after {} seconds!\n{}".format(
+                    stage, timeout, shell_command.strip()))
+            # otherwise read the rest of its output
+            await _communicate()
+        except BaseException:
+            # cancellation, do not leave the child (or its pipeline) running
+            _kill_process_group(process)
+            await process.wait()
+            raise
+
+        result.returncode = process.returncode
+        result.seconds = time() - s
+        if output_file:
+            result.output_bytes = os.path.getsize(output_file)
+        _check_shell_result(result, stage, debug)
 
+        if spool is not None:
+            spool.seek(0)
+            if output_parser is not None:
+                result.parsed = await run_blocking(output_parser, spool)
+            else:
+                result.stdout = spool.read().decode("utf-8", errors="replace")
+    finally:
+        if spool is not None:
+            spool.close()
+    return result
 
-def populate_node2_columns(folder_path: str):
+
+def execute_shell_code(shell_command: str, debug=True):
+    return run_shell_code(shell_command, debug=debug).stdout
+
+
+def _implode_file(input_path: str, output_path: str) -> str:
+    # write next to the final file and rename on success, so a failed run never looks up to date
+    temp_output_path = output_path + ".part"
+    shell_code = """
+    kgtk implode -i "{}" --remove-prefixed-columns True --without si_units language_suffix -o "{}"
+    """.format(input_path, temp_output_path)
+    try:
+        run_shell_code(shell_code, stage="kgtk implode", debug=False)
+        os.replace(temp_output_path, output_path)
+    finally:
+        if os.path.exists(temp_output_path):
+            os.remove(temp_output_path)
+    return output_path
+
+
+def populate_node2_columns(folder_path: str, workers: int = None):
+    """
+    run kgtk implode on every tsv file in `t2wml-output`, `workers` files at a time (default: cpu count)
+    files whose imploded output is already newer than the input are skipped
+    :param folder_path:
+    :param workers:
+    :return: path of the last imploded file
+    """
     t2wml_output_path = os.path.join(folder_path, "t2wml-output")
     output_path = None
     if not os.path.exists(os.path.join(folder_path, "imploded")):
         os.mkdir(os.path.join(folder_path, "imploded"))
+    pending = []
     for each_file in os.listdir(t2wml_output_path):
         full_path = os.path.join(t2wml_output_path, each_file)
         if os.path.isfile(full_path) and each_file.endswith(".tsv"):
-            # print("processing", full_path)
             output_path = os.path.join(folder_path, "imploded", each_file)
-            shell_code = """
-            kgtk implode -i "{}" --remove-prefixed-columns True --without si_units language_suffix -o "{}"
-            """.format(full_path, output_path)
-            execute_shell_code(shell_code)
+            if os.path.exists(output_path) and os.path.getmtime(output_path) > os.path.getmtime(full_path):
+                print("skipping", each_file, "imploded file is up to date")
+                continue
+            pending.append((full_path, output_path))
     if not output_path:
         raise ValueError("No tsv file found to populate!")
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(_implode_file, full_path, each_output): full_path
+                   for full_path, each_output in pending}
+        for future in as_completed(futures):
+            full_path = futures[future]
+            try:
+                future.result()
+                print("imploded", full_path)
+            except Exception as e:
+                failures[full_path] = str(e)
+                print("Error!! kgtk implode failed on", full_path)
+                print(e)
+                print("-" * 50)
+
+    if failures:
+        raise ValueError("Running kgtk implode failed on {} of {} files: {}".format(
+            len(failures), len(pending), ", ".join(sorted(failures))))
     return output_path
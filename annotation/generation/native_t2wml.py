@@ -0,0 +1,473 @@
+import csv
+import io
+import os
+import re
+import string
+import typing
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from annotation.generation.generate_t2wml import to_letter_column, to_number_column
+
+# columns of the kgtk file written by t2wml's KnowledgeGraph.save_kgtk
+KGTK_FIELDNAMES = ["id", "node1", "label", "node2", "node2;kgtk:data_type", "node2;kgtk:number",
+                   "node2;kgtk:low_tolerance", "node2;kgtk:high_tolerance", "node2;kgtk:units_node",
+                   "node2;kgtk:date_and_time", "node2;kgtk:precision", "node2;kgtk:calendar", "node2;kgtk:truth",
+                   "node2;kgtk:symbol", "node2;kgtk:latitude", "node2;kgtk:longitude", "node2;kgtk:globe",
+                   "node2;kgtk:text", "node2;kgtk:language"]
+
+# types of the wikidata properties ToT2WML uses that are not defined in the datamart schema properties
+WIKIDATA_PROPERTY_TYPES = {
+    "P17": "wikibaseitem",
+    "P131": "wikibaseitem",
+    "P585": "time",
+    "P625": "globecoordinate",
+}
+
+# t2wml time precisions as wikidata precision numbers
+TIME_PRECISIONS = {"year": 9, "month": 10, "day": 11}
+
+# calendars whose dates t2wml converts to gregorian ones
+ETHIOPIAN_CALENDARS = ("Q215271", "Ethiopian")
+
+_LETTERS = r"([A-Z]+)"
+_ITEM = re.compile(r'^=item\[' + _LETTERS + r', \$row, "main subject"\]$')
+_PROPERTY = re.compile(r'^=item\[\$col, (\d+), "property"\]$')
+_VALUE = "=value[$col, $row]"
+_UNIT_ROW = re.compile(r'^=value\[\$col, (\d+)\] -> item\[\$col, (\d+), "unit"\]$')
+_UNIT_COLUMN = re.compile(r'^=item\[' + _LETTERS + r', \$row, "unit"\]$')
+_CELL_VALUE = re.compile(r'^=value\[' + _LETTERS + r', \$row\]$')
+_CONCAT = re.compile(r'^=concat\((value\[[A-Z]+, \$row\](?:, value\[[A-Z]+, \$row\])+), "(.*)"\)$')
+_CELL_ITEM = re.compile(r'item\[' + _LETTERS + r', \$row(?:, "([^"]*)")?\]')
+_HEADER_ITEM = re.compile(r'^=item\[' + _LETTERS + r', (\d+), "property"\]$')
+
+
+class UnsupportedSheet(ValueError):
+    """
+    The native engine can not guarantee the output t2wml would produce for this template or sheet
+    """
+
+
+def _parse_value(expression) -> tuple:
+    """
+    ("cells", [columns], separator) for value[X, $row] (separator None) / concat(...), ("items", [(column, context),
+    ...]) for item[X, $row, "context"] or several of them joined with `or`, ("const", value) for a constant
+    """
+    if not isinstance(expression, str):
+        raise UnsupportedSheet("Non string value {!r}".format(expression))
+    if "#" in expression:
+        raise UnsupportedSheet("Unfinished template value {!r}".format(expression))
+    if not expression.startswith("="):
+        return "const", expression
+    match = _CELL_VALUE.match(expression)
+    if match:
+        return "cells", [to_number_column(match.group(1))], None
+    match = _CONCAT.match(expression)
+    if match:
+        columns = re.findall(r"value\[([A-Z]+), \$row\]", match.group(1))
+        return "cells", [to_number_column(each) for each in columns], match.group(2)
+    items = _CELL_ITEM.findall(expression)
+    if items and expression == "=" + " or ".join(
+            'item[{}, $row{}]'.format(column, ', "{}"'.format(context) if context else "")
+            for column, context in items):
+        return "items", [(to_number_column(column), context) for column, context in items]
+    raise UnsupportedSheet("Unsupported value {!r}".format(expression))
+
+
+def _parse_property(expression) -> tuple:
+    if not isinstance(expression, str):
+        raise UnsupportedSheet("Non string property {!r}".format(expression))
+    match = _HEADER_ITEM.match(expression)
+    if match:
+        return "header", to_number_column(match.group(1)), int(match.group(2)) - 1
+    if re.match(r"^P\d+$", expression):
+        return "const", expression
+    raise UnsupportedSheet("Unsupported property {!r}".format(expression))
+
+
+def _parse_qualifier(entry) -> dict:
+    if not isinstance(entry, dict) or "property" not in entry:
+        raise UnsupportedSheet("Unsupported qualifier {!r}".format(entry))
+    qualifier = {"property": _parse_property(entry["property"])}
+    keys = set(entry)
+    if keys == {"property", "latitude", "longitude", "globe"}:
+        qualifier["kind"] = "coordinate"
+        qualifier["latitude"] = _parse_value(entry["latitude"])
+        qualifier["longitude"] = _parse_value(entry["longitude"])
+        if qualifier["latitude"][0] != "cells" or qualifier["longitude"][0] != "cells":
+            raise UnsupportedSheet("Unsupported coordinate {!r}".format(entry))
+        qualifier["globe"] = entry["globe"]
+        return qualifier
+    if keys & {"calendar", "format", "precision", "time_zone"}:
+        if not keys <= {"property", "value", "calendar", "format", "precision", "time_zone"}:
+            raise UnsupportedSheet("Unsupported time qualifier {!r}".format(entry))
+        # without pinned formats and precision t2wml guesses them per cell
+        formats = entry.get("format")
+        if isinstance(formats, str):
+            formats = [formats]
+        if not formats or not all(isinstance(each, str) and "#" not in each for each in formats):
+            raise UnsupportedSheet("Time qualifier without format {!r}".format(entry))
+        if entry.get("precision") not in TIME_PRECISIONS:
+            raise UnsupportedSheet("Time qualifier without precision {!r}".format(entry))
+        if entry.get("calendar") in ETHIOPIAN_CALENDARS:
+            raise UnsupportedSheet("Time qualifier on the ethiopian calendar {!r}".format(entry))
+        qualifier.update(kind="time", value=_parse_value(entry.get("value")), formats=formats,
+                         precision=TIME_PRECISIONS[entry["precision"]], calendar=entry.get("calendar", ""))
+        if qualifier["value"][0] != "cells":
+            raise UnsupportedSheet("Unsupported time value {!r}".format(entry))
+        return qualifier
+    if keys != {"property", "value"}:
+        raise UnsupportedSheet("Unsupported qualifier {!r}".format(entry))
+    qualifier.update(kind="plain", value=_parse_value(entry["value"]))
+    return qualifier
+
+
+def _parse_template(t2wml_script: dict) -> dict:
+    if not isinstance(t2wml_script, dict) or set(t2wml_script) != {"statementMapping"}:
+        raise UnsupportedSheet("Unsupported script keys")
+    mapping = t2wml_script["statementMapping"]
+    if not isinstance(mapping, dict) or set(mapping) != {"region", "template"} or \
+            not isinstance(mapping["region"], list):
+        raise UnsupportedSheet("Unsupported statementMapping")
+    regions = []
+    for region in mapping["region"]:
+        if not isinstance(region, dict) or \
+                not {"left", "right", "top", "bottom"} <= set(region) <= {"left", "right", "top", "bottom",
+                                                                         "skip_columns"} or \
+                not all(isinstance(region[each], int) for each in ("top", "bottom")) or \
+                not all(re.match(r"^[A-Z]+$", str(region[each])) for each in ("left", "right")) or \
+                not isinstance(region.get("skip_columns", []), list) or \
+                not all(re.match(r"^[A-Z]+$", str(each)) for each in region.get("skip_columns", [])):
+            raise UnsupportedSheet("Unsupported region {!r}".format(region))
+        skipped = {to_number_column(each) for each in region.get("skip_columns", [])}
+        columns = [column for column in range(to_number_column(region["left"]), to_number_column(region["right"]) + 1)
+                   if column not in skipped]
+        regions.append((columns, region["top"] - 1, region["bottom"] - 1))
+
+    template = mapping["template"]
+    if not isinstance(template, dict) or not set(template) <= {"item", "property", "value", "unit", "qualifier"}:
+        raise UnsupportedSheet("Unsupported template keys")
+    item, prop = _ITEM.match(str(template.get("item"))), _PROPERTY.match(str(template.get("property")))
+    if not item or not prop or template.get("value") != _VALUE:
+        raise UnsupportedSheet("Unsupported item, property or value")
+    unit = None
+    if "unit" in template:
+        unit_row, unit_column = _UNIT_ROW.match(str(template["unit"])), _UNIT_COLUMN.match(str(template["unit"]))
+        if unit_row and unit_row.group(1) == unit_row.group(2):
+            unit = ("row", int(unit_row.group(1)) - 1)
+        elif unit_column:
+            unit = ("column", to_number_column(unit_column.group(1)))
+        else:
+            raise UnsupportedSheet("Unsupported unit {!r}".format(template["unit"]))
+    if not isinstance(template.get("qualifier", []), list):
+        raise UnsupportedSheet("Unsupported qualifier list")
+    return {"regions": regions, "item": to_number_column(item.group(1)), "header_row": int(prop.group(1)) - 1,
+            "unit": unit, "qualifiers": [_parse_qualifier(each) for each in template.get("qualifier", [])]}
+
+
+def parse_canonical_template(t2wml_script: dict) -> typing.Optional[dict]:
+    """
+    Returns the parsed template if `t2wml_script` has the shape generated by `ToT2WML.get_dict`, None otherwise
+    """
+    try:
+        return _parse_template(t2wml_script)
+    except UnsupportedSheet:
+        return None
+
+
+def property_types(properties_df: pd.DataFrame) -> typing.Dict[str, str]:
+    """
+    Returns the t2wml type (lower case, e.g. quantity) of the properties defined in `properties_df`
+    """
+    types = dict(WIKIDATA_PROPERTY_TYPES)
+    data_types = properties_df[properties_df["label"] == "data_type"]
+    types.update(zip(data_types["node1"].astype(str), data_types["node2"].astype(str).str.lower()))
+    return types
+
+
+class _Wikifier(object):
+    """
+    item lookups as t2wml's item table does them: the last entry of a key wins, and a cell is looked up by its
+    column, row and value first, down to its value alone
+    """
+    # (column, row, value) of the keys tried in order, False where the key leaves it empty
+    PRIORITY = [(True, True, True), (True, True, False), (True, False, True), (True, False, False),
+                (False, True, True), (False, True, False), (False, False, True)]
+
+    def __init__(self, wikifier_df: pd.DataFrame):
+        # the dataframe as t2wml reads the wikifier file, numbers included: a float value column matches "1.0"
+        wikifier_df = wikifier_df.fillna("").replace(r"^\s+$", "", regex=True)
+        for each in ("file", "sheet"):
+            if each in wikifier_df.columns and (wikifier_df[each].astype(str) != "").any():
+                raise UnsupportedSheet("Wikifier entries of a {}".format(each))
+        self.tables, self.patterns = {}, {}
+        for context, column, row, value, item in zip(wikifier_df["context"], wikifier_df["column"],
+                                                     wikifier_df["row"], wikifier_df["value"], wikifier_df["item"]):
+            if item == "":
+                raise UnsupportedSheet("Wikifier entry without an item")
+            try:
+                column, row = int(column) if column != "" else "", int(row) if row != "" else ""
+            except ValueError:
+                raise UnsupportedSheet("Wikifier entry of column {!r}, row {!r}".format(column, row))
+            value = str(value)
+            self.tables.setdefault(context, {})[(column, row, value)] = item
+            self.patterns.setdefault(context, set()).add((column != "", row != "", value != ""))
+
+    def lookup(self, values: pd.Series, column: int, rows: np.ndarray, context: str) -> pd.Series:
+        """
+        items of the `values` at `rows` of `column`, NaN where the wikifier has none
+        """
+        table, patterns = self.tables.get(context, {}), self.patterns.get(context, set())
+        items = pd.Series(np.nan, index=values.index, dtype=object)
+        n_values, rows = len(values), rows.tolist()
+        for use_column, use_row, use_value in self.PRIORITY:
+            if (use_column, use_row, use_value) not in patterns:
+                continue
+            keys = zip([column if use_column else ""] * n_values, rows if use_row else [""] * n_values,
+                       values.tolist() if use_value else [""] * n_values)
+            items = items.fillna(pd.Series([table.get(key) for key in keys], index=values.index, dtype=object))
+        return items
+
+
+def _mapped(values: pd.Series, function: typing.Callable) -> pd.Series:
+    # `function` evaluated once per distinct value
+    unique = values.unique()
+    return values.map(dict(zip(unique, map(function, unique))))
+
+
+def _makes_statement(text: str) -> bool:
+    # t2wml's string_is_valid: no statement for an empty cell, nan, #na or punctuation only
+    text = text.strip().lower()
+    return text not in ("", "#na", "nan") and not all(char in string.punctuation for char in text)
+
+
+def _is_number(text: str) -> bool:
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+def _iso_time(text: str, formats: typing.List[str]) -> typing.Optional[str]:
+    # the first of the formats that parses the value, like the additional formats given to t2wml
+    for each in formats:
+        try:
+            return datetime.strptime(text, each).isoformat()
+        except ValueError:
+            pass
+    return None
+
+
+def _quoted(values: pd.Series) -> pd.Series:
+    return '"' + values.str.replace('"', '\\"', regex=False) + '"'
+
+
+class NativeT2WML(object):
+    """
+    Generates the kgtk statements of a canonical template (see `parse_canonical_template`) column by column with
+    pandas, instead of evaluating the template cell by cell with t2wml. The output has the layout of t2wml's
+    `save_kgtk`, cells t2wml drops (empty values, missing main subjects or properties, values of the wrong type)
+    are dropped the same way. Anything whose t2wml result is not certain (a property of unknown type, a time
+    without a pinned format...) raises UnsupportedSheet so the caller can run t2wml.
+    """
+
+    def __init__(self, sheet: pd.DataFrame, template: dict, wikifier_df: pd.DataFrame,
+                 types: typing.Dict[str, str], file_name: str):
+        # the sheet as t2wml reads it from the csv file: strings, empty cells as ""
+        self.sheet = sheet
+        self.template = template
+        self.wikifier = _Wikifier(wikifier_df)
+        self.types = types
+        self.file_name = file_name
+        self.letters = [to_letter_column(i) for i in range(sheet.shape[1])]
+
+    def _type_of(self, property_id: str) -> str:
+        if property_id not in self.types:
+            raise UnsupportedSheet("Unknown type of property {}".format(property_id))
+        return self.types[property_id]
+
+    def _header_item(self, column: int, row: int, context: str) -> typing.Optional[str]:
+        if row >= self.sheet.shape[0] or column >= self.sheet.shape[1]:
+            raise UnsupportedSheet("Cell {},{} is outside of the sheet".format(column, row))
+        value = pd.Series([self.sheet.iat[row, column]])
+        item = self.wikifier.lookup(value, column, np.array([row]), context).iloc[0]
+        return None if pd.isna(item) else item
+
+    def _cells(self, columns: typing.List[int], rows: np.ndarray, separator: str = None) -> pd.Series:
+        values = [self.sheet.iloc[rows, column].reset_index(drop=True) for column in columns]
+        if separator is None:
+            return values[0]
+        # t2wml's concat skips blank cells and cuts len(separator) characters off the joined cells
+        joined = ["".join(cell + separator for cell in cells if cell.strip()) for cells in zip(*values)]
+        return pd.Series([each[:-len(separator)] for each in joined])
+
+    def _typed(self, property_id: str, values: pd.Series, qualifier: dict = None) -> typing.Tuple[dict, np.ndarray]:
+        """
+        the type specific columns of the edges of `values`, and the mask of the values t2wml keeps
+        """
+        property_type = self._type_of(property_id)
+        valid = (values != "").to_numpy()
+        if qualifier is not None and qualifier["kind"] == "time":
+            if property_type != "time":
+                raise UnsupportedSheet("Time qualifier on {} property {}".format(property_type, property_id))
+            times = _mapped(values, lambda text: _iso_time(text, qualifier["formats"]))
+            valid &= times.notna().to_numpy()
+            times = times.fillna("")
+            return {"node2": times, "node2;kgtk:data_type": "date_and_times",
+                    "node2;kgtk:date_and_time": _quoted(times), "node2;kgtk:precision": str(qualifier["precision"]),
+                    "node2;kgtk:calendar": qualifier["calendar"]}, valid
+        if property_type == "quantity":
+            valid &= _mapped(values, _is_number).to_numpy(dtype=bool)
+            return {"node2": values, "node2;kgtk:data_type": "quantity", "node2;kgtk:number": values}, valid
+        if property_type in ("string", "monolingualtext", "externalid", "url"):
+            return {"node2": values, "node2;kgtk:data_type": "string", "node2;kgtk:text": _quoted(values)}, valid
+        if property_type in ("wikibaseitem", "wikibaseproperty"):
+            return {"node2": values, "node2;kgtk:data_type": "symbol", "node2;kgtk:symbol": values}, valid
+        # times are guessed by t2wml without a pinned format
+        raise UnsupportedSheet("Unsupported {} value of property {}".format(property_type, property_id))
+
+    def _qualifier(self, qualifier: dict, rows: np.ndarray) -> typing.Optional[typing.Tuple[str, dict, np.ndarray]]:
+        """
+        label, type specific columns and mask of the qualifier edges of the data `rows`, None when t2wml drops
+        the qualifier for a property missing from the wikifier
+        """
+        if qualifier["property"][0] == "header":
+            property_id = self._header_item(qualifier["property"][1], qualifier["property"][2], "property")
+            if property_id is None:
+                return None
+        else:
+            property_id = qualifier["property"][1]
+
+        if qualifier["kind"] == "coordinate":
+            if self._type_of(property_id) != "globecoordinate":
+                raise UnsupportedSheet("Coordinate on property {}".format(property_id))
+            latitude = self._cells(qualifier["latitude"][1], rows, qualifier["latitude"][2])
+            longitude = self._cells(qualifier["longitude"][1], rows, qualifier["longitude"][2])
+            valid = (latitude != "").to_numpy() & (longitude != "").to_numpy()
+            return property_id, {"node2;kgtk:data_type": "location_coordinates", "node2;kgtk:latitude": latitude,
+                                 "node2;kgtk:longitude": longitude, "node2;kgtk:globe": qualifier["globe"]}, valid
+        if self._type_of(property_id) == "globecoordinate":
+            raise UnsupportedSheet("Coordinate property {} without latitude and longitude".format(property_id))
+
+        kind = qualifier["value"][0]
+        if kind == "const":
+            values = pd.Series([str(qualifier["value"][1])] * len(rows))
+        elif kind == "cells":
+            values = self._cells(qualifier["value"][1], rows, qualifier["value"][2])
+        else:
+            # the first item found, qualifiers whose cells are all missing from the wikifier are dropped
+            values = pd.Series(np.nan, index=range(len(rows)), dtype=object)
+            for column, context in qualifier["value"][1]:
+                cells = self.sheet.iloc[rows, column].reset_index(drop=True)
+                values = values.fillna(self.wikifier.lookup(cells, column, rows, context))
+            values = values.fillna("")
+        fields, valid = self._typed(property_id, values, qualifier)
+        return property_id, fields, valid
+
+    def _units(self, column: int, rows: np.ndarray) -> typing.Union[str, pd.Series]:
+        # a unit missing from the wikifier is a minor error for t2wml, the statement is kept without a unit
+        kind, index = self.template["unit"]
+        if kind == "row":
+            if not self.sheet.iat[index, column].strip():
+                return ""
+            return self._header_item(column, index, "unit") or ""
+        cells = self.sheet.iloc[rows, index].reset_index(drop=True)
+        return self.wikifier.lookup(cells, index, rows, "unit").fillna("")
+
+    def generate(self) -> pd.DataFrame:
+        """
+        Returns the kgtk edges t2wml generates for the template, statements in row order and each followed by its
+        qualifiers
+        """
+        template = self.template
+        n_rows = self.sheet.shape[0]
+        frames = []
+        for columns, top, bottom in template["regions"]:
+            rows = np.arange(max(top, 0), min(bottom, n_rows - 1) + 1)
+            if len(rows) == 0:
+                continue
+            subjects = self.wikifier.lookup(self.sheet.iloc[rows, template["item"]].reset_index(drop=True),
+                                            template["item"], rows, "main subject")
+            qualifiers = [each for each in (self._qualifier(each, rows) for each in template["qualifiers"])
+                          if each is not None]
+
+            for column in columns:
+                if column >= self.sheet.shape[1]:
+                    raise UnsupportedSheet("Region column {} is outside of the sheet".format(column))
+                property_id = self._header_item(column, template["header_row"], "property")
+                if property_id is None:
+                    continue
+                values = self.sheet.iloc[rows, column].reset_index(drop=True)
+                fields, valid = self._typed(property_id, values)
+                valid &= _mapped(values, _makes_statement).to_numpy(dtype=bool) & subjects.notna().to_numpy()
+                if template["unit"] is not None and self._type_of(property_id) == "quantity":
+                    fields["node2;kgtk:units_node"] = self._units(column, rows)
+
+                kept = np.flatnonzero(valid)
+                if len(kept) == 0:
+                    continue
+                cell_names = ["{}{}".format(self.letters[column], row + 1) for row in rows[kept]]
+                ids = pd.Series(["{};{}".format(self.file_name, each) for each in cell_names])
+                statement = {"id": ids, "node1": subjects.iloc[kept].reset_index(drop=True), "label": property_id}
+                statement.update(_take(fields, kept))
+                frames.append(_frame(statement, rows[kept], column, 0))
+
+                for i, (label, q_fields, q_valid) in enumerate(qualifiers, 1):
+                    q_kept = np.flatnonzero(q_valid[kept])
+                    if len(q_kept) == 0:
+                        continue
+                    statement_ids = ids.iloc[q_kept].reset_index(drop=True)
+                    edges = {"id": statement_ids + "-" + label, "node1": statement_ids, "label": label}
+                    edges.update(_take(q_fields, kept[q_kept]))
+                    frames.append(_frame(edges, rows[kept[q_kept]], column, i))
+
+        if not frames:
+            return pd.DataFrame(columns=KGTK_FIELDNAMES)
+        edges = pd.concat(frames, ignore_index=True)
+        edges = edges.iloc[np.lexsort((edges["_order"].to_numpy(), edges["_column"].to_numpy(),
+                                       edges["_row"].to_numpy()))]
+        return edges.reindex(columns=KGTK_FIELDNAMES).fillna("").reset_index(drop=True)
+
+
+def _take(fields: dict, positions: np.ndarray) -> dict:
+    return {name: value.iloc[positions].reset_index(drop=True) if isinstance(value, pd.Series) else value
+            for name, value in fields.items()}
+
+
+def _frame(columns: dict, rows: np.ndarray, column: int, order: int) -> pd.DataFrame:
+    frame = pd.DataFrame(columns, index=range(len(rows)))
+    frame["_row"], frame["_column"], frame["_order"] = rows, column, order
+    return frame
+
+
+def read_sheet(data_filepath: str) -> pd.DataFrame:
+    """
+    the csv sheet as t2wml loads it: strings, missing and blank cells as "". Raises UnsupportedSheet if a cell has
+    a tab or a line break since the kgtk file is written without quoting
+    """
+    with open(data_filepath, "rb") as f:
+        content = f.read()
+    df = pd.read_csv(io.BytesIO(content), header=None, dtype=str).fillna("").replace(r"^\s+$", "", regex=True)
+    if b"\t" in content or b"\r" in content or content.count(b"\n") != len(df):
+        raise UnsupportedSheet("Cells of {} with tabs or line breaks".format(os.path.basename(data_filepath)))
+    return df
+
+
+def run_native_t2wml(t2wml_script: dict, data_filepath: str, wikifier_filepath: str,
+                     properties_df: pd.DataFrame, output_path: str) -> bool:
+    """
+    Write the kgtk output t2wml would write for the canonical `t2wml_script` to `output_path`. Returns False,
+    without writing anything, when the script is not canonical or the sheet needs t2wml's own evaluation.
+    """
+    try:
+        template = _parse_template(t2wml_script)
+        engine = NativeT2WML(read_sheet(data_filepath), template,
+                             pd.read_csv(wikifier_filepath), property_types(properties_df),
+                             os.path.basename(data_filepath))
+        edges = engine.generate()
+    except UnsupportedSheet as e:
+        print("native t2wml: {}, running t2wml".format(e))
+        return False
+    edges.to_csv(output_path, sep="\t", index=False, quoting=csv.QUOTE_NONE)
+    return True
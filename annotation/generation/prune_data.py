@@ -0,0 +1,108 @@
+import typing
+import numpy as np
+import pandas as pd
+from annotation.schema import AnnotationSchema
+from annotation.generation.generate_t2wml import Role, Type, region_rows, with_region_rows
+
+
+class PruneReport(object):
+    """
+    Counts of the variable cells masked before running t2wml.
+    """
+
+    def __init__(self):
+        self.empty_cells = 0
+        self.non_numeric_cells = 0
+        self.duplicate_rows = 0
+        self.duplicate_cells = 0
+        self.trimmed_rows = 0
+
+    @property
+    def pruned_cells(self) -> int:
+        return self.non_numeric_cells + self.duplicate_cells
+
+    def to_dict(self) -> dict:
+        return {"empty_cells": self.empty_cells, "non_numeric_cells": self.non_numeric_cells,
+                "duplicate_rows": self.duplicate_rows, "duplicate_cells": self.duplicate_cells,
+                "pruned_cells": self.pruned_cells, "trimmed_rows": self.trimmed_rows}
+
+    def __str__(self):
+        return "masked {} variable cells ({} non numeric, {} of {} duplicate rows), {} were already empty, " \
+               "trimmed {} rows from the region".format(self.pruned_cells, self.non_numeric_cells,
+                                                        self.duplicate_cells, self.duplicate_rows, self.empty_cells,
+                                                        self.trimmed_rows)
+
+
+def _empty_mask(values: pd.DataFrame) -> np.ndarray:
+    return (values.isna() | values.astype(str).apply(lambda column: column.str.strip() == "")).to_numpy()
+
+
+def _non_numeric_mask(values: pd.DataFrame) -> np.ndarray:
+    # thousands separators and surrounding spaces are accepted by t2wml quantities
+    masks = [pd.to_numeric(values.iloc[:, i].astype(str).str.replace(",", "", regex=False).str.strip(),
+                           errors="coerce").isna().to_numpy() for i in range(values.shape[1])]
+    return np.column_stack(masks) if masks else np.zeros(values.shape, dtype=bool)
+
+
+def prune_sheet(sheet: pd.DataFrame, t2wml_script: dict, schema: AnnotationSchema = None) \
+        -> typing.Tuple[pd.DataFrame, dict, PruneReport]:
+    """
+    Mask the variable cells t2wml would evaluate for nothing: non numeric values in number columns and the
+    variable cells of rows duplicating an earlier data row. Masked cells are emptied in a copy of the sheet, so
+    the row and column numbering t2wml sees does not change. Rows with no variable value left at the start or end
+    of the statement region are trimmed from a copy of the script when its regions share numeric row bounds.
+
+    Returns the pruned sheet, the script to use with it and the report of what was pruned.
+    """
+    if schema is None:
+        schema = AnnotationSchema(sheet)
+    report = PruneReport()
+    variable_columns = list(schema.role_columns(Role.VARIABLE.value))
+    data_index = schema.data_index
+    if data_index is None or not variable_columns or data_index >= sheet.shape[0]:
+        return sheet, t2wml_script, report
+
+    data_part = sheet.iloc[data_index:]
+    values = data_part.iloc[:, variable_columns]
+    empty = _empty_mask(values)
+    report.empty_cells = int(empty.sum())
+
+    number_positions = [i for i, col in enumerate(variable_columns) if schema.types[col] == Type.NUMBER.value]
+    non_numeric = np.zeros(values.shape, dtype=bool)
+    if number_positions:
+        non_numeric[:, number_positions] = _non_numeric_mask(values.iloc[:, number_positions])
+        non_numeric &= ~empty
+    report.non_numeric_cells = int(non_numeric.sum())
+
+    # a row equal to an earlier data row in every column produces the same statements again
+    duplicated = data_part.astype(str).duplicated(keep="first").to_numpy()
+    report.duplicate_rows = int(duplicated.sum())
+    duplicate_cells = duplicated[:, None] & ~empty & ~non_numeric
+    report.duplicate_cells = int(duplicate_cells.sum())
+
+    masked = non_numeric | duplicate_cells
+    pruned_sheet = sheet
+    if masked.any():
+        pruned_sheet = sheet.copy()
+        for i, col in enumerate(variable_columns):
+            if masked[:, i].any():
+                rows = data_index + np.flatnonzero(masked[:, i])
+                pruned_sheet.iloc[rows, col] = ""
+
+    pruned_script = _trim_region(t2wml_script, ~(empty | masked), data_index, report)
+    return pruned_sheet, pruned_script, report
+
+
+def _trim_region(t2wml_script: dict, kept: np.ndarray, data_index: int, report: PruneReport) -> dict:
+    rows = region_rows(t2wml_script)
+    if rows is None:
+        return t2wml_script
+    top, bottom = rows
+
+    # region rows are 1 based, kept rows are relative to the data row
+    kept_rows = np.flatnonzero(kept.any(axis=1)) + data_index + 1
+    kept_rows = kept_rows[(kept_rows >= top) & (kept_rows <= bottom)]
+    if len(kept_rows) == 0 or (kept_rows[0] == top and kept_rows[-1] == bottom):
+        return t2wml_script
+    report.trimmed_rows = int((kept_rows[0] - top) + (bottom - kept_rows[-1]))
+    return with_region_rows(t2wml_script, int(kept_rows[0]), int(kept_rows[-1]))
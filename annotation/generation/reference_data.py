@@ -0,0 +1,188 @@
+import copy
+import csv
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import typing
+import pandas as pd
+
+# bump when the layout of the snapshot or the parsing of a source changes
+SNAPSHOT_VERSION = 2
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT_FILE = os.path.join(BASE_DIR, "reference_data.snapshot")
+
+
+def _read_json(path: str) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _read_code_map(path: str) -> dict:
+    code_map = {}
+    with open(path, "r") as fin:
+        for row in csv.reader(fin):
+            code_map[row[0]] = row[1]
+    return code_map
+
+
+# bundled reference files and how they are parsed from text
+SOURCES = {
+    "country_wikifier_cache.json": _read_json,
+    "country-wikifier.csv": pd.read_csv,
+    "datamart_schema_properties.tsv": lambda path: pd.read_csv(path, sep='\t', quoting=csv.QUOTE_NONE),
+    "ethiopia_census_code.csv": _read_code_map,
+    "region-ethiopia-exploded-edges.tsv": lambda path: pd.read_csv(path, sep='\t', quoting=csv.QUOTE_NONE),
+}
+
+_loaded = {}
+_snapshot = None
+_lock = threading.Lock()
+
+
+def _source_hash(name: str) -> str:
+    with open(os.path.join(BASE_DIR, name), "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _source_info(name: str) -> dict:
+    stat = os.stat(os.path.join(BASE_DIR, name))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": _source_hash(name)}
+
+
+def _write(content: dict, path: str) -> None:
+    # a temporary file of its own, several processes may refresh the snapshot at the same time
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                     dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _snapshot_key() -> tuple:
+    # pickled dataframes are only guaranteed to load with the pandas they were written with
+    return SNAPSHOT_VERSION, pd.__version__
+
+
+def load_text(name: str):
+    """
+    parse the reference file `name` from its text source
+    """
+    if name not in SOURCES:
+        raise ValueError("Unknown reference data `{}`, should be one of {}".format(name, list(SOURCES)))
+    return SOURCES[name](os.path.join(BASE_DIR, name))
+
+
+def build_snapshot(path: str = SNAPSHOT_FILE) -> str:
+    """
+    Compile every reference file into one binary snapshot at `path`, together with the size, modification time
+    and hash of each text source so that `load` notices when one of them changed.
+    """
+    content = {
+        "key": _snapshot_key(),
+        "sources": {name: _source_info(name) for name in SOURCES},
+        "data": {name: load_text(name) for name in SOURCES},
+    }
+    _write(content, path)
+    return path
+
+
+def _is_fresh(name: str, info: dict) -> typing.Tuple[bool, bool]:
+    """
+    Returns whether the snapshot entry of `name` is still valid, and whether the recorded modification time was
+    updated. A source is only hashed when its size is unchanged but its modification time is not, e.g. after a
+    checkout or an install.
+    """
+    try:
+        stat = os.stat(os.path.join(BASE_DIR, name))
+    except OSError:
+        # the text source is not installed, the snapshot is all there is
+        return True, False
+    if stat.st_size != info["size"]:
+        return False, False
+    if stat.st_mtime_ns == info["mtime_ns"]:
+        return True, False
+    if _source_hash(name) != info["sha1"]:
+        return False, False
+    info["mtime_ns"] = stat.st_mtime_ns
+    return True, True
+
+
+def load_snapshot(path: str = SNAPSHOT_FILE) -> dict:
+    """
+    Returns the entries of the snapshot at `path` whose text source did not change since it was built, an empty
+    dict if the snapshot is missing, unreadable or was built by another snapshot version or pandas version.
+    Sources found unchanged by hash are recorded with their new modification time, when `path` is writable.
+    """
+    try:
+        with open(path, "rb") as f:
+            content = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+        return {}
+    if not isinstance(content, dict) or content.get("key") != _snapshot_key():
+        return {}
+    data = {}
+    touched = False
+    for name, value in content["data"].items():
+        if name not in SOURCES or name not in content["sources"]:
+            continue
+        fresh, updated = _is_fresh(name, content["sources"][name])
+        if fresh:
+            data[name] = value
+        touched = touched or updated
+    if touched:
+        try:
+            _write(content, path)
+        except OSError:
+            pass
+    return data
+
+
+def load(name: str):
+    """
+    Returns a copy of the bundled reference data `name`, see SOURCES: a dict for the json / code map files and a
+    DataFrame for the others.
+
+    The snapshot built by `build_snapshot` is read once per process, entries whose text source changed since then
+    (and every entry when the snapshot is missing or stale) are parsed from text instead.
+    """
+    global _snapshot
+    with _lock:
+        if name not in _loaded:
+            if _snapshot is None:
+                _snapshot = load_snapshot()
+            if name in _snapshot:
+                _loaded[name] = _snapshot.pop(name)
+            else:
+                _loaded[name] = load_text(name)
+        value = _loaded[name]
+    # callers may modify what they get
+    return value.copy() if isinstance(value, pd.DataFrame) else copy.copy(value)
+
+
+def clear_cache() -> None:
+    global _snapshot
+    with _lock:
+        _loaded.clear()
+        _snapshot = None
+
+
+def load_file(path: typing.Optional[str], name: str):
+    """
+    `load(name)` if `path` is None or points to the bundled file, otherwise `path` parsed like the file `name`
+    """
+    if path is None or os.path.abspath(path) == os.path.join(BASE_DIR, name):
+        return load(name)
+    if name not in SOURCES:
+        raise ValueError("Unknown reference data `{}`, should be one of {}".format(name, list(SOURCES)))
+    return SOURCES[name](path)
+
+
+if __name__ == "__main__":
+    print("reference data snapshot written to {}".format(build_snapshot()))
@@ -0,0 +1,50 @@
+import collections
+import contextlib
+import typing
+from time import time
+
+
+class WikifierStats(object):
+    """
+    Counters and timers of a wikifier run, returned with the results by `DatamartCountryWikifier.wikify` and
+    `EthiopiaWikifier.produce` when called with `return_stats=True`.
+
+    Counter names are dotted, e.g. `lookup.exact_hit` or `table_linker.tl first query.rows`, timers are
+    in seconds. Stats of several runs can be combined with `merge`.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.seconds = collections.defaultdict(float)
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        s = time()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time() - s
+
+    def merge(self, other: 'WikifierStats') -> 'WikifierStats':
+        self.counters.update(other.counters)
+        for name, seconds in other.seconds.items():
+            self.seconds[name] += seconds
+        return self
+
+    def rate(self, name: str, *names: str) -> typing.Optional[float]:
+        """
+        share of the counter `name` in the sum of the counters `names`, None if they are all zero
+        """
+        total = sum(self.counters[each] for each in names)
+        return self.counters[name] / total if total else None
+
+    def to_dict(self) -> dict:
+        return {"counters": dict(sorted(self.counters.items())), "seconds": dict(sorted(self.seconds.items()))}
+
+    def __str__(self):
+        lines = ["{:<60}{:>10}".format(name, count) for name, count in sorted(self.counters.items())]
+        lines.extend("{:<60}{:>10.3f} seconds".format(name, seconds) for name, seconds in sorted(self.seconds.items()))
+        return "\n".join(lines)
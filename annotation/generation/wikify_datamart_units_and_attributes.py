@@ -2,12 +2,14 @@ import pandas as pd
 import os
 import string
 import csv
-import copy
 import typing
+import hashlib
+import threading
 
 from annotation.generation.annotation_to_template import run_wikifier as get_wikifier_result
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 """
 How to use:
@@ -35,6 +37,25 @@ Assume "Q-Node" column exist and it is the label column
 stop_punctuation = string.punctuation
 TRANSLATOR = str.maketrans(stop_punctuation, ' ' * len(stop_punctuation))
 
+REQUIRED_SHEET_NAME_CONFIG = {"dataset_file": "Dataset",
+                              "attributes_file": "Attributes",
+                              "units_file": "Units",
+                              "extra_edges": "Extra Edges"
+                              }
+OPTIONAL_SHEET_NAME_CONFIG = {"wikifier": "Wikifier",
+                              "qualifiers": "Qualifiers",
+                              "Wikifier_t2wml": "Wikifier_t2wml",
+                              "Wikifier Columns": "Wikifier Columns"
+                              }
+
+# columns of the t2wml wikifier file
+WIKIFIER_COLUMNS = ["column", "row", "value", "context", "item"]
+
+# parsed sheets of recently loaded workbooks, keyed by the content hash of the file and the requested sheets
+WORKBOOK_CACHE_SIZE = 16
+_workbook_cache = OrderedDict()
+_workbook_cache_lock = threading.Lock()
+
 
 # deprecated! not use
 def load_csvs(dataset_file: str, attributes_file: str, units_file: str):
@@ -49,32 +70,61 @@ def load_csvs(dataset_file: str, attributes_file: str, units_file: str):
     return loaded_file
 
 
-def load_xlsx(input_file: str, sheet_name_config: dict = None):
+def file_hash(file_path: str) -> str:
+    hash_generator = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hash_generator.update(chunk)
+    return hash_generator.hexdigest()
+
+
+def read_workbook(input_file: str, sheet_names: typing.List[str] = None, header=0,
+                  use_cache: bool = False) -> typing.Tuple[typing.List[str], typing.Dict[str, pd.DataFrame]]:
+    """
+    Open the workbook once and parse the requested sheets (all of them if not given) from that handle, sheets not
+    in the workbook are skipped. Returns the sheet names of the workbook and the parsed sheets.
+    With `use_cache`, parsed sheets are kept by file content hash so loading an unchanged workbook again is free,
+    copies are returned so the cached sheets can not be modified by the caller.
+    """
+    key = None
+    if use_cache:
+        key = (file_hash(input_file), None if sheet_names is None else tuple(sheet_names), header)
+        with _workbook_cache_lock:
+            if key in _workbook_cache:
+                _workbook_cache.move_to_end(key)
+                all_sheet_names, sheets = _workbook_cache[key]
+                return list(all_sheet_names), {k: v.copy() for k, v in sheets.items()}
+
+    with pd.ExcelFile(input_file) as xl:
+        all_sheet_names = xl.sheet_names
+        wanted = all_sheet_names if sheet_names is None else [each for each in sheet_names if each in all_sheet_names]
+        sheets = {each: xl.parse(each, header=header) for each in wanted}
+
+    if use_cache:
+        with _workbook_cache_lock:
+            _workbook_cache[key] = (list(all_sheet_names), {k: v.copy() for k, v in sheets.items()})
+            while len(_workbook_cache) > WORKBOOK_CACHE_SIZE:
+                _workbook_cache.popitem(last=False)
+    return all_sheet_names, sheets
+
+
+def load_xlsx(input_file: str, sheet_name_config: dict = None, use_cache: bool = False):
+    """
+    load the template sheets, the workbook is opened and parsed only once, see `read_workbook` for `use_cache`
+    """
     loaded_file = {}
-    sheet_names = pd.ExcelFile(input_file).sheet_names
     if not sheet_name_config:
-        sheet_name_config = {"dataset_file": "Dataset",
-                             "attributes_file": "Attributes",
-                             "units_file": "Units",
-                             "extra_edges": "Extra Edges"
-                             }
+        sheet_name_config = REQUIRED_SHEET_NAME_CONFIG
+    sheet_names, sheets = read_workbook(input_file,
+                                        list(sheet_name_config.values()) + list(OPTIONAL_SHEET_NAME_CONFIG.values()),
+                                        use_cache=use_cache)
     for k, v in sheet_name_config.items():
         if v not in sheet_names:
             raise ValueError("Sheet name {} used for {} does not found!".format(v, k))
-        loaded_file[k] = pd.read_excel(input_file, v)
-
-    optional_sheet_name_config = {
-        "wikifier": "Wikifier",
-        "qualifiers": "Qualifiers",
-        "Wikifier_t2wml": "Wikifier_t2wml",
-        "Wikifier Columns": "Wikifier Columns"
-    }
-    for k, v in optional_sheet_name_config.items():
-        if v not in sheet_names:
-            loaded_sheet = None
-        else:
-            loaded_sheet = pd.read_excel(input_file, v)
-        loaded_file[k] = loaded_sheet
+        loaded_file[k] = sheets[v]
+
+    for k, v in OPTIONAL_SHEET_NAME_CONFIG.items():
+        loaded_file[k] = sheets.get(v)
 
     return loaded_file
 
@@ -444,11 +494,8 @@ def _generate_dataset_file(input_df: pd.DataFrame):
     Qaid-security	P1813	    aid-security	        aid-security-P1813
     :return:
     """
-    output_df = copy.deepcopy(input_df)
-    ids = []
-    for _, each_row in output_df.iterrows():
-        ids.append("{}-{}".format(each_row["dataset"], each_row["label"]))
-    output_df['id'] = ids
+    ids = ["{}-{}".format(dataset, label) for dataset, label in zip(input_df["dataset"], input_df["label"])]
+    output_df = input_df.assign(id=ids)
 
     # Assume the the first column are already Q nodes
     # output_df["dataset"] = output_df['dataset'].apply(lambda x: "Q" + x)
@@ -472,29 +519,35 @@ def _generate_extra_edges_file(input_df: pd.DataFrame, memo: dict):
     return output_df
 
 
-# update 2020.7.24, add support of run wikifier and record t2wml wikifier file in template
-def run_wikifier(input_folder_path: str, wikifier_columns_df: pd.DataFrame, template_output_path: str):
-    """
-    run wikifier on all table files(csv, xlsx, xls) and add the new wikifier results to "wikifier.csv" file
-    :param input_folder_path:
-    :param wikifier_columns_df:
-    :param template_output_path:
-    :return:
-    """
-    new_wikifier_df_list = []
-    input_data = []
-
-    for each_file in os.listdir(input_folder_path):
+def _list_table_files(input_folder_path: str) -> typing.Iterator[str]:
+    for each_file in sorted(os.listdir(input_folder_path)):
         if each_file.startswith("~") or each_file.startswith("."):
             continue
+        if each_file.endswith(".csv") or each_file.endswith(".xlsx") or each_file.endswith("xls"):
+            yield os.path.join(input_folder_path, each_file)
+
 
-        each_file = os.path.join(input_folder_path, each_file)
-        if each_file.endswith(".csv"):
-            input_data.append(pd.read_csv(each_file, header=None))
-        elif each_file.endswith(".xlsx") or each_file.endswith("xls"):
-            for each_sheet in get_sheet_names(each_file):
-                input_data.append(pd.read_excel(each_file, each_sheet, header=None))
+def _wikifier_key(row: dict) -> tuple:
+    # t2wml looks a cell up by column/row before its value, and the same value may have several contexts
+    return tuple("" if pd.isna(row.get(each)) else str(row.get(each)) for each in ("column", "row", "value", "context"))
 
+
+def _wikify_file(file_path: str, wikifier_columns_df: pd.DataFrame,
+                 known_values: frozenset) -> typing.List[typing.Tuple[typing.List[dict], typing.List[dict]]]:
+    """
+    run the country wikifier and then the ethiopia wikifier on the remaining values of every sheet of the file,
+    values in `known_values` (already wikified in other files) are not sent to the ethiopia wikifier again.
+    return the (country results, ethiopia results) of every wikified part in order, `known_values` may miss
+    values of files still running so the ethiopia results are filtered again by `_merge_wikified_parts`
+    """
+    if file_path.endswith(".csv"):
+        input_data = [pd.read_csv(file_path, header=None)]
+    else:
+        _, sheets = read_workbook(file_path, header=None)
+        input_data = sheets.values()
+
+    results = []
+    wikified_values = set(known_values)
     for each_df in input_data:
         each_df = each_df.fillna("")
 
@@ -513,23 +566,104 @@ def run_wikifier(input_folder_path: str, wikifier_columns_df: pd.DataFrame, temp
                       format(target_column_number, end_row, each_df.shape))
                 continue
 
-            each_df = each_df.iloc[start_row:end_row, :]
+            part_df = each_df.iloc[start_row:end_row, :]
             # run wikifier
-            new_wikifier_df_list.extend(get_wikifier_result(input_df=each_df, target_col=target_column_number,
-                                                            wikifier_type="country"))
-            wikified_values = set([each["value"] for each in new_wikifier_df_list])
-            remained_df_part = each_df[~each_df.iloc[:, target_column_number].isin(wikified_values)]
-            new_wikifier_df_list.extend(get_wikifier_result(input_df=remained_df_part, target_col=target_column_number,
-                                                            wikifier_type="ethiopia"))
-
-    new_wikifier_df = pd.DataFrame(new_wikifier_df_list)
-    # combine the previous wikifier file if exists
-    output_wikifier_file_path = os.path.join(template_output_path, "wikifier.csv")
-    if os.path.exists(output_wikifier_file_path):
-        new_wikifier_df = pd.concat([pd.read_csv(output_wikifier_file_path), new_wikifier_df])
+            country_results = get_wikifier_result(input_df=part_df, target_col=target_column_number,
+                                                  wikifier_type="country")
+            wikified_values.update(each["value"] for each in country_results)
+            remained_df_part = part_df[~part_df.iloc[:, target_column_number].isin(wikified_values)]
+            ethiopia_results = get_wikifier_result(input_df=remained_df_part, target_col=target_column_number,
+                                                   wikifier_type="ethiopia")
+            results.append((country_results, ethiopia_results))
+            wikified_values.update(each["value"] for each in ethiopia_results)
+    return results
+
+
+def _merge_wikified_parts(parts: typing.List[typing.Tuple[typing.List[dict], typing.List[dict]]],
+                          wikified_values: set) -> typing.List[dict]:
+    """
+    merge the parts of `_wikify_file` against the values wikified so far and update `wikified_values`,
+    an ethiopia result is dropped if its value was already wikified, the same as running the files one by one
+    """
+    results = []
+    for country_results, ethiopia_results in parts:
+        results.extend(country_results)
+        wikified_values.update(each["value"] for each in country_results)
+        ethiopia_results = [each for each in ethiopia_results if each["value"] not in wikified_values]
+        results.extend(ethiopia_results)
+        wikified_values.update(each["value"] for each in ethiopia_results)
+    return results
+
 
-    # save to disk
-    new_wikifier_df.to_csv(output_wikifier_file_path, index=False)
+# update 2020.7.24, add support of run wikifier and record t2wml wikifier file in template
+def run_wikifier(input_folder_path: str, wikifier_columns_df: pd.DataFrame, template_output_path: str,
+                 workers: int = None):
+    """
+    run wikifier on all table files(csv, xlsx, xls) and add the new wikifier results to "wikifier.csv" file
+    files are wikified in parallel worker processes, at most `workers` of them are loaded at a time and their
+    results are appended to "wikifier.csv" as soon as they are done (in folder order), so memory use does not
+    depend on the folder size. The results are merged in folder order, so the file is the same as wikifying the
+    files one by one: values already wikified in a previous file are not kept from the ethiopia wikifier again,
+    and a row is only left out when the same (column, row, value, context) is already written.
+    :param input_folder_path:
+    :param wikifier_columns_df:
+    :param template_output_path:
+    :param workers: number of worker processes, default to the number of cpus
+    :return:
+    """
+    workers = workers or os.cpu_count()
+    output_wikifier_file_path = os.path.join(template_output_path, "wikifier.csv")
+    wikified_values = set()
+    written_keys = set()
+    # keep the columns of a previous wikifier file if exists
+    fieldnames = WIKIFIER_COLUMNS
+    if os.path.exists(output_wikifier_file_path) and os.path.getsize(output_wikifier_file_path) > 0:
+        previous_df = pd.read_csv(output_wikifier_file_path, dtype=object)
+        fieldnames = list(previous_df.columns)
+        if "value" in previous_df.columns:
+            wikified_values.update(previous_df["value"].dropna())
+        written_keys.update(_wikifier_key(each) for each in previous_df.to_dict("records"))
+        del previous_df
+        write_header = False
+    else:
+        write_header = True
+
+    with open(output_wikifier_file_path, "a", newline="") as f, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+        pending = deque()
+        files = _list_table_files(input_folder_path)
+
+        def submit_next() -> bool:
+            each_file = next(files, None)
+            if each_file is None:
+                return False
+            pending.append((each_file, executor.submit(_wikify_file, each_file, wikifier_columns_df,
+                                                       frozenset(wikified_values))))
+            return True
+
+        # keep at most `workers` files in flight so only a bounded number of them is in memory
+        while len(pending) < workers and submit_next():
+            pass
+        while pending:
+            each_file, future = pending.popleft()
+            try:
+                parts = future.result()
+            except Exception as e:
+                raise ValueError("Running wikifier on {} failed!".format(each_file)) from e
+            # merged in folder order, so the result does not depend on which worker finishes first
+            new_results = []
+            for each in _merge_wikified_parts(parts, wikified_values):
+                key = _wikifier_key(each)
+                if key not in written_keys:
+                    written_keys.add(key)
+                    new_results.append(each)
+            writer.writerows(new_results)
+            f.flush()
+            print("wikified {}: {} new rows".format(each_file, len(new_results)))
+            submit_next()
 
 
 def get_short_name(short_name_memo, input_str):
@@ -566,20 +700,20 @@ def get_sheet_names(file_path):
     return xl.sheet_names
 
 
-def _update_double_quotes(each_series):
-    each_series["node2"] = to_kgtk_format_string(each_series["node2"])
-    return each_series
-
-
 def _check_double_quotes(input_df: pd.DataFrame, label_types=None, check_content_startswith: bool = False):
-    output_df = input_df.copy()
+    # only node2 changes, it is rebuilt on its own instead of copying the frame and applying over every row
+    node2 = input_df["node2"]
     if label_types is not None:
-        output_df = output_df.apply(lambda x: _update_double_quotes(x) if x["label"] in set(label_types) else x, axis=1)
+        mask = input_df["label"].isin(set(label_types)).to_numpy()
+        if mask.any():
+            values = node2.to_numpy(dtype=object, copy=True)
+            values[mask] = [to_kgtk_format_string(each) for each in values[mask]]
+            node2 = pd.Series(values, index=node2.index, name="node2")
 
     if check_content_startswith:
-        output_df["node2"] = output_df['node2'].apply(
+        node2 = node2.map(
             lambda x: to_kgtk_format_string(x) if not x.startswith("Q") and not x.startswith("P") and not x.startswith("^") else x)
-    return output_df
+    return input_df.assign(node2=node2)
 
 
 def _generate_p_nodes(role: str, dataset_q_node: str, node_number: int, memo: dict, node_name: str):
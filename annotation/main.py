@@ -1,41 +1,141 @@
 import pandas as pd
-import tempfile, yaml
+import contextlib, os, tempfile, yaml
 from annotation.generation.generate_t2wml import ToT2WML
 from annotation.generation.generate_kgtk import GenerateKgtk
+from annotation.generation.generate_t2wml_files import run_blocking
 from annotation.validation.validate_annotation import ValidateAnnotation
+from annotation.schema import AnnotationSchema
+from annotation.memory_report import MemoryReport, stage as memory_stage
+from annotation.profiler import StageProfiler, profiling_enabled, stage as profile_stage
+from annotation.metrics import PipelineMetrics, stage as metrics_stage
 from t2wml.input_processing.yaml_parsing import validate_yaml
 
+# the debug artifacts of a conversion without a debug folder go to a new folder here
+DEBUG_ROOT = '/tmp'
+
+
+@contextlib.contextmanager
+def _stage(memory_report: MemoryReport, profiler: StageProfiler, metrics: PipelineMetrics, name: str):
+    with memory_stage(memory_report, name), profile_stage(profiler, name), metrics_stage(metrics, name):
+        yield
+
+
+@contextlib.contextmanager
+def _count_conversion(metrics: PipelineMetrics):
+    if metrics is None:
+        yield
+        return
+    try:
+        yield
+    except BaseException:
+        metrics.inc("conversions_total", status="failure")
+        raise
+    metrics.inc("conversions_total", status="success")
+
+
 class T2WMLAnnotation(object):
     def __init__(self):
         self.va = ValidateAnnotation()
 
-    def process(self, dataset_qnode, df, rename_columns, extra_files=False, t2wml_yaml: str=None):
+    def process(self, dataset_qnode, df, rename_columns, extra_files=False, t2wml_yaml: str=None,
+                schema: AnnotationSchema = None, memory_report: MemoryReport = None, debug_format: str = 'xlsx',
+                profile: bool = None, metrics: PipelineMetrics = None, debug_dir: str = None):
+        """
+        debug_dir: folder the debug artifacts of the conversion are saved to, use a distinct folder for each
+        conversion running at the same time. Defaults to a new `t2wml-annotation-debug-*` folder under /tmp
+        profile: each stage is profiled into `profiles/<dataset_id>` of the debug folder if True, see
+        `profiler.StageProfiler`. Defaults to the T2WML_ANNOTATION_PROFILE environment variable
+        metrics: if given, the outcome, volumes and stage latencies of the conversion are recorded in it
+        """
+        with _count_conversion(metrics):
+            t2wml_yaml, gk = self._generate_kgtk(dataset_qnode, df, rename_columns, t2wml_yaml, schema,
+                                                 memory_report, debug_format, profile, metrics, debug_dir)
+
+            try:
+                if extra_files:
+                    return self._extra_files(t2wml_yaml, gk)
+
+                with _stage(memory_report, gk.profiler, metrics, "generate_edges_df"):
+                    kgtk_exploded_df = gk.generate_edges_df()
+            finally:
+                # the debug artifacts are written in the background, the result does not wait on them
+                gk.close(wait=False)
+
+        variable_ids = gk.get_variable_ids()
+
+        return variable_ids, kgtk_exploded_df
+
+    async def process_async(self, dataset_qnode, df, rename_columns, extra_files=False, t2wml_yaml: str=None,
+                            schema: AnnotationSchema = None, memory_report: MemoryReport = None,
+                            debug_format: str = 'xlsx', profile: bool = None, metrics: PipelineMetrics = None,
+                            debug_dir: str = None):
+        """
+        asyncio version of process. The in process stages run in the default executor and the kgtk commands are
+        awaited as child processes, cancelling the awaiting task kills the running children.
+        """
+        with _count_conversion(metrics):
+            t2wml_yaml, gk = await run_blocking(self._generate_kgtk, dataset_qnode, df, rename_columns, t2wml_yaml,
+                                                schema, memory_report, debug_format, profile, metrics, debug_dir)
+
+            try:
+                if extra_files:
+                    return await run_blocking(self._extra_files, t2wml_yaml, gk)
+
+                with memory_stage(memory_report, "generate_edges_df"), metrics_stage(metrics, "generate_edges_df"):
+                    kgtk_exploded_df = await gk.generate_edges_df_async()
+            finally:
+                # the debug artifacts are written in the background, the result does not wait on them
+                gk.close(wait=False)
+
+        variable_ids = gk.get_variable_ids()
+
+        return variable_ids, kgtk_exploded_df
+
+    @staticmethod
+    def _generate_kgtk(dataset_qnode, df, rename_columns, t2wml_yaml: str, schema: AnnotationSchema,
+                       memory_report: MemoryReport, debug_format: str, profile: bool, metrics: PipelineMetrics,
+                       debug_dir: str):
         for rn in rename_columns:
             df.iloc[rn[0], rn[1]] = rn[2]
 
+        # a debug folder per conversion so concurrent conversions do not overwrite each other's artifacts
+        if debug_dir is None:
+            debug_dir = tempfile.mkdtemp(prefix='t2wml-annotation-debug-', dir=DEBUG_ROOT)
+        profile = profiling_enabled(profile)
+        profiler = None
+        if profile:
+            # same dataset id as GenerateKgtk, an empty dataset cell reads as NaN
+            dataset_id = df.iloc[0, 1]
+            if pd.isna(dataset_id) or not dataset_id:
+                dataset_id = dataset_qnode[1:]
+            profiler = StageProfiler(os.path.join(debug_dir, 'profiles', dataset_id))
+
+        # parse the annotation once and share it, a schema from validation only needs the renames applied
+        if schema is None:
+            schema = AnnotationSchema(df)
+        else:
+            schema = schema.renamed(rename_columns)
+
         if not t2wml_yaml:
             # get the t2wml yaml file
-            to_t2wml = ToT2WML(df, dataset_qnode=dataset_qnode)
-            t2wml_yaml_dict = to_t2wml.get_dict()
-            t2wml_yaml = to_t2wml.get_yaml()
+            with _stage(memory_report, profiler, metrics, "t2wml yaml"):
+                to_t2wml = ToT2WML(df, dataset_qnode=dataset_qnode, schema=schema)
+                t2wml_yaml_dict = to_t2wml.get_dict()
+                t2wml_yaml = to_t2wml.get_yaml()
         else:
             with tempfile.NamedTemporaryFile(suffix=".yaml") as temp_yaml_file:
                 temp_yaml_file.write(str.encode(t2wml_yaml))
                 temp_yaml_file.seek(0)
                 t2wml_yaml_dict = validate_yaml(temp_yaml_file.name)
 
-        gk = GenerateKgtk(df, t2wml_yaml_dict, dataset_qnode=dataset_qnode, debug=True, debug_dir='/tmp')
-
-        combined_item_def_df = pd.concat(
-            [gk.output_df_dict[filename] for filename in gk.output_df_dict.keys() if filename.endswith('.tsv')])
+        with _stage(memory_report, profiler, metrics, "GenerateKgtk"):
+            gk = GenerateKgtk(df, t2wml_yaml_dict, dataset_qnode=dataset_qnode, debug=True, debug_dir=debug_dir,
+                              schema=schema, memory_report=memory_report, debug_format=debug_format,
+                              profile=profile, profiler=profiler, metrics=metrics)
+        return t2wml_yaml, gk
 
+    @staticmethod
+    def _extra_files(t2wml_yaml: str, gk: GenerateKgtk):
+        combined_item_def_df = gk.get_metadata_df(include_schema_properties=True)
         consolidated_wikifier_df = pd.concat([gk.constant_wikikifer_df, gk.output_df_dict["wikifier.csv"]])
-
-        if extra_files:
-            return t2wml_yaml, combined_item_def_df, consolidated_wikifier_df
-
-        kgtk_exploded_df = gk.generate_edges_df()
-
-        variable_ids = gk.get_variable_ids()
-
-        return variable_ids, kgtk_exploded_df
+        return t2wml_yaml, combined_item_def_df, consolidated_wikifier_df
@@ -0,0 +1,171 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import tracemalloc
+import typing
+from time import time
+
+# interval between two resident set size samples while a stage is running
+RSS_SAMPLE_SECONDS = 0.01
+# number of allocation sites kept per stage
+TOP_ALLOCATIONS = 10
+
+
+def current_rss() -> int:
+    """
+    Resident set size of this process in bytes, falls back to the lifetime peak when /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return _max_rss(resource.RUSAGE_SELF)
+
+
+def _max_rss(who) -> int:
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    # leave out the allocations of tracemalloc itself
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+class _Stage(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time()
+        self.rss_start = current_rss()
+        self.rss_peak = self.rss_start
+        self.traced_start = tracemalloc.get_traced_memory()[0]
+        self.traced_peak = self.traced_start
+        self.children_max_rss_start = _max_rss(resource.RUSAGE_CHILDREN)
+        self.snapshot = _take_snapshot()
+
+
+class MemoryReport(object):
+    """
+    Opt-in memory instrumentation of named pipeline stages.
+
+    For every stage it records the peak resident set size (sampled on a background thread), the tracemalloc peak
+    over the memory traced when the stage started, the allocation sites that grew the most, and the peak RSS of
+    child processes (kgtk, tl) if one of them went above every child before it. Stages may be nested, each one
+    reports its own peak including its sub stages.
+
+    Use `stage(report, name)` in the pipeline so that nothing is measured when no report is given, and
+    `to_dict` / `save` to get the machine readable report.
+    """
+
+    def __init__(self, top_allocations: int = TOP_ALLOCATIONS, frames: int = 1):
+        self.top_allocations = top_allocations
+        self.frames = frames
+        self.stages = []
+        self._stack = []
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._started_tracemalloc = False
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        self._enter()
+        parent = self._stack[-1] if self._stack else None
+        if parent is not None:
+            # keep the peak the parent reached so far before the peak is reset for this stage
+            parent.traced_peak = max(parent.traced_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        current = _Stage(name)
+        with self._lock:
+            self._stack.append(current)
+        try:
+            yield current
+        finally:
+            traced_end, traced_peak = tracemalloc.get_traced_memory()
+            current.traced_peak = max(current.traced_peak, traced_peak)
+            rss_end = current_rss()
+            with self._lock:
+                self._stack.pop()
+                current.rss_peak = max(current.rss_peak, rss_end)
+                if parent is not None:
+                    parent.traced_peak = max(parent.traced_peak, current.traced_peak)
+                    parent.rss_peak = max(parent.rss_peak, current.rss_peak)
+            tracemalloc.reset_peak()
+            self.stages.append(self._record(current, traced_end, rss_end))
+            self._exit()
+
+    def _record(self, current: _Stage, traced_end: int, rss_end: int) -> dict:
+        children_max_rss = _max_rss(resource.RUSAGE_CHILDREN)
+        top = _take_snapshot().compare_to(current.snapshot, "lineno")
+        return {
+            "stage": current.name,
+            "seconds": time() - current.start,
+            "rss_start_bytes": current.rss_start,
+            "rss_peak_bytes": current.rss_peak,
+            "rss_end_bytes": rss_end,
+            "rss_peak_delta_bytes": current.rss_peak - current.rss_start,
+            "traced_peak_delta_bytes": current.traced_peak - current.traced_start,
+            "traced_end_delta_bytes": traced_end - current.traced_start,
+            "children_peak_rss_bytes":
+                children_max_rss if children_max_rss > current.children_max_rss_start else None,
+            "top_allocations": [{
+                "location": "{}:{}".format(each.traceback[0].filename, each.traceback[0].lineno),
+                "size_delta_bytes": each.size_diff,
+                "count_delta": each.count_diff,
+            } for each in top[:self.top_allocations] if each.size_diff > 0],
+        }
+
+    def _enter(self):
+        if not self._stack:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self._started_tracemalloc = True
+            self._sampler = _RssSampler(self)
+            self._sampler.start()
+
+    def _exit(self):
+        if not self._stack:
+            self._sampler.stop()
+            self._sampler = None
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+
+    def _sample(self, rss: int):
+        with self._lock:
+            for each in self._stack:
+                each.rss_peak = max(each.rss_peak, rss)
+
+    def to_dict(self) -> dict:
+        return {"pid": os.getpid(), "stages": list(self.stages)}
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class _RssSampler(threading.Thread):
+    def __init__(self, report: MemoryReport):
+        super().__init__(daemon=True)
+        self.report = report
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(RSS_SAMPLE_SECONDS):
+            self.report._sample(current_rss())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def stage(report: typing.Optional[MemoryReport], name: str):
+    """
+    Context manager measuring `name` in the report, does nothing if no report is given.
+    """
+    if report is None:
+        return contextlib.nullcontext()
+    return report.stage(name)
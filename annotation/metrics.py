@@ -0,0 +1,176 @@
+import bisect
+import contextlib
+import os
+import tempfile
+import threading
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+# upper bounds of the latency buckets in seconds
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+# upper bounds of the volume buckets (rows, columns, statements, edges)
+VOLUME_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+# name: (type, help, buckets)
+METRICS = {
+    "conversions_total": ("counter", "Conversions by outcome", None),
+    "stage_failures_total": ("counter", "Pipeline stages that raised", None),
+    "stage_seconds": ("histogram", "Wall time of the pipeline stages", SECONDS_BUCKETS),
+    "data_rows": ("histogram", "Rows in the data block of a converted sheet", VOLUME_BUCKETS),
+    "variable_columns": ("histogram", "Variable columns of a converted sheet", VOLUME_BUCKETS),
+    "qualifier_columns": ("histogram", "Qualifier columns of a converted sheet", VOLUME_BUCKETS),
+    "t2wml_statements": ("histogram", "KGTK rows produced by t2wml for a sheet", VOLUME_BUCKETS),
+    "exploded_edges": ("histogram", "Edges after kgtk explode for a sheet", VOLUME_BUCKETS),
+    "wikifier_rows": ("histogram", "Wikifier rows generated from the template of a sheet", VOLUME_BUCKETS),
+    "wikifier_events_total": ("counter", "Wikifier lookups, candidates and tl rows by WikifierStats counter", None),
+}
+
+
+class _Histogram(object):
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PipelineMetrics(object):
+    """
+    Counters and histograms of the conversions, see METRICS for what is recorded. Each conversion observes its
+    volumes once, so the `_sum` of a volume histogram is the total over all conversions and its buckets give the
+    distribution per conversion.
+
+    Export them with `to_prometheus` (text exposition format), `write` (e.g. for the node exporter textfile
+    collector) or `serve` (a local /metrics endpoint). One instance may be shared by concurrent conversions.
+    """
+
+    def __init__(self, prefix: str = "t2wml_annotation"):
+        self.prefix = prefix
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, "counter", labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, "histogram", labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = _Histogram(METRICS[name][2])
+            self._values[key].observe(value)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        s = time()
+        try:
+            yield
+        except BaseException:
+            self.inc("stage_failures_total", stage=name)
+            raise
+        finally:
+            self.observe("stage_seconds", time() - s, stage=name)
+
+    @staticmethod
+    def _key(name: str, metric_type: str, labels: dict) -> tuple:
+        if name not in METRICS or METRICS[name][0] != metric_type:
+            raise ValueError("Unknown {} `{}`".format(metric_type, name))
+        return name, tuple(sorted(labels.items()))
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            values = sorted((key, value if isinstance(value, (int, float)) else _copy_histogram(value))
+                            for key, value in self._values.items())
+        lines = []
+        for name, (metric_type, help_text, _) in METRICS.items():
+            samples = [(labels, value) for (each, labels), value in values if each == name]
+            if not samples:
+                continue
+            full_name = "{}_{}".format(self.prefix, name)
+            lines.append("# HELP {} {}".format(full_name, help_text))
+            lines.append("# TYPE {} {}".format(full_name, metric_type))
+            for labels, value in samples:
+                if metric_type == "counter":
+                    lines.append("{}{} {}".format(full_name, _labels(labels), _number(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets + (float("inf"),), value.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _number(bound)
+                    lines.append("{}_bucket{} {}".format(full_name, _labels(labels + (("le", le),)), cumulative))
+                lines.append("{}_sum{} {}".format(full_name, _labels(labels), _number(value.sum)))
+                lines.append("{}_count{} {}".format(full_name, _labels(labels), value.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        write the metrics to `path`, replaced atomically so that a collector never reads a partial file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as f:
+            f.write(self.to_prometheus())
+        os.replace(f.name, path)
+
+    def serve(self, port: int = 9464, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """
+        serve the metrics at http://<host>:<port>/metrics from a daemon thread, call `shutdown` on the returned
+        server to stop it
+        """
+        metrics = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), _Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def _copy_histogram(histogram: _Histogram) -> _Histogram:
+    copied = _Histogram(histogram.buckets)
+    copied.counts = list(histogram.counts)
+    copied.sum = histogram.sum
+    copied.count = histogram.count
+    return copied
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, _escape(value)) for key, value in labels) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def stage(metrics: typing.Optional[PipelineMetrics], name: str):
+    """
+    Context manager timing `name` in the metrics, does nothing if no metrics are given.
+    """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name)
@@ -0,0 +1,152 @@
+import cProfile
+import collections
+import contextlib
+import os
+import re
+import sys
+import threading
+import typing
+
+# set to anything but "" or "0" to profile the stages of every conversion
+PROFILE_ENV = "T2WML_ANNOTATION_PROFILE"
+# interval between two stack samples while a stage is running
+SAMPLE_SECONDS = 0.005
+
+
+def profiling_enabled(profile: bool = None) -> bool:
+    """
+    `profile` if given, otherwise whether the T2WML_ANNOTATION_PROFILE environment variable is set
+    """
+    if profile is not None:
+        return profile
+    return os.getenv(PROFILE_ENV, "") not in ("", "0")
+
+
+class _Stage(object):
+    def __init__(self, name: str, index: int):
+        self.name = name
+        self.index = index
+        self.profile = cProfile.Profile()
+        self.profiling = False
+        self.samples = collections.Counter()
+
+    def enable(self):
+        try:
+            self.profile.enable()
+            self.profiling = True
+        except ValueError:
+            # python >= 3.12 allows a single active profiler per process, a stage running in another thread has it
+            self.profiling = False
+
+    def disable(self):
+        if self.profiling:
+            self.profile.disable()
+            self.profiling = False
+
+
+class StageProfiler(object):
+    """
+    Opt-in profiling of named pipeline stages.
+
+    Every stage is run under cProfile and its stack is sampled on a background thread. When it ends the stage
+    writes `<index>-<stage>.pstats` (load it with pstats or snakeviz) and `<index>-<stage>.collapsed`, the sampled
+    stacks in the collapsed format of flamegraph.pl / speedscope, to `output_dir`. Stages may be nested, each one
+    is profiled without its sub stages. Stages in other threads are sampled, but python >= 3.12 runs cProfile in
+    one of them at a time, the others only get the collapsed stacks.
+
+    Use `stage(profiler, name)` in the pipeline so that nothing is profiled when no profiler is given.
+    """
+
+    def __init__(self, output_dir: str, sample_seconds: float = SAMPLE_SECONDS):
+        self.output_dir = output_dir
+        self.sample_seconds = sample_seconds
+        self.files = []
+        self._active = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._count += 1
+            current = _Stage(name, self._count)
+            stack = self._active.setdefault(thread_id, [])
+            parent = stack[-1] if stack else None
+            stack.append(current)
+            if self._sampler is None:
+                self._sampler = _StackSampler(self)
+                self._sampler.start()
+        if parent is not None:
+            parent.disable()
+        current.enable()
+        try:
+            yield current
+        finally:
+            current.disable()
+            if parent is not None:
+                parent.enable()
+            with self._lock:
+                stack.pop()
+                if not stack:
+                    del self._active[thread_id]
+                sampler = self._sampler if not self._active else None
+                if sampler is not None:
+                    self._sampler = None
+            if sampler is not None:
+                sampler.stop()
+            self._save(current)
+
+    def _save(self, current: _Stage) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, "{:02d}-{}".format(current.index,
+                                                                 re.sub(r"[^\w.-]+", "-", current.name)))
+        current.profile.create_stats()
+        if current.profile.stats:
+            current.profile.dump_stats(prefix + ".pstats")
+            self.files.append(prefix + ".pstats")
+        with open(prefix + ".collapsed", "w") as f:
+            for stack, count in sorted(current.samples.items()):
+                f.write("{} {}\n".format(stack, count))
+        self.files.append(prefix + ".collapsed")
+
+    def _sample(self, frames: dict) -> None:
+        with self._lock:
+            for thread_id, stack in self._active.items():
+                frame = frames.get(thread_id)
+                if frame is not None and stack:
+                    stack[-1].samples[_collapse(frame)] += 1
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class _StackSampler(threading.Thread):
+    def __init__(self, profiler: StageProfiler):
+        super().__init__(daemon=True)
+        self.profiler = profiler
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.profiler.sample_seconds):
+            self.profiler._sample(sys._current_frames())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def stage(profiler: typing.Optional[StageProfiler], name: str):
+    """
+    Context manager profiling `name`, does nothing if no profiler is given.
+    """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
@@ -0,0 +1,198 @@
+import itertools
+import string
+import typing
+import pandas as pd
+from types import MappingProxyType
+from annotation.utility import Category
+
+# rows of the annotation block, in the order they appear in column A of a well formed sheet
+ANNOTATION_ROWS = [Category.DATASET, Category.ROLE, Category.TYPE, Category.DESCRIPTION, Category.NAME,
+                   Category.UNIT, Category.TAG]
+# per-column tables kept by the schema; header has no fixed position so it has no fallback row
+TABLE_CATEGORIES = ANNOTATION_ROWS[1:] + [Category.HEADER]
+CATEGORY_VALUES = [category.value for category in Category]
+
+
+def column_letters(count: int) -> tuple:
+    """
+    Spreadsheet letters ("A", "B", ..., "Z", "AA", ...) of the first `count` columns.
+    """
+    letters = []
+    width = 1
+    while len(letters) < count:
+        for each in itertools.product(string.ascii_uppercase, repeat=width):
+            letters.append(''.join(each))
+            if len(letters) == count:
+                break
+        width += 1
+    return tuple(letters)
+
+
+def _to_cell(value):
+    # empty cells are read as NaN / None, treat them the same as blank strings
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ''
+    return value
+
+
+def _group_columns(values: tuple) -> dict:
+    # maps each cell value to the columns holding it, column A (the annotation labels) is skipped
+    groups = {}
+    for i in range(1, len(values)):
+        if values[i] != '':
+            groups.setdefault(values[i], []).append(i)
+    return {k: tuple(v) for k, v in groups.items()}
+
+
+class AnnotationSchema(object):
+    """
+    Parse-once view of the annotation rows of an annotated spreadsheet.
+
+    Column A is scanned a single time to locate the category rows, then the role, type, description, name, unit,
+    tag and header rows are copied into per-column tuples together with the column letters. Validation, yaml
+    generation and template generation all read from the same instance instead of re-scanning the sheet.
+
+    The schema is immutable, use `renamed` to get a schema reflecting header renames.
+    """
+    __slots__ = ('n_rows', 'n_columns', 'positions', 'letters', '_tables', '_role_groups', '_type_groups',
+                 '_header_groups')
+
+    def __init__(self, df: pd.DataFrame):
+        column_one = df.iloc[:, 0]
+        matched = pd.Series(column_one.to_numpy()).isin(CATEGORY_VALUES)
+        positions = {}
+        for row in matched[matched].index:
+            positions.setdefault(column_one.iat[row], int(row))
+
+        tables = {}
+        for category in TABLE_CATEGORIES:
+            row = positions.get(category.value)
+            if row is None and category != Category.HEADER:
+                # fall back to the canonical position so validation can still report on the other rows
+                row = ANNOTATION_ROWS.index(category)
+            if row is None or row >= df.shape[0]:
+                tables[category.value] = ('',) * df.shape[1]
+            else:
+                tables[category.value] = tuple(_to_cell(x) for x in df.iloc[row].tolist())
+
+        self._build(df.shape[0], df.shape[1], positions, tables)
+
+    def _build(self, n_rows: int, n_columns: int, positions: dict, tables: dict) -> None:
+        object.__setattr__(self, 'n_rows', n_rows)
+        object.__setattr__(self, 'n_columns', n_columns)
+        object.__setattr__(self, 'positions', MappingProxyType(positions))
+        object.__setattr__(self, 'letters', column_letters(n_columns))
+        object.__setattr__(self, '_tables', MappingProxyType(tables))
+        object.__setattr__(self, '_role_groups', _group_columns(tables[Category.ROLE.value]))
+        object.__setattr__(self, '_type_groups', _group_columns(tables[Category.TYPE.value]))
+        object.__setattr__(self, '_header_groups', _group_columns(tables[Category.HEADER.value]))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("AnnotationSchema is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("AnnotationSchema is immutable")
+
+    def index(self, category: Category) -> int:
+        """
+        Row of the given category in column A, raises IndexError if column A does not contain it.
+        """
+        if category.value not in self.positions:
+            raise IndexError("Missing annotation \"{}\" in column A".format(category.value))
+        return self.positions[category.value]
+
+    def get_row(self, category: Category) -> tuple:
+        return self._tables[category.value]
+
+    @property
+    def role_index(self) -> typing.Optional[int]:
+        return self.positions.get(Category.ROLE.value)
+
+    @property
+    def type_index(self) -> typing.Optional[int]:
+        return self.positions.get(Category.TYPE.value)
+
+    @property
+    def unit_index(self) -> typing.Optional[int]:
+        return self.positions.get(Category.UNIT.value)
+
+    @property
+    def header_index(self) -> typing.Optional[int]:
+        return self.positions.get(Category.HEADER.value)
+
+    @property
+    def data_index(self) -> typing.Optional[int]:
+        return self.positions.get(Category.DATA.value)
+
+    @property
+    def has_tag(self) -> bool:
+        return self.positions.get(Category.TAG.value, len(ANNOTATION_ROWS)) < len(ANNOTATION_ROWS)
+
+    @property
+    def roles(self) -> tuple:
+        return self._tables[Category.ROLE.value]
+
+    @property
+    def types(self) -> tuple:
+        return self._tables[Category.TYPE.value]
+
+    @property
+    def descriptions(self) -> tuple:
+        return self._tables[Category.DESCRIPTION.value]
+
+    @property
+    def names(self) -> tuple:
+        return self._tables[Category.NAME.value]
+
+    @property
+    def units(self) -> tuple:
+        return self._tables[Category.UNIT.value]
+
+    @property
+    def tags(self) -> tuple:
+        return self._tables[Category.TAG.value]
+
+    @property
+    def headers(self) -> tuple:
+        return self._tables[Category.HEADER.value]
+
+    def role_columns(self, role: str, *, startswith=False) -> tuple:
+        return self._find(self._role_groups, role, None, startswith)
+
+    def type_columns(self, type_: str, *, within: tuple = None, startswith=False) -> tuple:
+        return self._find(self._type_groups, type_, within, startswith)
+
+    def header_columns(self, header) -> tuple:
+        return self._header_groups.get(header, ())
+
+    @staticmethod
+    def _find(groups: dict, value, within, startswith) -> tuple:
+        if startswith:
+            columns = sorted(i for k, v in groups.items() if isinstance(k, str) and k.startswith(value) for i in v)
+        else:
+            columns = groups.get(value, ())
+        if within is not None:
+            within = set(within)
+            columns = [i for i in columns if i in within]
+        return tuple(columns)
+
+    def renamed(self, rename_columns: list) -> 'AnnotationSchema':
+        """
+        Returns a new schema with the (row, column, new value) renames from validation applied.
+        """
+        tables = {k: list(v) for k, v in self._tables.items()}
+        rows = {}
+        for category in TABLE_CATEGORIES:
+            row = self.positions.get(category.value)
+            if row is None and category != Category.HEADER:
+                row = ANNOTATION_ROWS.index(category)
+            if row is not None:
+                rows.setdefault(row, []).append(category.value)
+        for row, col, value in rename_columns:
+            for each in rows.get(row, []):
+                tables[each][col] = _to_cell(value)
+
+        tables = {k: tuple(v) for k, v in tables.items()}
+        schema = AnnotationSchema.__new__(AnnotationSchema)
+        schema._build(self.n_rows, self.n_columns, dict(self.positions), tables)
+        return schema
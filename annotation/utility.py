@@ -11,6 +11,7 @@ class Category(Enum):
     DESCRIPTION = 'description'
     NAME = 'name'
     UNIT = 'unit'
+    TAG = 'tag'
     HEADER = 'header'
     DATA = 'data'
 
@@ -20,7 +21,11 @@ class Utility(object):
         pass
 
     @staticmethod
-    def find_data_start_row(df: pd.DataFrame) -> (int, int):
+    def find_data_start_row(df: pd.DataFrame, schema=None) -> (int, int):
+        # reuse the rows located by an already parsed AnnotationSchema when one is given
+        if schema is not None:
+            return schema.index(Category.HEADER), schema.index(Category.DATA)
+
         header_index = Utility.get_index(df.iloc[:, 0], Category.HEADER.value)
         data_index = Utility.get_index(df.iloc[:, 0], Category.DATA.value)
 
@@ -38,3 +43,18 @@ class Utility(object):
     @staticmethod
     def get_index(series: pd.Series, value, *, pos=0) -> int:
         return int(series[series == value].index[pos])
+
+    @staticmethod
+    def to_parquet(df: pd.DataFrame, file_path: str) -> None:
+        """
+        save the dataframe as parquet, mixed type object columns (common in the annotation sheets) are saved as
+        strings since parquet needs a single type per column. Needs pyarrow or fastparquet.
+        """
+        df = df.copy(deep=False)
+        df.columns = [str(each) for each in df.columns]
+        for each in df.columns[df.dtypes == object]:
+            df[each] = df[each].where(df[each].isna(), df[each].astype(str))
+        try:
+            df.to_parquet(file_path, index=False)
+        except ImportError as e:
+            raise ValueError("Saving parquet files requires pyarrow or fastparquet: {}".format(e))
@@ -1,8 +1,8 @@
 import json
 import pandas as pd
-from xlsxwriter import utility
 from annotation.utility import Utility
-from annotation.utility import Category
+from annotation.schema import AnnotationSchema
+from annotation.generation.generate_t2wml_files import run_blocking
 
 ROLE_ROW = 2
 TYPE_ROW = 3
@@ -45,6 +45,7 @@ class ValidateAnnotation(object):
         }
         self.inhouse_utilty = Utility()
         self.renamed_columns = {}
+        self.schema = None
 
     def validate(self, dataset_id, file_path=None, df=None):
         if file_path is None and df is None:
@@ -52,15 +53,18 @@ class ValidateAnnotation(object):
         if file_path is not None:
             df = pd.read_excel(file_path, header=None).fillna('')
 
-        valid_column_one = self.validate_annotation_column_one(df, dataset_id)
+        # parse the annotation rows once, callers can reuse `self.schema` for yaml and template generation
+        self.schema = schema = AnnotationSchema(df)
 
-        valid_roles, qualifier_cols, variable_col_ids = self.validate_roles(df)
+        valid_column_one = self.validate_annotation_column_one(df, dataset_id, schema)
 
-        valid_role_and_type = self.validate_roles_types(df)
+        valid_roles, qualifier_cols, variable_col_ids = self.validate_roles(df, schema)
+
+        valid_role_and_type = self.validate_roles_types(df, schema)
 
         try:
-            rename_columns = self.validate_qualifier_headers(df, qualifier_cols)
-            rename_columns.extend(self.validate_variable_headers(df, variable_col_ids))
+            rename_columns = self.validate_qualifier_headers(df, qualifier_cols, schema)
+            rename_columns.extend(self.validate_variable_headers(df, variable_col_ids, schema))
         except IndexError:
             # Missing "data" in column one causes exception
             rename_columns = []
@@ -69,31 +73,25 @@ class ValidateAnnotation(object):
             return json.dumps(self.error_report, indent=4), False, rename_columns
         return "", True, rename_columns
 
-    def validate_roles(self, df):
+    async def validate_async(self, dataset_id, file_path=None, df=None):
+        """
+        asyncio version of validate, run in the default executor
+        """
+        return await run_blocking(self.validate, dataset_id, file_path=file_path, df=df)
+
+    def validate_roles(self, df, schema: AnnotationSchema = None):
         # 1. one main subject
         # 2. at least one time
         # 3. location annotation is optional
         # 4. at least one variable annotation must be present
-        roles = list(df.iloc[1])
+        if schema is None:
+            schema = AnnotationSchema(df)
         valid_roles = True
-        main_subject_cols = []
-        variable_cols = []
-        variable_col_ids = []
-        time_cols = []
-        location_cols = []
-        qualifier_cols = []
-        for i, x in enumerate(roles):
-            if x == 'main subject':
-                main_subject_cols.append(utility.xl_col_to_name(i))
-            if x == 'variable':
-                variable_cols.append(utility.xl_col_to_name(i))
-                variable_col_ids.append(i)
-            if x == 'time':
-                time_cols.append(utility.xl_col_to_name(i))
-            if x == 'location':
-                location_cols.append(utility.xl_col_to_name(i))
-            if x == 'qualifier':
-                qualifier_cols.append(utility.xl_col_to_name(i))
+        main_subject_cols = [schema.letters[i] for i in schema.role_columns('main subject')]
+        variable_col_ids = list(schema.role_columns('variable'))
+        variable_cols = [schema.letters[i] for i in variable_col_ids]
+        time_cols = [schema.letters[i] for i in schema.role_columns('time')]
+        qualifier_cols = [schema.letters[i] for i in schema.role_columns('qualifier')]
 
         if len(variable_cols) == 0:
             valid_roles = False
@@ -131,14 +129,17 @@ class ValidateAnnotation(object):
 
         return valid_roles, qualifier_cols, variable_col_ids
 
-    def validate_roles_types(self, df):
-        roles = list(df.iloc[1])
-        types = list(df.iloc[2])
+    def validate_roles_types(self, df, schema: AnnotationSchema = None):
+        if schema is None:
+            schema = AnnotationSchema(df)
+        roles = schema.roles
+        types = schema.types
+        letters = schema.letters
         invalid_roles = []
 
         for i in range(1, len(roles)):
             if roles[i].strip().split(';')[0] not in self.valid_roles and roles[i] != '':
-                invalid_roles.append(utility.xl_col_to_name(i))
+                invalid_roles.append(letters[i])
 
         if invalid_roles:
             self.error_report.append(
@@ -156,7 +157,7 @@ class ValidateAnnotation(object):
                 self.error_report.append(self.error_row(
                     'Missing TYPE for role: {}'.format(r),
                     TYPE_ROW,
-                    utility.xl_col_to_name(i),
+                    letters[i],
                     'Please specify a valid type. Valid type for role: {} is one of the following: [{}]'.
                         format(r, ','.join(self.valid_types[r]))
                 ))
@@ -165,7 +166,7 @@ class ValidateAnnotation(object):
                 self.error_report.append(self.error_row(
                     'Missing ROLE for type: {}'.format(t),
                     ROLE_ROW,
-                    utility.xl_col_to_name(i),
+                    letters[i],
                     'Specifying TYPE without a ROLE is invalid'
                 ))
                 valid_types = False
@@ -176,7 +177,7 @@ class ValidateAnnotation(object):
                         self.error_report.append(self.error_row(
                             'Invalid type: {}, for the role: {}'.format(t, r),
                             TYPE_ROW,
-                            utility.xl_col_to_name(i),
+                            letters[i],
                             'Valid type for role: {}, is either one of [{}], OR a python date format '
                             'regex(https://docs.python.org/3.7/library/datetime.html#strftime-and-strptime-behavior)'
                                 .format(r, ','.join(self.valid_types[r]))
@@ -187,107 +188,112 @@ class ValidateAnnotation(object):
                         self.error_report.append(self.error_row(
                             'Invalid type: {}, for the role: {}'.format(t, r),
                             TYPE_ROW,
-                            utility.xl_col_to_name(i),
+                            letters[i],
                             'Valid type for role: {}, is [{}]'.format(r, ','.join(self.valid_types[r]))
                         ))
                         valid_types = False
 
         return valid_types
 
-    def validate_annotation_column_one(self, df, dataset_id):
+    def validate_annotation_column_one(self, df, dataset_id, schema: AnnotationSchema = None):
+        if schema is None:
+            schema = AnnotationSchema(df)
+        letters = schema.letters
         valid_first_column = True
         dataset = df.iloc[0, 1].strip()
 
         if dataset == '':
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Please specify the dataset', 1, utility.xl_col_to_name(1), 'dataset can not be blank'))
+                self.error_row('Please specify the dataset', 1, letters[1], 'dataset can not be blank'))
 
         if dataset != dataset_id:
             valid_first_column = False
             self.error_report.append(
                 self.error_row('Dataset ID in the file is not same as the Dataset ID in the URL', 1,
-                               utility.xl_col_to_name(1),
+                               letters[1],
                                'Expected: {} but got:{}'.format(dataset_id, dataset)))
 
         if df.iloc[0, 0].strip().lower() != 'dataset':
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Incorrect annotation: First Column', 1, utility.xl_col_to_name(0),
+                self.error_row('Incorrect annotation: First Column', 1, letters[0],
                                'First row in column 1 should be "dataset"'))
 
         if df.iloc[1, 0].strip().lower() != 'role':
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Incorrect annotation: First Column', 2, utility.xl_col_to_name(0),
+                self.error_row('Incorrect annotation: First Column', 2, letters[0],
                                'Second row in column 1 should be "role"'))
 
         if df.iloc[2, 0].strip().lower() != 'type':
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Incorrect annotation: First Column', 3, utility.xl_col_to_name(0),
+                self.error_row('Incorrect annotation: First Column', 3, letters[0],
                                'Third row in column 1 should be "type"'))
 
         if df.iloc[3, 0].strip().lower() != 'description':
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Incorrect annotation: First Column', 4, utility.xl_col_to_name(0),
+                self.error_row('Incorrect annotation: First Column', 4, letters[0],
                                'Fourth row in column 1 should be "description"'))
 
         if df.iloc[4, 0].strip().lower() != 'name':
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Incorrect annotation: First Column', 5, utility.xl_col_to_name(0),
+                self.error_row('Incorrect annotation: First Column', 5, letters[0],
                                'Fifth row in column 1 should be "name"'))
 
         if df.iloc[5, 0].strip().lower() != 'unit':
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Incorrect annotation: First Column', 6, utility.xl_col_to_name(0),
+                self.error_row('Incorrect annotation: First Column', 6, letters[0],
                                'Sixth row in column 1 should be "unit"'))
 
         if df.iloc[6, 0].strip().lower() != 'tag':
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Incorrect annotation: First Column', 7, utility.xl_col_to_name(0),
+                self.error_row('Incorrect annotation: First Column', 7, letters[0],
                                'Seventh row in column 1 should be "tag"'))
 
-        try:
-            header_index = Utility.get_index(df.iloc[:, 0], Category.HEADER.value)
-        except:
+        if schema.header_index is None:
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Incorrect annotation: First Column', -1, utility.xl_col_to_name(0),
+                self.error_row('Incorrect annotation: First Column', -1, letters[0],
                                'Missing annotation "header" in column A'))
-        try:
-            data_index = Utility.get_index(df.iloc[:, 0], Category.DATA.value)
-        except:
+        if schema.data_index is None:
             valid_first_column = False
             self.error_report.append(
-                self.error_row('Incorrect annotation: First Column', -1, utility.xl_col_to_name(0),
+                self.error_row('Incorrect annotation: First Column', -1, letters[0],
                                'Missing annotation "data" in column A'))
 
         return valid_first_column
 
-    def validate_qualifier_headers(self, df, qualifier_cols):
-        header_row, data_row = self.inhouse_utilty.find_data_start_row(df)
+    def validate_qualifier_headers(self, df, qualifier_cols, schema: AnnotationSchema = None):
+        if schema is None:
+            schema = AnnotationSchema(df)
+        header_row, data_row = self.inhouse_utilty.find_data_start_row(df, schema)
+        qualifier_cols = set(qualifier_cols)
         rename_columns = []
-        for i, col in enumerate(df.iloc[header_row]):
-            if utility.xl_col_to_name(i) in qualifier_cols:
+        for i, col in enumerate(schema.headers):
+            if schema.letters[i] in qualifier_cols:
                 if col in self.reserved_qualifier_columns:
                     # record the cell and renamed
                     rename_columns.append((header_row, i, self.rename_column(col)))
         return rename_columns
 
-    def validate_variable_headers(self, df, variable_col_ids):
-        header_row, data_row = self.inhouse_utilty.find_data_start_row(df)
+    def validate_variable_headers(self, df, variable_col_ids, schema: AnnotationSchema = None):
+        if schema is None:
+            schema = AnnotationSchema(df)
+        header_row, data_row = self.inhouse_utilty.find_data_start_row(df, schema)
+        headers = schema.headers
         variable_dict = {}
 
         rename_columns = []
         for vi in variable_col_ids:
-            if df.iloc[header_row, vi] not in variable_dict:
-                variable_dict[df.iloc[header_row, vi]] = []
-            variable_dict[df.iloc[header_row, vi]].append((df.iloc[4, vi], vi))
+            if headers[vi] not in variable_dict:
+                variable_dict[headers[vi]] = []
+            variable_dict[headers[vi]].append((schema.names[vi], vi))
 
         # For each unique header name
         for v in variable_dict:
@@ -309,7 +315,7 @@ class ValidateAnnotation(object):
                     vids = v_dict[k]
                     # Rename column if needed
                     # Should use k (the annotaed name) if k is not empty, right???
-                    renamed_col = self.rename_column(df.iloc[header_row, vids[0]])
+                    renamed_col = self.rename_column(headers[vids[0]])
                     for vid in vids:
                         rename_columns.append((header_row, vid, renamed_col))
         return rename_columns
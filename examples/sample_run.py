@@ -21,11 +21,8 @@ def main():
     # you can also send parameter as debug_dir="path_to_folder" to specify the output debugging file,
     # default it will save to user's home directory + "datamart-annotation-debug-output"
 
-    # output to current directory
-    test.generate_edges("./")
-
-    # or output to dataframe
-    output = test.generate_edges_df()
+    # output to current directory and to dataframe, t2wml and kgtk only run once
+    _, output = test.generate_edges_and_df("./")
     print("------------output kgtk file is------------")
     print(output)
 
@@ -0,0 +1,338 @@
+import argparse
+import copy
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import pandas as pd
+
+from annotation.schema import AnnotationSchema
+from annotation.generation.generate_t2wml import ToT2WML, Type, infer_time_format, to_number_column
+from annotation.generation.annotation_to_template import generate_template_from_df, _generate_unit_tab
+from annotation.validation.validate_annotation import ValidateAnnotation
+from annotation.generation.wikify_datamart_units_and_attributes import load_xlsx, REQUIRED_SHEET_NAME_CONFIG, \
+    OPTIONAL_SHEET_NAME_CONFIG
+from annotation.generation import reference_data
+from annotation.generation.wikify_datamart_units_and_attributes import _check_double_quotes, _generate_dataset_file, \
+    to_kgtk_format_string
+from annotation.memory_report import MemoryReport
+from annotation.generation.edge_delta import diff_edges
+
+
+def make_wide_sheet(n_columns: int, n_rows: int, dataset_id: str = 'bench') -> pd.DataFrame:
+    """
+    Annotated sheet with one main subject, one year column and `n_columns` variable columns interleaved
+    with qualifier columns.
+    """
+    roles = ['role', 'main subject', 'time']
+    types = ['type', 'string', 'year']
+    headers = ['header', 'site', 'year']
+    for i in range(n_columns):
+        if i % 4 == 3:
+            roles.append('qualifier')
+            types.append('string')
+        else:
+            roles.append('variable')
+            types.append('number')
+        headers.append('column {}'.format(i))
+    width = len(roles)
+
+    def row(label, values=None):
+        return [label] + (values if values is not None else [''] * (width - 1))
+
+    rows = [row('dataset', [dataset_id] + [''] * (width - 2)), roles, types, row('description'), row('name'),
+            row('unit'), row('tag'), headers]
+    for r in range(n_rows):
+        rows.append(['data' if r == 0 else '', 'site {}'.format(r % 10), str(2000 + r % 20)] +
+                    [str(r + i) for i in range(width - 3)])
+    return pd.DataFrame(rows)
+
+
+def _timed(name, func):
+    s = time()
+    result = func()
+    print('{:<40}{:>10.3f} seconds'.format(name, time() - s))
+    return result
+
+
+def benchmark_schema(args):
+    df = make_wide_sheet(args.columns, args.rows)
+    print('sheet shape: {}'.format(df.shape))
+
+    # each subsystem parses the annotation on its own
+    _timed('validate (own schema)', lambda: ValidateAnnotation().validate('bench', df=df))
+    _timed('yaml (own schema)', lambda: ToT2WML(df, 'Qbench').get_dict())
+    _timed('template (own schema)', lambda: generate_template_from_df(df, 'Qbench', 'bench'))
+
+    # parse once and share
+    schema = _timed('AnnotationSchema', lambda: AnnotationSchema(df))
+    _timed('yaml (shared schema)', lambda: ToT2WML(df, 'Qbench', schema=schema).get_dict())
+    _timed('template (shared schema)', lambda: generate_template_from_df(df, 'Qbench', 'bench', schema=schema))
+
+
+def benchmark_formats(args):
+    columns = {
+        Type.YEAR: pd.Series([str(1990 + i % 30) for i in range(args.rows)]),
+        Type.MONTH: pd.Series([['Jan', 'Feb', 'Mar', 'Apr'][i % 4] for i in range(args.rows)]),
+        Type.DAY: pd.Series([str(1 + i % 28) for i in range(args.rows)]),
+        Type.DATE: pd.Series(['2020-{:02}-{:02}'.format(1 + i % 12, 1 + i % 28) for i in range(args.rows)]),
+    }
+    print('rows: {}'.format(args.rows))
+    for col_type, values in columns.items():
+        for sample_size in [None, args.sample_size]:
+            name = '{} (sample {})'.format(col_type.value, sample_size or 'all')
+            spec_format, confidence = _timed(name, lambda: infer_time_format(values, col_type, sample_size))
+            print('    format: {}, confidence: {:.3f}'.format(spec_format, confidence))
+
+
+def _region_cells(t2wml_script: dict) -> int:
+    # t2wml only evaluates the first region
+    region = t2wml_script['statementMapping']['region'][0]
+    columns = to_number_column(region['right']) - to_number_column(region['left']) + 1 - \
+        len(region.get('skip_columns', []))
+    return columns * (region['bottom'] - region['top'] + 1)
+
+
+def benchmark_regions(args):
+    # variables interleaved with qualifier columns, one qualifier every `--interleave` columns
+    df = make_wide_sheet(args.columns, args.rows)
+    roles = df.iloc[1].tolist()
+    types = df.iloc[2].tolist()
+    for col in range(3, df.shape[1]):
+        qualifier = (col - 3) % args.interleave == args.interleave - 1
+        roles[col] = 'qualifier' if qualifier else 'variable'
+        types[col] = 'string' if qualifier else 'number'
+    df.iloc[1] = roles
+    df.iloc[2] = types
+    variables = roles.count('variable')
+    print('sheet shape: {}, {} variable columns'.format(df.shape, variables))
+    for exact_regions in [False, True]:
+        name = 'skipped columns' if exact_regions else 'single span'
+        script = _timed('yaml ({})'.format(name), lambda: ToT2WML(df, 'Qbench', exact_regions=exact_regions)
+                        .get_dict())
+        cells = _region_cells(script)
+        print('    {} skipped columns, {} candidate cells, {} statement cells'.format(
+            len(script['statementMapping']['region'][0].get('skip_columns', [])), cells, variables * args.rows))
+
+
+def benchmark_units(args):
+    df = make_wide_sheet(4, args.rows)
+    # two unit columns with a handful of distinct values
+    df[df.shape[1]] = ['', 'unit', 'string', '', '', '', '', 'unit a'] + \
+                      ['kg' if r % 3 else 'ton' for r in range(args.rows)]
+    df[df.shape[1]] = ['', 'unit', 'string', '', '', '', '', 'unit b'] + \
+                      ['per year' if r % 2 else 'per month' for r in range(args.rows)]
+    schema = AnnotationSchema(df)
+    content_part = df.iloc[schema.data_index:, 1:]
+    print('rows: {}'.format(args.rows))
+    units = _timed('_generate_unit_tab', lambda: _generate_unit_tab('Qbench', content_part, schema))
+    print('    units: {}'.format(units['Unit'].tolist()))
+
+
+def stress_concurrency(args):
+    # needs t2wml and kgtk, imported here so the other benchmarks run without them
+    from annotation.main import T2WMLAnnotation
+
+    def convert(i):
+        df = make_wide_sheet(args.columns, args.rows, dataset_id='stress{}'.format(i))
+        return T2WMLAnnotation().process('Qstress{}'.format(i), df, [])
+
+    def normalized(result):
+        variable_ids, edges_df = result
+        return sorted(variable_ids), edges_df.sort_values(list(edges_df.columns)).reset_index(drop=True)
+
+    expected = [normalized(each) for each in _timed('{} conversions in sequence'.format(args.conversions),
+                                                    lambda: [convert(i) for i in range(args.conversions)])]
+    with ThreadPoolExecutor(max_workers=args.conversions) as executor:
+        results = _timed('{} conversions in threads'.format(args.conversions),
+                         lambda: list(executor.map(convert, range(args.conversions))))
+    failures = 0
+    for i, (each, (expected_ids, expected_df)) in enumerate(zip(results, expected)):
+        variable_ids, edges_df = normalized(each)
+        if variable_ids != expected_ids or not edges_df.equals(expected_df):
+            failures += 1
+            print('conversion {} differs from its sequential result'.format(i))
+    if failures:
+        raise ValueError('{} of {} concurrent conversions failed'.format(failures, args.conversions))
+    print('all {} concurrent conversions match'.format(args.conversions))
+
+
+def benchmark_workbook(args):
+    sheet_names = list(REQUIRED_SHEET_NAME_CONFIG.values()) + list(OPTIONAL_SHEET_NAME_CONFIG.values())
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_file = os.path.join(temp_dir, 'template.xlsx')
+        with pd.ExcelWriter(input_file) as writer:
+            for sheet_name in sheet_names:
+                pd.DataFrame({'node1': ['Q{}'.format(i) for i in range(args.rows)],
+                              'label': ['P{}'.format(i % 50) for i in range(args.rows)],
+                              'node2': [str(i) for i in range(args.rows)]}) \
+                    .to_excel(writer, sheet_name=sheet_name, index=False)
+        print('workbook: {} sheets of {} rows'.format(len(sheet_names), args.rows))
+
+        def load_per_sheet():
+            # one read_excel per sheet, each one parses the workbook again
+            available = pd.ExcelFile(input_file).sheet_names
+            return {each: pd.read_excel(input_file, each) for each in sheet_names if each in available}
+
+        _timed('read_excel per sheet', load_per_sheet)
+        _timed('load_xlsx (single open)', lambda: load_xlsx(input_file))
+        _timed('load_xlsx (cache miss)', lambda: load_xlsx(input_file, use_cache=True))
+        _timed('load_xlsx (cache hit)', lambda: load_xlsx(input_file, use_cache=True))
+
+
+def benchmark_reference(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        snapshot_path = _timed('build_snapshot', lambda: reference_data.build_snapshot(
+            os.path.join(temp_dir, 'reference_data.snapshot')))
+        print('snapshot: {} bytes'.format(os.path.getsize(snapshot_path)))
+
+        def parse_text():
+            return {name: reference_data.load_text(name) for name in reference_data.SOURCES}
+
+        for _ in range(args.repeat):
+            text = _timed('parse text sources', parse_text)
+            snapshot = _timed('load snapshot', lambda: reference_data.load_snapshot(snapshot_path))
+        for name, value in text.items():
+            same = value.equals(snapshot[name]) if isinstance(value, pd.DataFrame) else value == snapshot[name]
+            if not same:
+                raise ValueError('snapshot entry `{}` differs from its text source'.format(name))
+        print('all {} snapshot entries match their text sources'.format(len(text)))
+
+
+def benchmark_copies(args):
+    # traced peak of the stages that used to copy the sheet or the edges, each one next to its previous version
+    df = make_wide_sheet(args.columns, args.rows)
+    edges = pd.DataFrame({'dataset': ['Qbench'] * args.rows,
+                          'label': [['label', 'description', 'P31', 'P1813'][r % 4] for r in range(args.rows)],
+                          'node2': ['value {}'.format(r) if r % 3 else 'Q{}'.format(r) for r in range(args.rows)]})
+    edges['node1'] = edges['dataset']
+    print('sheet shape: {}, edges: {}'.format(df.shape, len(edges)))
+    data_row = AnnotationSchema(df).data_index
+
+    def slice_content_before():
+        # set_index(0) and a row list, both copy the sheet
+        input_df = df.set_index(0)
+        return input_df, input_df.iloc[list(range(data_row, len(input_df)))]
+
+    def slice_content_after():
+        annotation_part = df.iloc[:, 1:]
+        return annotation_part, annotation_part.iloc[data_row:]
+
+    def check_double_quotes_before():
+        # copy of the frame, then every row is applied over
+        label_types = {'label', 'description'}
+
+        def update(each_series):
+            each_series['node2'] = to_kgtk_format_string(each_series['node2'])
+            return each_series
+        return edges.copy().apply(lambda x: update(x) if x['label'] in label_types else x, axis=1)
+
+    def generate_dataset_file_before():
+        # deep copy of the edges, ids built over iterrows
+        output_df = copy.deepcopy(edges)
+        output_df['id'] = ['{}-{}'.format(each_row['dataset'], each_row['label'])
+                           for _, each_row in output_df.iterrows()]
+        return output_df
+
+    report = MemoryReport()
+    for name, before, after in [
+            ('template content slice', slice_content_before, slice_content_after),
+            ('_check_double_quotes', check_double_quotes_before,
+             lambda: _check_double_quotes(edges, label_types={'label', 'description'})),
+            ('_generate_dataset_file', generate_dataset_file_before, lambda: _generate_dataset_file(edges))]:
+        if not args.skip_before:
+            with report.stage('{} (before)'.format(name)):
+                before()
+        with report.stage('{} (after)'.format(name)):
+            after()
+    with report.stage('generate_template_from_df'):
+        generate_template_from_df(df, 'Qbench', 'bench')
+    for each in report.stages:
+        print('{:<40}{:>10.3f} seconds{:>10.1f} MB traced peak'.format(
+            each['stage'], each['seconds'], each['traced_peak_delta_bytes'] / 1024 / 1024))
+
+
+def benchmark_delta(args):
+    # edge files of two versions of a dataset, `changes` edges removed, modified and added between them
+    with tempfile.TemporaryDirectory() as directory:
+        previous_path = os.path.join(directory, 'previous.tsv')
+        current_path = os.path.join(directory, 'current.tsv')
+        with open(previous_path, 'w') as previous, open(current_path, 'w') as current:
+            previous.write('node1\tlabel\tnode2\tid\n')
+            current.write('node1\tlabel\tnode2\tid\n')
+            step = max(args.edges // args.changes, 1)
+            for i in range(args.edges):
+                edge = 'Q{}\tP{}\t{}\tQ{}-P{}-{}\n'.format(i // 10, i % 10, i, i // 10, i % 10, i)
+                previous.write(edge)
+                if i % step == 0:
+                    continue
+                current.write(edge if i % step != 1 else edge.replace('\t{}\t'.format(i), '\tchanged\t'))
+            for i in range(args.changes):
+                current.write('Qnew\tP1\t{}\tQnew-P1-{}\n'.format(i, i))
+        print('edges: {}, files: {:.1f} MB'.format(
+            args.edges, (os.path.getsize(previous_path) + os.path.getsize(current_path)) / 1024 / 1024))
+        report = MemoryReport()
+        with report.stage('diff_edges'):
+            counts = diff_edges(previous_path, current_path, os.path.join(directory, 'added.tsv'),
+                                os.path.join(directory, 'removed.tsv'), memory_budget=args.memory_budget * 1024 * 1024)
+        print(counts)
+        for each in report.stages:
+            print('{:<40}{:>10.3f} seconds{:>10.1f} MB traced peak'.format(
+                each['stage'], each['seconds'], each['traced_peak_delta_bytes'] / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the annotation pipeline.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    schema_parser = subparsers.add_parser('schema', help='Annotation parsing on a wide sheet')
+    schema_parser.add_argument('--columns', type=int, default=10000)
+    schema_parser.add_argument('--rows', type=int, default=10)
+    schema_parser.set_defaults(func=benchmark_schema)
+
+    formats_parser = subparsers.add_parser('formats', help='Time format inference on a long column')
+    formats_parser.add_argument('--rows', type=int, default=2000000)
+    formats_parser.add_argument('--sample-size', type=int, default=10000)
+    formats_parser.set_defaults(func=benchmark_formats)
+
+    regions_parser = subparsers.add_parser('regions', help='Statement regions on an interleaved layout')
+    regions_parser.add_argument('--columns', type=int, default=200)
+    regions_parser.add_argument('--rows', type=int, default=1000)
+    regions_parser.add_argument('--interleave', type=int, default=2)
+    regions_parser.set_defaults(func=benchmark_regions)
+
+    units_parser = subparsers.add_parser('units', help='Unit discovery on a long sheet with unit columns')
+    units_parser.add_argument('--rows', type=int, default=1000000)
+    units_parser.set_defaults(func=benchmark_units)
+
+    workbook_parser = subparsers.add_parser('workbook', help='Loading the sheets of a template workbook')
+    workbook_parser.add_argument('--rows', type=int, default=5000)
+    workbook_parser.set_defaults(func=benchmark_workbook)
+
+    reference_parser = subparsers.add_parser('reference', help='Bundled reference data from text vs. snapshot')
+    reference_parser.add_argument('--repeat', type=int, default=3)
+    reference_parser.set_defaults(func=benchmark_reference)
+
+    copies_parser = subparsers.add_parser('copies', help='Peak memory of the template stages on a long sheet')
+    copies_parser.add_argument('--columns', type=int, default=4)
+    copies_parser.add_argument('--rows', type=int, default=200000)
+    copies_parser.add_argument('--skip-before', action='store_true',
+                               help='Only run the current stages, the previous ones are slow on long sheets')
+    copies_parser.set_defaults(func=benchmark_copies)
+
+    delta_parser = subparsers.add_parser('delta', help='Diff of two versions of a large edge file')
+    delta_parser.add_argument('--edges', type=int, default=5000000)
+    delta_parser.add_argument('--changes', type=int, default=1000)
+    delta_parser.add_argument('--memory-budget', type=int, default=64, help='MB')
+    delta_parser.set_defaults(func=benchmark_delta)
+
+    concurrency_parser = subparsers.add_parser('concurrency', help='Stress test of conversions running in threads')
+    concurrency_parser.add_argument('--conversions', type=int, default=8)
+    concurrency_parser.add_argument('--columns', type=int, default=20)
+    concurrency_parser.add_argument('--rows', type=int, default=200)
+    concurrency_parser.set_defaults(func=stress_concurrency)
+
+    args = parser.parse_args()
+    args.func(args)
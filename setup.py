@@ -1,4 +1,10 @@
+import importlib.util
+import os
 import setuptools
+from setuptools.command.build_py import build_py
+from setuptools.command.develop import develop
+
+REFERENCE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "annotation", "generation")
 
 with open("README.md", "r") as fh:
     long_description = fh.read()
@@ -11,6 +17,37 @@ with open('requirements.txt', 'r') as f:
             install_requires.append(re)
 
 
+def build_reference_snapshot(directory):
+    # compile the bundled reference data into the binary snapshot annotation.generation.reference_data loads,
+    # without it the data is parsed from text in every process
+    spec = importlib.util.spec_from_file_location("reference_data", os.path.join(REFERENCE_DATA_DIR,
+                                                                                 "reference_data.py"))
+    try:
+        reference_data = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(reference_data)
+    except ImportError as e:
+        print("skipping the reference data snapshot: {}".format(e))
+        return
+    print("reference data snapshot written to {}".format(
+        reference_data.build_snapshot(os.path.join(directory, "reference_data.snapshot"))))
+
+
+class BuildPyWithSnapshot(build_py):
+    def run(self):
+        super().run()
+        if not self.dry_run:
+            editable = getattr(self, "editable_mode", False)
+            build_reference_snapshot(REFERENCE_DATA_DIR if editable else
+                                     os.path.join(self.build_lib, "annotation", "generation"))
+
+
+class DevelopWithSnapshot(develop):
+    def run(self):
+        super().run()
+        if not self.dry_run:
+            build_reference_snapshot(REFERENCE_DATA_DIR)
+
+
 setuptools.setup(
     name="t2wml-annotation",
     version="0.0.3",
@@ -28,5 +65,9 @@ setuptools.setup(
     ],
     include_package_data=True,
     install_requires=install_requires,
-    package_data={'datamart': ['resources/*.json','resources/*.csv', 'resources/*.xlsx', 'resources/*.yaml', 'resources/*.tsv']}
+    # reading parquet edge files and the parquet debug format, fastparquet also works
+    extras_require={'parquet': ['pyarrow>=3.0.0']},
+    package_data={'datamart': ['resources/*.json','resources/*.csv', 'resources/*.xlsx', 'resources/*.yaml', 'resources/*.tsv'],
+                  'annotation.generation': ['*.json', '*.csv', '*.tsv']},
+    cmdclass={'build_py': BuildPyWithSnapshot, 'develop': DevelopWithSnapshot}
 )
@@ -0,0 +1,39 @@
+import csv
+import os
+import pandas as pd
+import yaml
+
+
+def prepare_t2wml_inputs(df: pd.DataFrame, t2wml_script: dict, directory: str, dataset_qnode: str) -> dict:
+    """
+    Write the sheet, the consolidated wikifier and the yaml GenerateKgtk hands to t2wml into `directory`,
+    returns their paths together with the GenerateKgtk instance
+    """
+    from annotation.generation.generate_kgtk import GenerateKgtk, register_properties
+
+    gk = GenerateKgtk(df, t2wml_script, dataset_qnode=dataset_qnode)
+    data_filepath = os.path.join(directory, "{}.csv".format(gk.dataset_id))
+    df.to_csv(data_filepath, header=None, index=False)
+    wikifier_filepath = os.path.join(directory, "wikifier.csv")
+    pd.concat([gk.constant_wikikifer_df, gk.output_df_dict["wikifier.csv"]]).to_csv(wikifier_filepath, index=False)
+    yaml_filepath = os.path.join(directory, "t2wml.yaml")
+    with open(yaml_filepath, "w") as f:
+        yaml.dump(t2wml_script, f)
+    register_properties(gk.kgtk_properties_df)
+    return {"gk": gk, "data": data_filepath, "wikifier": wikifier_filepath, "yaml": yaml_filepath}
+
+
+def run_t2wml(inputs: dict, output_path: str) -> pd.DataFrame:
+    """
+    Run t2wml on the files written by `prepare_t2wml_inputs`, returns its kgtk output sorted
+    """
+    from t2wml.api import KnowledgeGraph
+
+    KnowledgeGraph.generate_from_files(inputs["data"], os.path.basename(inputs["data"]), inputs["yaml"],
+                                       inputs["wikifier"]).save_kgtk(output_path)
+    return read_kgtk_sorted(output_path)
+
+
+def read_kgtk_sorted(path: str) -> pd.DataFrame:
+    df = pd.read_csv(path, sep="\t", quoting=csv.QUOTE_NONE, dtype=str, keep_default_na=False)
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
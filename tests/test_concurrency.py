@@ -0,0 +1,44 @@
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pytest
+
+pytest.importorskip("t2wml.api")
+if shutil.which("kgtk") is None:
+    pytest.skip("the conversion runs the kgtk command", allow_module_level=True)
+
+from annotation.main import T2WMLAnnotation
+
+N_CONVERSIONS = 8
+
+
+def make_sheet(dataset_id: str, n_rows: int = 50) -> pd.DataFrame:
+    """
+    Annotated sheet with one main subject, one year column and two variable columns
+    """
+    rows = [["dataset", dataset_id, "", "", ""],
+            ["role", "main subject", "time", "variable", "variable"],
+            ["type", "string", "year", "number", "number"],
+            ["description", "", "", "", ""],
+            ["name", "", "", "", ""],
+            ["unit", "", "", "", ""],
+            ["tag", "", "", "", ""],
+            ["header", "site", "year", "amount", "count"]]
+    for r in range(n_rows):
+        rows.append(["data" if r == 0 else "", "site {}".format(r % 10), str(2000 + r % 20), str(r), str(r * 2)])
+    return pd.DataFrame(rows)
+
+
+def convert(i: int, debug_dir) -> tuple:
+    variable_ids, edges_df = T2WMLAnnotation().process("Qstress{}".format(i), make_sheet("stress{}".format(i)), [],
+                                                       debug_dir=str(debug_dir / "stress{}".format(i)))
+    return sorted(variable_ids), edges_df.sort_values(list(edges_df.columns)).reset_index(drop=True)
+
+
+def test_conversions_in_threads_match_their_sequential_results(tmp_path):
+    expected = [convert(i, tmp_path / "sequential") for i in range(N_CONVERSIONS)]
+    with ThreadPoolExecutor(max_workers=N_CONVERSIONS) as executor:
+        results = list(executor.map(lambda i: convert(i, tmp_path / "threads"), range(N_CONVERSIONS)))
+    for (variable_ids, edges_df), (expected_ids, expected_df) in zip(results, expected):
+        assert variable_ids == expected_ids
+        pd.testing.assert_frame_equal(edges_df, expected_df)
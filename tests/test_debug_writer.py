@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from annotation.generation import debug_writer
+from annotation.generation.debug_writer import DebugArtifactWriter
+
+
+def test_close_without_waiting_hands_over_the_scratch_files(tmp_path, monkeypatch):
+    release = threading.Event()
+    copy = shutil.copy
+
+    def slow_copy(source, destination):
+        release.wait(10)
+        return copy(source, destination)
+
+    monkeypatch.setattr(debug_writer.shutil, "copy", slow_copy)
+    scratch = tempfile.TemporaryDirectory()
+    with open(os.path.join(scratch.name, "edges.tsv"), "w") as f:
+        f.write("id\tnode1\tlabel\tnode2\n")
+
+    writer = DebugArtifactWriter(str(tmp_path))
+    writer.copy_file(os.path.join(scratch.name, "edges.tsv"), "kgtk-edges.tsv")
+    # returns while the copy is still pending, the scratch folder is removed after it
+    writer.close(wait=False, then=scratch.cleanup)
+    assert not (tmp_path / "kgtk-edges.tsv").exists() and os.path.isdir(scratch.name)
+
+    release.set()
+    writer.wait()
+    assert (tmp_path / "kgtk-edges.tsv").exists()
+    assert not os.path.exists(scratch.name)
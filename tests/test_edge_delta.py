@@ -0,0 +1,61 @@
+import csv
+import math
+import os
+import pandas as pd
+import pytest
+
+from annotation.generation.edge_delta import PARSED_SIZE_FACTOR, diff_edges
+
+pytest.importorskip("pyarrow")
+
+
+def make_edges(n_rows: int) -> pd.DataFrame:
+    # quantities and empty cells, a numeric column read back from parquet is not text any more
+    return pd.DataFrame({
+        "id": ["E{}".format(i) for i in range(n_rows)],
+        "node1": ["Q{}".format(i % 50) for i in range(n_rows)],
+        "label": ["P{}".format(i % 7) for i in range(n_rows)],
+        "node2": [str(i) if i % 3 == 0 else "{}.5".format(i) if i % 3 == 1 else "" for i in range(n_rows)],
+        "node2;kgtk:number": ["" if i % 4 == 0 else str(i * 10) for i in range(n_rows)],
+    })
+
+
+def write_tsv(df: pd.DataFrame, path) -> str:
+    df.to_csv(path, sep="\t", index=False, quoting=csv.QUOTE_NONE)
+    return str(path)
+
+
+def write_parquet(df: pd.DataFrame, path) -> str:
+    # as an export typed by pandas: quantity columns become floats, empty cells missing values
+    df = df.assign(**{column: pd.to_numeric(df[column]) for column in ("node2", "node2;kgtk:number")})
+    df.to_parquet(path, compression="gzip", index=False)
+    return str(path)
+
+
+@pytest.mark.parametrize("memory_budget", [512 * 1024 * 1024, 64 * 1024])
+def test_tsv_and_parquet_round_trip(tmp_path, memory_budget):
+    edges = make_edges(20000)
+    tsv = write_tsv(edges, tmp_path / "edges.tsv")
+    parquet = write_parquet(edges, tmp_path / "edges.parquet")
+    assert pd.read_parquet(parquet)["node2"].dtype == float
+
+    for previous, current in ((tsv, parquet), (parquet, tsv)):
+        counts = diff_edges(previous, current, str(tmp_path / "added.tsv"), str(tmp_path / "removed.tsv"),
+                            memory_budget=memory_budget)
+        assert (counts["previous"], counts["current"]) == (len(edges), len(edges))
+        assert (counts["added"], counts["removed"], counts["changed"]) == (0, 0, 0)
+
+
+def test_parquet_buckets_follow_the_uncompressed_size(tmp_path):
+    edges = make_edges(20000)
+    parquet = write_parquet(edges, tmp_path / "edges.parquet")
+    changed = edges.assign(node2=edges["node2"].where(edges.index % 100 != 0, "changed"))
+    current = write_tsv(changed, tmp_path / "current.tsv")
+
+    # the budget fits both files as stored on disk, but not the edges the compressed parquet file holds
+    on_disk = os.path.getsize(parquet) + os.path.getsize(current)
+    budget = math.ceil(on_disk * PARSED_SIZE_FACTOR) + 1
+    counts = diff_edges(parquet, current, str(tmp_path / "added.tsv"), str(tmp_path / "removed.tsv"),
+                        memory_budget=budget)
+    assert counts["buckets"] > 1
+    assert counts["changed"] == counts["added"] == counts["removed"] == 200
@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+from annotation.generation.generate_t2wml import ToT2WML
+from tests.helpers import prepare_t2wml_inputs, run_t2wml
+
+pytest.importorskip("t2wml.api")
+
+
+def make_split_sheet(n_rows: int = 12) -> pd.DataFrame:
+    # variable columns D and G split by a qualifier (E) and a time (F) column
+    columns = [("main subject", "country", "site"), ("time", "year", "year"), ("variable", "number", "amount"),
+               ("qualifier", "string", "source"), ("time", "month", "month"), ("variable", "number", "count")]
+    width = len(columns) + 1
+    rows = [["dataset", "split"] + [""] * (width - 2),
+            ["role"] + [role for role, _, _ in columns],
+            ["type"] + [column_type for _, column_type, _ in columns],
+            ["description"] + [""] * (width - 1), ["name"] + [""] * (width - 1),
+            ["unit"] + ["kg" if role == "variable" else "" for role, _, _ in columns],
+            ["tag"] + [""] * (width - 1), ["header"] + [header for _, _, header in columns]]
+    for r in range(n_rows):
+        rows.append(["data" if r == 0 else "", ["Ethiopia", "Kenya", "Sudan"][r % 3], str(2000 + r),
+                     "" if r % 4 == 1 else str(r * 1.5), "source {}".format(r % 2), str(1 + r % 12), str(r)])
+    return pd.DataFrame(rows)
+
+
+def test_skip_columns_region_matches_variable_cells(tmp_path):
+    df = make_split_sheet()
+    t2wml_script = ToT2WML(df, "Qsplit").get_dict()
+    regions = t2wml_script["statementMapping"]["region"]
+    assert len(regions) == 1
+    assert regions[0]["left"] == "D" and regions[0]["right"] == "G"
+    assert regions[0]["skip_columns"] == ["E", "F"]
+
+    inputs = prepare_t2wml_inputs(df, t2wml_script, str(tmp_path), "Qsplit")
+    edges = run_t2wml(inputs, str(tmp_path / "t2wml.tsv"))
+    # qualifier edges point to the id of their statement
+    statements = edges[~edges["node1"].isin(edges["id"])]
+    cells = set(statements["id"].str.split(";").str[-1])
+
+    data = df.iloc[8:]
+    expected = {"{}{}".format(letter, row + 1) for letter, column in (("D", 3), ("G", 6))
+                for row, value in zip(data.index, data[column]) if value != ""}
+    assert cells == expected
@@ -0,0 +1,56 @@
+import asyncio
+import os
+import time
+import pytest
+
+from annotation.generation import generate_t2wml_files
+from annotation.generation.generate_t2wml_files import _move_results, async_run_shell_code, run_shell_code
+
+
+def make_work_directory(path, sheet_name: str, rows: int) -> str:
+    os.makedirs(os.path.join(str(path), sheet_name))
+    with open(os.path.join(str(path), sheet_name, "results.tsv"), "w") as f:
+        f.write("id\tnode1\tlabel\tnode2\n" + "".join("E{}\tQ1\tP1\t{}\n".format(i, i) for i in range(rows)))
+    return str(path)
+
+
+def test_sheets_of_different_workbooks_do_not_overwrite_each_other(tmp_path):
+    output = tmp_path / "t2wml-output"
+    output.mkdir()
+    moved = set()
+    assert _move_results(make_work_directory(tmp_path / ".work-0", "Sheet1", 2), str(output), "a.xlsx.", moved) == 2
+    assert _move_results(make_work_directory(tmp_path / ".work-1", "Sheet1", 3), str(output), "b.xlsx.", moved) == 3
+    assert sorted(os.listdir(str(output))) == ["a.xlsx.Sheet1.tsv", "b.xlsx.Sheet1.tsv"]
+    assert not (tmp_path / ".work-0").exists() and not (tmp_path / ".work-1").exists()
+
+
+def test_clashing_output_fails_and_keeps_the_work_directory(tmp_path):
+    output = tmp_path / "t2wml-output"
+    output.mkdir()
+    moved = set()
+    _move_results(make_work_directory(tmp_path / ".work-0", "data.csv", 2), str(output), "", moved)
+    with pytest.raises(ValueError, match="data.csv.tsv"):
+        _move_results(make_work_directory(tmp_path / ".work-1", "data.csv", 3), str(output), "", moved)
+    assert (tmp_path / ".work-1" / "data.csv" / "results.tsv").exists()
+    with open(str(output / "data.csv.tsv")) as f:
+        assert len(f.readlines()) == 3
+
+
+def test_timeout_kills_the_command():
+    with pytest.raises(TimeoutError):
+        run_shell_code("sleep 5", timeout=0.2, debug=False)
+    with pytest.raises(TimeoutError):
+        asyncio.run(async_run_shell_code("sleep 5", timeout=0.2, debug=False))
+
+
+def test_timer_firing_after_the_command_exited_is_not_a_timeout(monkeypatch):
+    # the timer fires while the finished child waits to be reaped
+    wait_unreaped = generate_t2wml_files._wait_unreaped
+
+    def slow_wait(process):
+        wait_unreaped(process)
+        time.sleep(0.5)
+
+    monkeypatch.setattr(generate_t2wml_files, "_wait_unreaped", slow_wait)
+    result = run_shell_code("echo done", timeout=0.1, debug=False)
+    assert (result.returncode, result.stdout) == (0, "done\n")
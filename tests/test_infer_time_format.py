@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+from annotation.generation.generate_t2wml import ToT2WML, Type, infer_time_format
+
+
+@pytest.mark.parametrize("values, expected", [
+    (["2020-01-05T10:00:00", "2021-02-03T00:00:00"], (None, 0.0)),
+    (["2020-01-05 10:00", "2021-02-03 08:30"], (None, 0.0)),
+    (["2020-01", "2021-02"], (["%Y-%m"], 1.0)),
+    (["2020-01-05", "2021-02-03"], (["%Y-%m-%d"], 1.0)),
+])
+def test_date_formats_parse_as_t2wml_applies_them(values, expected):
+    # a format is only a candidate if strptime, which t2wml uses on pinned formats, parses the value with it
+    assert infer_time_format(pd.Series(values), Type.DATE) == expected
+
+
+def make_date_sheet(dates: list) -> pd.DataFrame:
+    rows = [["dataset", "dates", ""], ["role", "main subject", "time"], ["type", "country", "date"],
+            ["description", "", ""], ["name", "", ""], ["unit", "", ""], ["tag", "", ""], ["header", "site", "date"]]
+    rows += [["data" if i == 0 else "", "Ethiopia", date] for i, date in enumerate(dates)]
+    return pd.DataFrame(rows)
+
+
+def time_qualifier(to_t2wml: ToT2WML) -> dict:
+    return next(each for each in to_t2wml.get_dict()["statementMapping"]["template"]["qualifier"]
+                if each["property"] == "P585")
+
+
+def test_timestamps_are_left_to_t2wml():
+    qualifier = time_qualifier(ToT2WML(make_date_sheet(["2020-01-05T10:00:00", "2021-02-03T00:00:00"]), "Qdates"))
+    assert "format" not in qualifier
+
+
+def test_year_month_format_is_pinned_from_a_sample():
+    dates = ["{}-{:02d}".format(2000 + i % 20, 1 + i % 12) for i in range(1000)]
+    to_t2wml = ToT2WML(make_date_sheet(dates), "Qdates", format_sample_size=100)
+    assert time_qualifier(to_t2wml)["format"] == ["%Y-%m"]
+
+    # one value in ten does not parse: pinned only when the threshold allows it
+    dates = [each if i % 10 else "unknown" for i, each in enumerate(dates)]
+    assert "format" not in time_qualifier(ToT2WML(make_date_sheet(dates), "Qdates", format_sample_size=100))
+    to_t2wml = ToT2WML(make_date_sheet(dates), "Qdates", format_sample_size=100, format_confidence_threshold=0.8)
+    assert time_qualifier(to_t2wml)["format"] == ["%Y-%m"]
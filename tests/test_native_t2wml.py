@@ -0,0 +1,100 @@
+import itertools
+import pandas as pd
+import pytest
+
+from annotation.generation.generate_t2wml import ToT2WML
+from annotation.generation.native_t2wml import run_native_t2wml
+from tests.helpers import prepare_t2wml_inputs, read_kgtk_sorted, run_t2wml
+
+pytest.importorskip("t2wml.api")
+
+# every role / type combination the native engine is checked against t2wml on
+NATIVE_COMBINATIONS = {
+    "main_subject": ["string", "country"],
+    "time": [("year",), ("year", "month"), ("year", "month", "day"), ("date",)],
+    "variable": ["number", "string"],
+    "qualifier": [None, "string", "date", "entity"],
+    "location": [None, "admin1", "coordinate"],
+    "unit": [None, "row", "column"],
+}
+
+
+def make_combination_sheet(main_subject: str, time_types: tuple, variable: str, qualifier: str, location: str,
+                           unit: str, n_rows: int, dataset_id: str = "combo") -> pd.DataFrame:
+    """
+    Annotated sheet with the given column types, some variable and qualifier cells are left empty.
+    """
+    columns = [("main subject", main_subject, "site")]
+    columns += [("time", each, each) for each in time_types]
+    columns += [("variable", variable, "amount"), ("variable", variable, "count")]
+    if qualifier:
+        columns.append(("qualifier", qualifier, "source"))
+    if location == "admin1":
+        columns.append(("location", "admin1", "province"))
+    elif location == "coordinate":
+        columns += [("location", "latitude", "lat"), ("location", "longitude", "lon")]
+    if unit == "column":
+        columns.append(("unit", "string", "unit"))
+
+    def cell(column_type: str, header: str, r: int) -> str:
+        date = "{}-{:02d}-{:02d}".format(2000 + r % 20, 1 + r % 12, 1 + r % 28)
+        values = {
+            "site": "site {}".format(r % 10) if column_type == "string" else ["Ethiopia", "Kenya", "Sudan"][r % 3],
+            "year": str(2000 + r % 20), "month": str(1 + r % 12), "day": str(1 + r % 28), "date": date,
+            "amount": "" if r % 7 == 3 else (str(r * 1.5) if column_type == "number" else "value {}".format(r)),
+            "count": str(r) if column_type == "number" else "count {}".format(r),
+            "source": "" if r % 5 == 4 else {"string": "source {}".format(r % 3), "date": date,
+                                             "entity": "entity {}".format(r % 3)}.get(column_type, ""),
+            "province": ["Oromia", "Amhara"][r % 2], "lat": str(9 + r % 5 / 10), "lon": str(38 + r % 7 / 10),
+            "unit": ["kg", "ton"][r % 2],
+        }
+        return values[header]
+
+    width = len(columns) + 1
+    unit_row = ["unit"] + ["kg" if unit == "row" and role == "variable" else "" for role, _, _ in columns]
+    rows = [["dataset", dataset_id] + [""] * (width - 2),
+            ["role"] + [role for role, _, _ in columns],
+            ["type"] + [column_type for _, column_type, _ in columns],
+            ["description"] + [""] * (width - 1), ["name"] + [""] * (width - 1), unit_row,
+            ["tag"] + [""] * (width - 1), ["header"] + [header for _, _, header in columns]]
+    for r in range(n_rows):
+        rows.append(["data" if r == 0 else ""] + [cell(column_type, header, r) for _, column_type, header in columns])
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize("combination", list(itertools.product(*NATIVE_COMBINATIONS.values())),
+                         ids=lambda combination: "-".join(str(each) if not isinstance(each, tuple)
+                                                          else "+".join(each) for each in combination))
+def test_native_engine_matches_t2wml(tmp_path, combination):
+    settings = dict(zip(NATIVE_COMBINATIONS, combination))
+    if settings["location"] == "admin1":
+        # admin1 columns are wikified with the table linker
+        pytest.importorskip("tl")
+    df = make_combination_sheet(settings["main_subject"], settings["time"], settings["variable"],
+                                settings["qualifier"], settings["location"], settings["unit"], 12)
+    t2wml_script = ToT2WML(df, "Qcombo").get_dict()
+    inputs = prepare_t2wml_inputs(df, t2wml_script, str(tmp_path), "Qcombo")
+
+    native_path = str(tmp_path / "native.tsv")
+    ran = run_native_t2wml(t2wml_script, inputs["data"], inputs["wikifier"], inputs["gk"].kgtk_properties_df,
+                           native_path)
+    # date qualifiers have no pinned format, t2wml guesses it cell by cell
+    assert ran == (settings["qualifier"] != "date")
+    if ran:
+        pd.testing.assert_frame_equal(read_kgtk_sorted(native_path),
+                                      run_t2wml(inputs, str(tmp_path / "t2wml.tsv")))
+
+
+def test_native_engine_matches_t2wml_on_unclean_cells(tmp_path):
+    df = make_combination_sheet("country", ("year",), "number", "string", None, "row", 12)
+    # columns: site, year, amount, count, source
+    unclean = ["1,500", "NA", "-", " 2.5", "nan", "1e3", "  ", "n/a"]
+    df.iloc[8:8 + len(unclean), 3] = unclean
+    df.iloc[8:12, 5] = ['say "hi"', "#N/A", "...", " padded "]
+    t2wml_script = ToT2WML(df, "Qcombo").get_dict()
+    inputs = prepare_t2wml_inputs(df, t2wml_script, str(tmp_path), "Qcombo")
+
+    native_path = str(tmp_path / "native.tsv")
+    assert run_native_t2wml(t2wml_script, inputs["data"], inputs["wikifier"], inputs["gk"].kgtk_properties_df,
+                            native_path)
+    pd.testing.assert_frame_equal(read_kgtk_sorted(native_path), run_t2wml(inputs, str(tmp_path / "t2wml.tsv")))
@@ -0,0 +1,42 @@
+import pandas as pd
+import pytest
+
+from annotation.generation import wikify_datamart_units_and_attributes
+from annotation.generation.wikify_datamart_units_and_attributes import run_wikifier
+
+real_get_wikifier_result = wikify_datamart_units_and_attributes.get_wikifier_result
+
+
+def fake_get_wikifier_result(input_df: pd.DataFrame, target_col: int, wikifier_type: str):
+    # the ethiopia wikifier needs an elasticsearch server, every value it gets is resolved to a fixed node instead
+    if wikifier_type == "country":
+        return real_get_wikifier_result(input_df=input_df, target_col=target_col, wikifier_type=wikifier_type)
+    return [{"column": target_col, "row": row_number, "value": label, "context": "", "item": "Q-" + label}
+            for row_number, label in input_df.iloc[:, target_col].items() if label != ""]
+
+
+@pytest.fixture
+def input_folder(tmp_path):
+    folder = tmp_path / "input"
+    folder.mkdir()
+    regions = [["Ethiopia", "Amhara", "Tigray"], ["Oromia", "Kenya", "Amhara"], ["Afar", "Tigray", "Oromia", "Kenya"]]
+    for i, values in enumerate(regions):
+        pd.DataFrame({"region": ["region"] + values}).to_csv(str(folder / "data{}.csv".format(i)), header=False,
+                                                             index=False)
+    return str(folder)
+
+
+def wikify(input_folder, output_path, workers: int) -> pd.DataFrame:
+    output_path.mkdir()
+    run_wikifier(input_folder, pd.DataFrame({"Columns": ["A"], "Rows": ["2:"]}), str(output_path), workers=workers)
+    return pd.read_csv(str(output_path / "wikifier.csv"), dtype=object)
+
+
+def test_parallel_wikifier_file_is_the_same_as_the_sequential_one(tmp_path, input_folder, monkeypatch):
+    monkeypatch.setattr(wikify_datamart_units_and_attributes, "get_wikifier_result", fake_get_wikifier_result)
+    sequential = wikify(input_folder, tmp_path / "sequential", workers=1)
+    parallel = wikify(input_folder, tmp_path / "parallel", workers=3)
+    pd.testing.assert_frame_equal(parallel, sequential)
+    # a value found by the ethiopia wikifier in one file is not wikified again in the next ones
+    ethiopia_values = sequential[sequential["item"].str.startswith("Q-")]["value"]
+    assert sorted(ethiopia_values) == ["Afar", "Amhara", "Oromia", "Tigray"]